@@ -2,18 +2,31 @@ from dino.cmd.exception import *
 from dino.cmd.command import with_session
 from dino.cmd.maincmd import MainCommand
 
-import dino.cmd.admin
-import dino.cmd.help
-import dino.cmd.jsonimport
-import dino.cmd.jsonexport
-import dino.cmd.ip
-import dino.cmd.migrate
-import dino.cmd.edit
-import dino.cmd.getset
-import dino.cmd.generate
-import dino.cmd.createkeys
-import dino.cmd.show
-import dino.cmd.info
+#
+# Command registry: module, name(s), group and usage of each command. 
+# A command module is imported only when one of its commands is looked up,
+# its classes then replace these entries (see CommandMeta.register).
+# test_command checks that they match the command classes.
+#
+MainCommand.register('dino.cmd.admin', 'admin', 'system', '<subcommand> [ <args> ]')
+MainCommand.register('dino.cmd.createkeys', 'createkeys', 'data', 'Host:<InstanceName>')
+MainCommand.register('dino.cmd.diff', 'diff', 'query', '<changeset> <changeset> [ <EntityName> ... ]')
+MainCommand.register('dino.cmd.edit', 'create', 'element', ' { -i | [ -o ] <EntityNameList> } [ -f <filename> ]')
+MainCommand.register('dino.cmd.edit', 'dump', 'element', '<ElementNameList> [ -f <filename> ]')
+MainCommand.register('dino.cmd.edit', 'edit', 'element', '{ -i | [ -o ] <ObjectSpecList> } [ -f <filename> ] ')
+MainCommand.register('dino.cmd.generate', ('generate', 'gen'), 'data', 
+    '{ -l | [ <generator> [ <generator> ] ... ] [ -g | -a ] [ -f ] [ -j <N> ] [ -p ] [ --profile-json <file> ] [ --cprofile <phase> ] }')
+MainCommand.register('dino.cmd.getset', 'get', 'deprecated', '<ElementName>/<PropertyName>')
+MainCommand.register('dino.cmd.getset', 'set', 'element', '<ElementName>/<PropertyName> <Value>')
+MainCommand.register('dino.cmd.help', 'help', 'system', '[ commands | entities | objectspec | <Command> | <EntityName> ]')
+MainCommand.register('dino.cmd.info', 'info', 'system', '')
+MainCommand.register('dino.cmd.ip', 'ip', 'query', '<subcommand>')
+MainCommand.register('dino.cmd.jsonexport', 'jsonexport', 'data', '<object> Host/<InstanceName> | -a [ -s <site> ] [ -o <file> ] [ Host[<QueryClause>] ]')
+MainCommand.register('dino.cmd.jsonimport', 'jsonimport', 'data', '[ -c | -b [ -s <batch_size> ] ] [ -j <jobs> ] <file|dir> [ , <file|dir> ] ... ]')
+MainCommand.register('dino.cmd.migrate', 'migrate', 'system', 
+    '[ -s <source_url> ] \n               [ -i|--import-dir <import-dir> ] \n               [ -p|--special-dir <special-dir> ]\n               [ -j|--jobs <jobs> ]')
+MainCommand.register('dino.cmd.show', 'delete', 'element', '<ElementNameList>')
+MainCommand.register('dino.cmd.show', ('show', 'sh'), 'query', '<EntityName> | <ElementName> | <ElementId> | <ElementQuery> | <AttributeName>')
 
 #import dino.cmd.jimport
 #import dino.cmd.showrack
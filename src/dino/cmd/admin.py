@@ -1,10 +1,15 @@
 from optparse import Option
 import logging
+import os
+import subprocess
+import sys
+import time
 
 import sqlalchemy.orm.properties as sa_props
 import sqlalchemy.orm as sa_orm
 import sqlalchemy.types as sa_types
 
+import dino
 from dino.config import load_config
 from dino.cmd.command import AbstractCommandInterface, CommandMeta, with_session, with_connection
 from dino.cmd.maincmd import MethodSubCommand, ClassSubCommand
@@ -220,11 +225,31 @@ class UpdateNamesCommand(AdminSubCommand):
 class UpdateSubnetsCommand(AdminSubCommand):
     '''Validate that all subnets have the most appropriate parent subnet assigned'''
     NAME = 'update_subnets'
-    USAGE = ''
+    USAGE = '[ -b [ -n <batch_size> ] ]'
+    OPTIONS = ( 
+        Option('-b', '--bulk', dest='bulk', action='store_true', default=False), 
+        Option('-n', '--batch-size', type="int", dest='batch_size', default=1000), 
+    )
+    
+    def validate(self):
+        if self.option.batch_size < 1:
+            raise CommandArgumentError(self, "Batch size must be positive: %s" % self.option.batch_size)
         
     @with_session
-    def execute(self, session):        
+    def execute(self, session):
+        if self.option.bulk:
+            self._execute_bulk(session)
+        else:
+            self._execute_orm(session)
+    
+    def _execute_orm(self, session):
         session.begin()
+        
+        # Load every Subnet once, so query_subnet() resolves from 
+        # the session PrefixIndex and identity map without a query 
+        subnets = session.query(Subnet).all()
+        self.log.info("Indexed %d Subnets", len(session.subnet_index))
+        
         for addr in session.query(IpAddress).all():            
             subnet = addr.query_subnet()
             if addr.subnet != subnet:
@@ -237,6 +262,52 @@ class UpdateSubnetsCommand(AdminSubCommand):
         else:
             self.log.info("No Changes")
             
+    def _execute_bulk(self, session):
+        """ Reconcile from (id, value, subnet_id) rows, and write each 
+        batch of reassignments as one UPDATE per target subnet """
+        session.open_changeset()
+        
+        index = session.subnet_index
+        self.log.info("Indexed %d Subnets", len(index))
+        
+        # target subnet_id -> [ ip.id, ... ]
+        pending = {}
+        pending_count = 0
+        examined = 0
+        changed = 0
+        
+        query = session.query(IpAddress.id, IpAddress.value, IpAddress.subnet_id)
+        for (id, value, subnet_id) in query:
+            examined += 1
+            target_id = index.lookup(IpType.aton(value))
+            if target_id == subnet_id:
+                continue
+            
+            self.log.fine("Updating: %s (%s -> %s)", value, subnet_id, target_id)
+            pending.setdefault(target_id, []).append(id)
+            pending_count += 1
+            
+            if pending_count >= self.option.batch_size:
+                changed += self._flush_bulk(session, pending)
+                pending = {}
+                pending_count = 0
+                
+        changed += self._flush_bulk(session, pending)
+        
+        if changed > 0:
+            cs = session.submit_changeset()
+            print "ChangeSet: %s" % cs
+        else:
+            session.revert_changeset()
+            
+        print "Examined: %d Changed: %d" % (examined, changed)
+        
+    def _flush_bulk(self, session, pending):
+        count = 0
+        for (target_id, ids) in pending.iteritems():
+            count += session.bulk_update(IpAddress, ids, { 'subnet_id' : target_id })
+        return count
+            
  
 class DotCommand(AdminSubCommand):
     NAME = 'dot'
@@ -373,6 +444,142 @@ digraph M {
 
 
 
+class SnapshotCommand(AdminSubCommand):
+    ''' Write every table, head and revision tables alike, to a snapshot 
+    directory: one compressed columnar file per table '''
+    
+    NAME = 'snapshot'
+    USAGE = '<dir>'
+    
+    def validate(self):
+        if len(self.args) != 1:
+            raise CommandArgumentError(self, "Must specify a snapshot directory")
+        
+    def execute(self):
+        start = time.time()
+        manifest = self.db_config.snapshot(self.args[0])
+        rows = sum([ t['rows'] for t in manifest['tables'] ])
+        self.log.info("Snapshot: %d tables %d rows %.2fs", len(manifest['tables']), rows, time.time() - start)
+        
+        if not self.cli:
+            return manifest
+        print "Snapshot: %d tables, %d rows in %.2fs" % (len(manifest['tables']), rows, time.time() - start)
+
+
+class RestoreCommand(AdminSubCommand):
+    ''' Replace the contents of every table with a snapshot directory '''
+    
+    NAME = 'restore'
+    USAGE = '<dir>'
+    
+    def validate(self):
+        if len(self.args) != 1:
+            raise CommandArgumentError(self, "Must specify a snapshot directory")
+        if not os.path.isdir(self.args[0]):
+            raise CommandArgumentError(self, "Path is not directory: %s" % self.args[0])
+        
+    def execute(self):
+        self.db_config.assert_unprotected()
+        
+        start = time.time()
+        try:
+            manifest = self.db_config.restore(self.args[0])
+        except SnapshotError, e:
+            raise CommandExecutionError(self, str(e))
+        rows = sum([ t['rows'] for t in manifest['tables'] ])
+        self.log.info("Restore: %d tables %d rows %.2fs", len(manifest['tables']), rows, time.time() - start)
+        
+        if not self.cli:
+            return manifest
+        print "Restored: %d tables, %d rows in %.2fs" % (len(manifest['tables']), rows, time.time() - start)
+
+
+class UpgradeCommand(AdminSubCommand):
+    ''' Upgrade the schema of a db instance created by an older version '''
+    
+    NAME = 'upgrade'
+    USAGE = ''
+    
+    def execute(self):
+        info = self.db_config.schema_info
+        old_version = info.version
+        try:
+            steps = self.db_config.upgrade()
+        except UpgradeError, e:
+            raise CommandExecutionError(self, str(e))
+        
+        if not self.cli:
+            return steps
+        if steps:
+            print "Upgraded: %02X -> %02X" % (old_version, info.version)
+        else:
+            print "Up to date: %02X" % info.version
+
+
+class StartupBenchCommand(AdminSubCommand):
+    ''' Time the startup of a new dino process: python, sqlalchemy/elixir 
+    imports, dino.config, dino.db (entity setup and mapper compile) and 
+    dino.cmd. Reports the best and the mean of <runs> runs '''
+    
+    NAME = 'startup-bench'
+    USAGE = '[ -n <runs> ]'
+    OPTIONS = ( 
+        Option('-n', '--runs', type="int", dest='runs', default=5), 
+    )
+    
+    # Run by a new interpreter, this one has imported everything already.
+    # Prints "<stage> <seconds>" as each stage completes
+    SCRIPT = """
+import sys, time
+start = time.time()
+def stage(name):
+    global start
+    now = time.time()
+    print "%s %f" % (name, now - start)
+    start = now
+import sqlalchemy, sqlalchemy.orm, elixir
+stage('sqlalchemy')
+import dino.config
+stage('config')
+import dino.db
+stage('schema')
+import dino.cmd
+stage('commands')
+"""
+    STAGES = ('python', 'sqlalchemy', 'config', 'schema', 'commands', 'total')
+    
+    def validate(self):
+        if self.option.runs < 1:
+            raise CommandArgumentError(self, "Runs must be positive: %s" % self.option.runs)
+        
+    def execute(self):
+        runs = [ self.run_once() for i in xrange(self.option.runs) ]
+        
+        print "%-12s %8s %8s" % ("stage", "best", "mean")
+        for name in self.STAGES:
+            times = [ r[name] for r in runs ]
+            print "%-12s %8.3f %8.3f" % (name, min(times), sum(times) / len(times))
+    
+    def run_once(self):
+        """ { stage : seconds } of one new process """
+        env = dict(os.environ)
+        src_dir = os.path.dirname(os.path.dirname(os.path.abspath(dino.__file__)))
+        env['PYTHONPATH'] = os.pathsep.join([ src_dir ] + [ p for p in env.get('PYTHONPATH', '').split(os.pathsep) if p ])
+        
+        start = time.time()
+        p = subprocess.Popen([ sys.executable, '-c', self.SCRIPT ], env=env,
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        (out, err) = p.communicate()
+        total = time.time() - start
+        if p.returncode != 0:
+            raise CommandExecutionError(self, "Startup failed:\n%s" % err)
+        
+        result = dict([ (name, float(secs)) for (name, secs) in [ line.split() for line in out.splitlines() ] ])
+        result['total'] = total
+        result['python'] = total - sum([ result[name] for name in self.STAGES[1:-1] ])
+        return result
+    
+
 class ListLoggersCommand(AdminSubCommand):
     ''' Throw and Exception: used for testing'''
     
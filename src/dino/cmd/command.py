@@ -4,7 +4,7 @@ from optparse import OptionParser
 from dino.cmd.exception import *
 
 __all__ = [ 
-    'AbstractCommandInterface', 'CommandMeta',  
+    'AbstractCommandInterface', 'CommandMeta', 'LazyCommand', 
     'with_session', 'with_connection' 
 ]
 
@@ -40,6 +40,29 @@ class AbstractCommandInterface(object):
         '''print multi-line help about the command'''
 
 
+class LazyCommand(object):
+    ''' Registry entry for a command whose module has not been imported.
+    Has the NAME, GROUP and USAGE of the command class, which replaces it 
+    when the module is imported (see CommandMeta.register) '''
+    
+    def __init__(self, module, name, group, usage):
+        self.module = module
+        self.NAME = name
+        self.GROUP = group
+        self.USAGE = usage
+        
+    def names(self):
+        if isinstance(self.NAME, (list, tuple)):
+            return self.NAME
+        return (self.NAME,)
+        
+    def load(self):
+        __import__(self.module)
+        
+    def __repr__(self):
+        return "LazyCommand(%s, %r)" % (self.module, self.NAME)
+
+
 class CommandMeta(type): 
     def __init__(cls, name, bases, dict_):
         super(CommandMeta, cls).__init__(name, bases, dict_) 
@@ -54,6 +77,7 @@ class CommandMeta(type):
         if not issubclass( base_class_type, CommandMeta ): 
             cls.COMMANDS = {}
             cls.GROUPS = {}      
+            cls.REGISTRY = []
         
         if not hasattr(cls,'NAME'):
             raise CommandDefinitionError("CommandMeta Instance has no NAME attribute: %s" % name)
@@ -64,15 +88,20 @@ class CommandMeta(type):
             return 
             
         if isinstance(cls.NAME, (list, tuple)):
-            for name in cls.NAME:
-                cls.COMMANDS[name] = cls
+            names = cls.NAME
         else:        
-            cls.COMMANDS[cls.NAME] = cls
+            names = (cls.NAME,)
+        for name in names:
+            cls.COMMANDS[name] = cls
         
-        if hasattr(cls, 'GROUP'):
-            cls.GROUPS.setdefault(cls.GROUP, []).append(cls)
+        # Take the place of the registered LazyCommand, if any
+        group = cls.GROUPS.setdefault(getattr(cls, 'GROUP', 'other'), [])
+        for (i, c) in enumerate(group):
+            if isinstance(c, LazyCommand) and names[0] in c.names():
+                group[i] = cls
+                break
         else:
-            cls.GROUPS.setdefault('other', []).append(cls)
+            group.append(cls)
 
         cls.parser = OptionParser()        
         if hasattr(cls, 'OPTIONS'):
@@ -82,6 +111,28 @@ class CommandMeta(type):
                 cls.parser.add_option(opt)
 
        
+    #
+    # Lazy Registration
+    #
+    def register(cls, module, name, group='other', usage=""):
+        ''' Register a command without importing its module. The module is
+        imported when the command is first looked up by find_command() '''
+        entry = LazyCommand(module, name, group, usage)
+        cls.REGISTRY.append(entry)
+        
+        # Already imported
+        if entry.names()[0] in cls.COMMANDS:
+            return
+        
+        for name in entry.names():
+            cls.COMMANDS[name] = entry
+        cls.GROUPS.setdefault(group, []).append(entry)
+        
+    def load_commands(cls):
+        ''' Import the modules of all registered commands '''
+        for entry in cls.REGISTRY:
+            entry.load()
+       
     #
     # Find/Get All Commands
     #
@@ -90,10 +141,13 @@ class CommandMeta(type):
  
     def find_command(cls, key):
         ''' Find a command, return None if not found'''
-        if cls.COMMANDS.has_key(key):
-            return cls.COMMANDS[key]
-        else:
-            return None
+        cmd = cls.COMMANDS.get(key)
+        if isinstance(cmd, LazyCommand):
+            cmd.load()
+            cmd = cls.COMMANDS[key]
+            if isinstance(cmd, LazyCommand):
+                raise CommandDefinitionError("Module %s does not define command: %s" % (cmd.module, key))
+        return cmd
              
     def get_command(cls, key):
         ''' Find a command, raise exception if not found'''
@@ -103,6 +157,7 @@ class CommandMeta(type):
         return cmd
 
     def commands(cls):
+        cls.load_commands()
         return cls.COMMANDS.values()
         
 
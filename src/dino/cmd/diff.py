@@ -0,0 +1,56 @@
+from optparse import Option
+
+from dino.cmd.command import with_session
+from dino.cmd.maincmd import MainCommand
+from dino.cmd.exception import *
+
+from dino.db import UnknownEntityError
+
+
+class DiffCommand(MainCommand):
+    ''' Show the Elements added (+), deleted (-) and modified (~) between two ChangeSets
+
+    -c --columns
+        Also print the old and new value of each modified column
+    '''
+
+    NAME = "diff"
+    USAGE = "<changeset> <changeset> [ <EntityName> ... ]"
+    GROUP = "query"
+    OPTIONS = (
+        Option('-c', '--columns', dest='columns', action='store_true', default=False),
+    )
+
+    def validate(self):
+        if len(self.args) < 2:
+            raise CommandArgumentError(self, "Must specify two changesets")
+
+        try:
+            self.changesets = [ int(arg) for arg in self.args[0:2] ]
+        except ValueError, e:
+            raise CommandArgumentError(self, "Changeset must be a number: %s" % e)
+
+    @with_session
+    def execute(self, session):
+        entities = None
+        if len(self.args) > 2:
+            try:
+                entities = [ session.resolve_entity(name) for name in self.args[2:] ]
+            except UnknownEntityError, e:
+                raise CommandArgumentError(self, str(e))
+
+            for entity in entities:
+                if not hasattr(entity, 'Revision'):
+                    raise CommandArgumentError(self, "Entity has no revisions: %s" % entity.__name__)
+
+        changes = session.diff_changesets(self.changesets[0], self.changesets[1], entities)
+
+        if not self.cli:
+            return [ str(change) for change in changes ]
+
+        # Print as each change is found, the diff may be large
+        for change in changes:
+            print str(change)
+            if self.option.columns:
+                for (column, old, new) in change.changed_columns():
+                    print "    %s: %s -> %s" % (column, old, new)
@@ -1,23 +1,73 @@
+import time
+import traceback
 from optparse import Option
 
+try:
+    import multiprocessing
+except ImportError:
+    # python < 2.6: no -j
+    multiprocessing = None
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
 from dino.cmd.maincmd import MainCommand
 from dino.cmd.exception import *
 
 from dino.generators.base import Generator, NoSuchGeneratorError, GeneratorException
+from dino.generators.profile import GeneratorProfile, format_report
 
 from dino.db import DbConfig, DbConfigError
 
 class GenerateCommand(MainCommand):
-    ''' Run Generator(s) for various services '''
+    ''' Run Generator(s) for various services 
+    
+    -f --full
+        Regenerate everything, even for generators that can run incrementally
+        from the changes since their last run, and activate everything, even
+        if nothing changed since the last activate (eg. to re-push to a 
+        rebuilt target: -a -f)
+        
+    -j --jobs <N>
+        Run up to N generators at once, each in its own process with its own
+        database connection. Activation starts only after every generator
+        has generated successfully.
+        
+    -p --profile
+        Time the phases of each generator (query, render, write, activate, 
+        ...) and count their SQL statements, print the report at the end
+        
+    --profile-json <file>
+        Also write the report to file as JSON (implies -p)
+        
+    --cprofile <phase>
+        Run that phase of each generator under cProfile (implies -p). The
+        stats are written to <generator>.<phase>.prof in the generate workdir
+    '''
     NAME = ("generate", "gen")
-    USAGE = "{ -l | [ <generator> [ <generator> ] ... ] [ -g | -a ] }"
+    USAGE = "{ -l | [ <generator> [ <generator> ] ... ] [ -g | -a ] [ -f ] [ -j <N> ] [ -p ] [ --profile-json <file> ] [ --cprofile <phase> ] }"
     GROUP = "data"
     
     OPTIONS = ( 
         Option('-g', dest='generate', action='store_true', default=False), 
         Option('-a', dest='activate', action='store_true', default=False), 
         Option('-l', dest='list', action='store_true', default=False), 
+        Option('-f', '--full', dest='full', action='store_true', default=False), 
+        Option('-j', '--jobs', dest='jobs', type='int', default=1), 
+        Option('-p', '--profile', dest='profile', action='store_true', default=False), 
+        Option('--profile-json', dest='profile_json', default=None), 
+        Option('--cprofile', dest='cprofile', default=None), 
     )
+    
+    def validate(self):
+        if self.option.jobs < 1:
+            raise CommandArgumentError(self, "Jobs must be at least 1: %d" % self.option.jobs)
+        if self.option.jobs > 1 and multiprocessing is None:
+            raise CommandArgumentError(self, "Running generators in parallel (-j) requires python 2.6")
+        if self.option.profile_json or self.option.cprofile:
+            self.option.profile = True
         
     @classmethod
     def print_help(cls, args=None):
@@ -53,20 +103,15 @@ class GenerateCommand(MainCommand):
             gen_list = [ c(gen_db_config) for c in classes ] 
             
             for gen in gen_list:
+                gen.full = self.option.full
                 gen.parse(self.args)
+                if self.option.profile:
+                    gen.profile = self.create_profile(gen)
                 
-            if self.option.generate:
-                for gen in gen_list:
-                    gen.generate()
+            if self.option.generate or not self.option.activate:
+                self.generate_all(gen_list, gen_db_config)
                     
-            elif self.option.activate:
-                for gen in gen_list:
-                    gen.activate()
-                                    
-            else:
-                for gen in gen_list:
-                    gen.generate()
-                
+            if not self.option.generate:
                 for gen in gen_list:
                     gen.activate()
         
@@ -74,4 +119,109 @@ class GenerateCommand(MainCommand):
             raise CommandArgumentError(self, str(e))
 
         except GeneratorException, e:
-            raise CommandExecutionError(self, e)
\ No newline at end of file
+            raise CommandExecutionError(self, e)
+        
+        if self.option.profile:
+            return self.profile_report(gen_list)
+        
+    #
+    # Profiling
+    #
+    def create_profile(self, gen):
+        return GeneratorProfile(gen.NAME, self.option.cprofile, gen.settings.workdir)
+    
+    def profile_report(self, gen_list):
+        """ Print the report (return it without a cli), and write the JSON 
+        with --profile-json """
+        reports = dict([ (gen.NAME, gen.profile.report()) for gen in gen_list ])
+        
+        if self.option.profile_json:
+            f = open(self.option.profile_json, 'w')
+            try:
+                json.dump(reports, f, indent=2, sort_keys=True)
+            finally:
+                f.close()
+        
+        for gen in gen_list:
+            if gen.profile.cprofile_file:
+                self.log.info("cProfile stats: %s", gen.profile.cprofile_file)
+        
+        if not self.cli:
+            return reports
+        
+        for line in format_report(reports):
+            print line
+
+    def generate_all(self, gen_list, db_config):
+        """ Run generate() of every generator, in a process pool when -j > 1.
+        Raises CommandExecutionError after all have finished if any failed. """
+        if self.option.jobs > 1 and len(gen_list) > 1:
+            tasks = [ (gen.__class__, db_config.options, gen.full, self.args, gen.profile is not None and self.option.cprofile) 
+                      for gen in gen_list ]
+            pool = multiprocessing.Pool(processes=min(self.option.jobs, len(gen_list)))
+            try:
+                results = pool.map(_generate_worker, tasks)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [ run_generate(gen) for gen in gen_list ]
+        
+        failed = []
+        for (gen, (name, elapsed, error, report)) in zip(gen_list, results):
+            # the generate phases of a pool process
+            if report is not None and gen.profile is not None and not gen.profile.phases:
+                gen.profile.update(report)
+                
+            if error is None:
+                self.log.info("generate %s: %.2fs", name, elapsed)
+            else:
+                self.log.error("generate %s: FAILED after %.2fs\n%s", name, elapsed, error)
+                failed.append(name)
+        
+        if failed:
+            raise CommandExecutionError(self, "Generate failed for: %s (nothing activated)" % ", ".join(failed))
+        
+        return results
+
+
+def run_generate(gen):
+    """ (name, seconds, error, report) of one generate() run, error is the
+    formatted traceback or None, report the profile report or None """
+    if gen.profile is not None:
+        gen.profile.attach(gen.db_config.engine)
+        # until the generator starts its first phase
+        gen.phase('generate')
+        
+    start = time.time()
+    try:
+        gen.generate()
+        error = None
+    except Exception, e:
+        error = traceback.format_exc()
+    elapsed = time.time() - start
+    
+    report = None
+    if gen.profile is not None:
+        gen.profile.stop()
+        gen.profile.detach()
+        report = gen.profile.report()
+    return (gen.NAME, elapsed, error, report)
+        
+
+def _generate_worker(task):
+    """ Pool process entry point. The generator gets its own DbConfig, created
+    with the options of the parent's: connections can't be shared with the 
+    parent process """ 
+    (gen_cls, db_options, full, args, cprofile) = task
+    try:
+        gen = gen_cls(DbConfig(**db_options))
+        gen.full = full
+        gen.parse(args)
+        # False: not profiled, None: profiled without cProfile
+        if cprofile is not False:
+            gen.profile = GeneratorProfile(gen.NAME, cprofile, gen.settings.workdir)
+    except Exception, e:
+        return (gen_cls.NAME, 0.0, traceback.format_exc(), None)
+    
+    return run_generate(gen)
@@ -77,20 +77,14 @@ class AvailCommand(IpSubCommand):
         subnet = session.find_element(self.oname)
         
         if not subnet:
-            raise CommandExecutionError(self, "Subnet not found: %s" % subnet_name)
-            sys.exit(1)
+            raise CommandExecutionError(self, "Subnet not found: %s" % self.oname)
         
         self.log.fine("Found: %s", subnet)
         
-        ip_list = list(subnet.avail_ip_set())
-        ip_list.sort()
-        ip_list = map(IpType.ntoa, ip_list)
+        ip_list = map(IpType.ntoa, subnet.avail_ips(self.count))
                         
         if len(ip_list) < self.count:
             raise CommandExecutionError(self, "Requested count of addresses not available: %s" % self.count)
-
-        if len(ip_list) > self.count:    
-            ip_list = ip_list[0:self.count]
             
         if self.cli is None:
             return ip_list
@@ -1,4 +1,7 @@
 
+import sys
+from optparse import Option
+
 from dino.cmd.command import with_session
 from dino.cmd.maincmd import MainCommand
 from dino.cmd.exception import *
@@ -7,13 +10,24 @@ from dino.db.objectspec import *
 
 class JsonExportCommand(MainCommand):
 
-    '''Query repository for a complete server description.'''
+    '''Query repository for a complete server description.
+    With --all, every Host (of a site, or of a Host ElementQuery) is 
+    written as one json object per line.'''
 
     NAME = "jsonexport"
-    USAGE = "<object> Host/<InstanceName>"
+    USAGE = "<object> Host/<InstanceName> | -a [ -s <site> ] [ -o <file> ] [ Host[<QueryClause>] ]"
     GROUP = "data"
+    OPTIONS = (
+        Option('-a', '--all', dest='all', action='store_true', default=False),
+        Option('-s', '--site', dest='site', default=None),
+        Option('-o', '--output', dest='output', default=None),
+    )
 
     def validate(self):
+        if self.option.all:
+            if len(self.args) > 1:
+                raise CommandArgumentError(self, 'You can specify ONLY ONE ElementQuery.\n')
+            return
         if len(self.args) < 1:
             raise CommandArgumentError(self, 'Please specify a server in fqdn format.\n')
         if len(self.args) >= 2: 
@@ -21,6 +35,8 @@ class JsonExportCommand(MainCommand):
 
     @with_session 
     def execute(self, session):
+        if self.option.all:
+            return self._export_all(session)
              
         name = self.args[0].split('.')
         if len(name) != 3: 
@@ -40,6 +56,35 @@ class JsonExportCommand(MainCommand):
         if self.cli is None:
             return json
     
-        print json        
-        
-    
+        print json
+
+
+    def _export_all(self, session):
+        host_ids = None
+        if self.args:
+            oquery = ObjectSpec.parse(self.args[0], expected=ElementQuery)
+            if oquery is None or oquery.entity_name != "Host":
+                raise CommandArgumentError(self, "Not an ElementQuery of Hosts: %s" % self.args[0])
+            host_ids = [ id for (id,) in oquery.create_query(session, Host).values(Host.id) ]
+
+        exporter = JsonExporter(session.connection())
+        hosts = exporter.iter_hosts(site=self.option.site, host_ids=host_ids)
+
+        if self.cli is None and self.option.output is None:
+            return [ json.dumps(data) for data in hosts ]
+
+        # One line per host, as it is read
+        if self.option.output is not None:
+            out = open(self.option.output, 'w')
+        else:
+            out = sys.stdout
+        count = 0
+        try:
+            for data in hosts:
+                out.write(json.dumps(data))
+                out.write("\n")
+                count += 1
+        finally:
+            if out is not sys.stdout:
+                out.close()
+        self.log.info("Exported %d hosts", count)
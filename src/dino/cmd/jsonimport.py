@@ -1,9 +1,16 @@
 #!/usr/bin/env python
 
 import os
+import time
 import logging
 from optparse import Option
 
+try:
+    import multiprocessing
+except ImportError:
+    # python < 2.6: no -j
+    multiprocessing = None
+
 from dino.cmd.command import with_session
 from dino.cmd.maincmd import MainCommand 
 from dino.cmd.jsonutil import *
@@ -15,22 +22,49 @@ class JsonImportCommand(MainCommand):
     Add a complete device description from a json file.
     If path is a directory, process all files in that 
     directory.  Directories are not processed recursively. 
+
+    With --bulk, all files are parsed and checked first, in jobs
+    processes. Then, in one session, the elements they name are looked
+    up together and batch-size files go in each changeset.
+    
+    With --check, the files are only validated: their references are
+    looked up in an index of names, without a session, and a json report
+    of the errors of every file is printed.
     '''
     
     NAME =      'jsonimport'
-    USAGE =     '<file|dir> [ , <file|dir> ] ... ]'  
+    USAGE =     '[ -c | -b [ -s <batch_size> ] ] [ -j <jobs> ] <file|dir> [ , <file|dir> ] ... ]'  
     GROUP =     'data'  
     OPTIONS = ( 
         Option( '-n', '--no-submit', action='store_false', dest='submit', default=True),
+        Option( '-b', '--bulk', dest='bulk', action='store_true', default=False), 
+        Option( '-s', '--batch-size', type="int", dest='batch_size', default=50), 
+        Option( '-j', '--jobs', type="int", dest='jobs', default=1), 
+        Option( '-c', '--check', dest='check', action='store_true', default=False), 
     )        
     
+    # Files handed to a parse process at a time
+    PARSE_CHUNK_SIZE = 16
+    
     def validate(self):
         if len(self.args) < 1:
             raise CommandArgumentError(self, "Must specify a file/dir to add")
+        if self.option.batch_size < 1:
+            raise CommandArgumentError(self, "Batch size must be positive: %s" % self.option.batch_size)
+        if self.option.jobs > 1 and multiprocessing is None:
+            raise CommandArgumentError(self, "Parsing in parallel (-j) requires python 2.6")
         
     
+    def execute(self):  
+        if self.option.check:
+            return self._execute_check()
+        if self.option.bulk:
+            return self._execute_bulk()
+        return self._execute_files()
+    
+    
     @with_session
-    def execute(self, session):  
+    def _execute_files(self, session):
         proc = JsonProcessor(session)
     
         for path in self.arg_iterator():        
@@ -48,6 +82,103 @@ class JsonImportCommand(MainCommand):
                 self.log.info("Not submitting")
 
 
+    def _execute_bulk(self):
+        start = time.time()
+        
+        parsed = self.parse_all(list(self.arg_iterator()))
+        self.log.info("Parsed %d files in %.2fs", len(parsed), time.time() - start)
+        
+        failed = [ (path, errors) for (path, data, errors) in parsed if errors ]
+        if failed:
+            for (path, errors) in failed:
+                for e in errors:
+                    self.log.warn("%s: %s", path, e)
+            raise CommandExecutionError(self, "Critical errors were found in %d of %d files. Please see the log for details." 
+                                        % (len(failed), len(parsed)))
+        
+        # The session is only open for the write
+        data_list = [ data for (path, data, errors) in parsed ]
+        session = self.db_config.session()
+        try:
+            self._write_bulk(session, data_list)
+        finally:
+            session.close()
+
+        elapsed = time.time() - start
+        rate = elapsed and len(data_list) / elapsed or 0.0
+        self.log.info("Imported %d files in %.2fs (%.1f files/sec)", len(data_list), elapsed, rate)
+        
+        if not self.cli:
+            return (len(data_list), elapsed)
+        print "Imported %d files in %.2fs (%.1f files/sec)" % (len(data_list), elapsed, rate)
+
+
+    def _execute_check(self):
+        start = time.time()
+        
+        parsed = self.parse_all(list(self.arg_iterator()))
+        
+        connection = self.db_config.connection()
+        try:
+            index = NameIndex().load(connection)
+        finally:
+            connection.close()
+        
+        validator = JsonValidator(index)
+        failed = []
+        for (path, data, errors) in parsed:
+            if data is not None:
+                try:
+                    errors = errors + validator.validate(data)
+                except Exception, e:
+                    errors = errors + [ "%s: %s" % (e.__class__.__name__, e) ]
+            if errors:
+                failed.append({ 'file' : path, 'errors' : errors })
+        
+        report = { 'files' : len(parsed), 
+                   'failed' : len(failed), 
+                   'seconds' : round(time.time() - start, 3), 
+                   'errors' : failed }
+        self.log.info("Checked %d files in %.2fs: %d failed", report['files'], report['seconds'], report['failed'])
+        
+        if not self.cli:
+            return report
+        print json.dumps(report, indent=4)
+        if failed:
+            raise CommandExecutionError(self, "%d of %d files failed validation" % (len(failed), len(parsed)))
+
+
+    def parse_all(self, paths):
+        ''' parse_file() of every path, in a process pool when -j > 1. '''
+        if self.option.jobs > 1 and len(paths) > 1:
+            pool = multiprocessing.Pool(processes=min(self.option.jobs, len(paths)))
+            try:
+                return pool.map(parse_file, paths, self.PARSE_CHUNK_SIZE)
+            finally:
+                pool.close()
+                pool.join()
+        return [ parse_file(path) for path in paths ]
+
+
+    def _write_bulk(self, session, data_list):
+        proc = JsonProcessor(session)
+        proc.prefetch(data_list)
+        
+        batch_size = self.option.batch_size
+        for i in xrange(0, len(data_list), batch_size):
+            session.open_changeset()
+            for data in data_list[i:i + batch_size]:
+                proc.apply(data, check=False)
+                
+            if self.option.submit:
+                cs = session.submit_changeset()        
+                self.log.info("Committed Changeset: %s (%d files)", cs, len(data_list[i:i + batch_size]))
+            else:
+                session.revert_changeset()
+                proc.discard_created()
+                self.log.info("Not submitting")
+
+
     def arg_iterator(self):
         for path in self.args:
             if not os.path.exists(path):
@@ -5,12 +5,13 @@ except ImportError:
     import simplejson as json
 
 import sqlalchemy
-from sqlalchemy import and_
+from sqlalchemy import and_, select
 
 from dino.cmd.exception import *
 from dino.cmd.ip import IpCommand
 from dino.db.schema import * 
 from dino.db.objectspec import *
+from dino.db.model import PrefixIndex
 
 import pprint; pp = pprint.PrettyPrinter(indent=4)
 
@@ -59,11 +60,26 @@ class JsonProcessor(object):
 
     log = logging.getLogger("dino.cmd.json.processor")
 
+    # Keys of an element dict that name another element (resolved by verify())
+    REFERENCE_KEYS = ('rack', 'chassis', 'console', 'switch', 'pod', 'appliance', 'subnet')
+    
+    # Max number of names in a single IN (...) clause
+    QUERY_CHUNK_SIZE = 500
+
     def __init__(self, session):
         self.session = session
+        
+        # ElementName -> instance (or None), filled by prefetch()
+        self.known = None
+        # ElementNames created by apply() since the last discard_created()
+        self.created = []
 
 
     def host_to_json(self, host):  
+        return json.dumps(self.host_to_dict(host), indent=4)
+
+
+    def host_to_dict(self, host):  
 
         hname = str(host.instance_name).split('.')
 
@@ -127,21 +143,48 @@ class JsonProcessor(object):
                     data[ip]['value'] = b
         
         #data = verify(self.session, data)    
-        return json.dumps(data, indent=4)
+        return data
     
 
     def process(self, filepath):  
+        return self.apply(self.load(filepath))
+    
 
-        elements = ['Device/', 'Host/', 'Port/', 'Interface/', 'IpAddress/'] 
+    def load(self, filepath):
+        ''' Read a json file, as a v2 struct '''
+        
         self.log.info("Read file: %s", filepath)
         data = json.load(open(filepath)) 
-        # asserts new format, then verifies.
             
         # if no header, assume v1 format.
         if not data.has_key('Header'): 
             data = self.v1_transform(data)
-            
-        data = self.verify(data)    
+        
+        return data
+    
+
+    def parse(self, filepath):
+        ''' load() and the checks of verify() that need no database: (data, errors).
+        Without a session, the v1 lookups are left to apply(). '''
+        
+        data = self.load(filepath)
+        
+        errors = []
+        if data['Header'].get('type') == 'server':
+            errors = self.check_server(data)
+        elif data['Header'].get('type') == 'special':
+            errors = self.check_special(data)
+        return (data, errors)
+    
+
+    def apply(self, data, check=True):
+        ''' Verify a v2 struct, then add or update its elements.
+        check=False skips the checks parse() has made. '''
+
+        elements = ['Device/', 'Host/', 'Port/', 'Interface/', 'IpAddress/'] 
+        if data.has_key('Header'):
+            self.resolve_deferred(data)
+        data = self.verify(data, check)    
     
         #pp.pprint(data)
 
@@ -149,13 +192,16 @@ class JsonProcessor(object):
         self.instances = {}
         
         for spec in data.keys():
-            instance = is_known(self.session, spec)
+            instance = self.find(spec)
             
             if instance is None:
                 self.log.info("  Adding new %s" % spec) 
                 oname = ObjectSpec.parse(spec, expected=ElementName)
                 instance = self.session.resolve_entity(oname.entity_name).create_empty()
                 self.session.add(instance)
+                if self.known is not None:
+                    self.known[spec] = instance
+                    self.created.append(spec)
             else:
                 self.log.info("  Updating %s" % spec)
 
@@ -191,6 +237,76 @@ class JsonProcessor(object):
                 data[spec] = instance 
     
             
+    # # # # # # # # # # # # # #
+    # element lookup
+    # # # # # # # # # # # # # #
+
+    def find(self, spec):
+        ''' The element named by spec, from the prefetched names if it is one of them '''
+        if self.known is not None and self.known.has_key(spec):
+            return self.known[spec]
+        return is_known(self.session, spec)
+
+
+    def prefetch(self, data_list):
+        '''
+        Resolve every ElementName in a list of v2 structs: the element keys,
+        the names in REFERENCE_KEYS and the Hosts of deferred device lookups.
+        One IN (...) query per entity
+        (per QUERY_CHUNK_SIZE names), instead of one query per name.
+        '''
+        
+        # entity -> { instance_name : ElementName }
+        names = {}
+        for data in data_list:
+            for spec, edict in data.items():
+                if spec == 'Header':
+                    # the Hosts of the deferred device lookups
+                    refs = [ arg for (s, k, kind, arg) in edict.get('deferred', []) if kind == 'device' ]
+                else:
+                    refs = [ spec ] + [ edict.get(key) for key in self.REFERENCE_KEYS ]
+                for name in refs:
+                    if not isinstance(name, basestring) or '/' not in name:
+                        continue
+                    oname = ObjectSpec.parse(name, expected=ElementName)
+                    entity = self.session.resolve_entity(oname.entity_name)
+                    names.setdefault(entity, {})[oname.instance_name] = name
+
+        if self.known is None:
+            self.known = {}
+            
+        for entity, specs in names.items():
+            for name in specs.values():
+                self.known.setdefault(name, None)
+            
+            instance_names = specs.keys()
+            for i in xrange(0, len(instance_names), self.QUERY_CHUNK_SIZE):
+                chunk = instance_names[i:i + self.QUERY_CHUNK_SIZE]
+                inexact = False
+                for element in self.session.query(entity).filter(entity._instance_name.in_(chunk)):
+                    if element.instance_name in specs:
+                        self.known[specs[element.instance_name]] = element
+                    else:
+                        inexact = True
+
+                # The database collation may match names that differ in case or
+                # trailing spaces (MySQL does): the names of this chunk that were
+                # not matched exactly are left to is_known()
+                if inexact:
+                    for iname in chunk:
+                        if self.known[specs[iname]] is None:
+                            del self.known[specs[iname]]
+
+        self.log.info("Prefetched %d elements of %d entities", len(self.known), len(names))
+
+
+    def discard_created(self):
+        ''' Forget the elements created since the last call, after their changeset was reverted '''
+        for spec in self.created:
+            self.known[spec] = None
+        self.created = []
+
+
     # # # # # # # # # # # # # #
     # local methods
     # # # # # # # # # # # # # #
@@ -256,19 +372,21 @@ class JsonProcessor(object):
                    
     
     
-    def verify(self, data):
+    def verify(self, data, check=True):
         '''
         Look in v2 header for clues about what operation we're performing, 
         e.g. a full server insertion, a special device insertion, etc.
-        Run the appropriate verification for that context.
+        Run the appropriate verification for that context: the checks
+        of check_<type>() (skipped with check=False, when parse() has
+        already run them), then the resolution of the references.
         '''
     
         if data.has_key('Header') and data['Header'].has_key('type'):
     
             if data['Header']['type'] == 'server':
-                self._verify_server(data)
+                self._verify_server(data, check)
             elif data['Header']['type'] == 'special':
-                self._verify_special(data)
+                self._verify_special(data, check)
             else: 
                 err = 'Passed in Header that has no update type.\n'
                 CommandExecutionError(self, err)
@@ -283,13 +401,31 @@ class JsonProcessor(object):
                 
     
     
-    def _verify_special(self, data):
+    def _verify_special(self, data, check=True):
+        errors = []
+        if check:
+            errors += self.check_special(data)
+        errors += self._resolve_special(data)
+       
+        # stop if there are critical errors.
+        if errors: 
+            for e in errors:
+                self.log.warn(e)
+            err = '''Critical errors were found in the validation process
+                    for special device: %s. Please see log for details.\n'''
+            raise CommandExecutionError(self, (err % 'special'))
+    
+        return(data)
+       
+        
+    def check_special(self, data):
     
         '''
-        Verify the special device data we're about to import. Special 
+        Check the special device data we're about to import. Special 
         devices include routers, switches, devices, and PDUs. Routers
         and switches often have no port or interface info, so the 
         verification process is different from a server.. 
+        Needs no database, returns a list of errors.
         '''
         
         count = { 'device':    0, 
@@ -298,7 +434,7 @@ class JsonProcessor(object):
                   'interface': 0, 
                   'addr':      0 }
     
-        critical = False
+        errors = []
     
         # clear null keys
         for e, edict in data.items():
@@ -311,96 +447,89 @@ class JsonProcessor(object):
             if e.startswith('Device/'):
                 count['device'] += 1
         
-                # Rack must be known.
-                rack = is_known(self.session, edict['rack'])
-                if not rack: 
-                    critical = True 
-                    self.log.warn('Rack: %s does not exist.\n' % edict['rack'])
-                data[e]['rack'] = rack
-    
-                # Chassis must be known.
-                chassis = is_known(self.session, edict['chassis'])
-                if not chassis: 
-                    critical = True 
-                    self.log.warn('Chassis: %s does not exist.\n'
-                                  % edict['chassis'])
-                data[e]['chassis'] = chassis
-    
             if e.startswith('Host/'):
                 count['host'] += 1
     
-                # Pod must be known.
-                pod = is_known(self.session, edict['pod'])
-                if not pod: 
-                    critical = True 
-                    self.log.warn('Pod: %s does not exist.\n' % edict['pod'])
-                data[e]['pod'] = pod
-    
-    
             # unnamed ethernet ports are lo0, by convention.
             # (ports on consoles and PDUs are unnamed.)
             if e.startswith('Port/'):
                 count['port'] += 1
                 if not data[e]['name'] == 'lo0':
-                    critical = True
-                    self.log.warn('Port: %s should be named lo0' 
-                                  % edict['name'])
+                    errors.append('Port: %s should be named lo0' % edict['name'])
     
             if e.startswith('Interface/'):
                 count['interface'] += 1
     
             if e.startswith('IpAddress/'):
-                subnet = is_known(self.session, edict['subnet'])
-                if not subnet: 
-                    critical = True 
-                    self.log.warn('Subnet: %s does not exist.\n'
-                                   % edict['subnet'])
-                data[e]['subnet'] = subnet
                 count['addr'] += 1
     
-    
         # sanity check element counts
         if not count['device'] == 1: 
-            critical = True
-            self.log.warn('Data should contain 1 device, not %s.\n' 
-                          % count['device'])
+            errors.append('Data should contain 1 device, not %s.' % count['device'])
         if not count['host'] == 1:
-            critical = True
-            self.log.warn('Data should contain 1 host, not %s.\n' 
-                          % count['host'])
+            errors.append('Data should contain 1 host, not %s.' % count['host'])
         #if not count['interface'] == 1:
-        #    critical = True
-        #    self.log.warn('Data should contain 1 interface, not %s.\n' 
-        #                  % (count['interface']))
+        #    errors.append('Data should contain 1 interface, not %s.' % (count['interface']))
         #if not count['addr'] == count['interface']:
-        #    self.log.warn('Data should have 1 address per interface. \
-        #                   Ifaces: %s, Addrs: %s\n'
+        #    errors.append('Data should have 1 address per interface. Ifaces: %s, Addrs: %s'
         #                  % (count['interface'], count['addr']))
-        #    critical = True
-       
-        # stop if there are critical errors.
-        if critical: 
-            err = '''Critical errors were found in the validation process
-                    for special device: %s. Please see log for details.\n'''
-            raise CommandExecutionError(self, (err % 'special'))
     
-        return(data)
-       
+        return errors
+    
+    
+    def _resolve_special(self, data):
+        ''' Replace the rack, chassis, pod and subnet names with their elements '''
         
-           
-    def _verify_server(self, data):
+        errors = []
+        for e, edict in data.items():
+    
+            if e.startswith('Device/'):
+                # Rack and Chassis must be known.
+                self._resolve(edict, 'rack', 'Rack', errors)
+                self._resolve(edict, 'chassis', 'Chassis', errors)
     
+            if e.startswith('Host/'):
+                # Pod must be known.
+                self._resolve(edict, 'pod', 'Pod', errors)
+    
+            if e.startswith('IpAddress/'):
+                self._resolve(edict, 'subnet', 'Subnet', errors)
+                
+        return errors
+           
+           
+    def _verify_server(self, data, check=True):
     
         '''
         Verify the server data we're about to import.  Prepare it for 
-        the ORM import process.  If critical errors are found, populate 
-        an abort function with messages.
+        the ORM import process.  If critical errors are found, log them
+        and raise.
     
         NOTE: when an object in the cache is checked for its existence in 
               dino, we then cache the object at the point where the instance
               name used to be. This expedites the import process later on.
         '''
     
+        errors = []
+        if check:
+            errors += self.check_server(data)
+        errors += self._resolve_server(data)
+            
+        # stop if there are critical errors.
+        if errors: 
+            for e in errors:
+                self.log.warn(e)
+            err = '''Critical errors were found in the validation process. 
+                            Please see the log for details.\n'''
+            raise CommandExecutionError(self, err)
+    
+        return(data)
+            
+            
+    def check_server(self, data):
+        ''' The element counts and port flags of server data. 
+        Needs no database, returns a list of errors. '''
+    
         count = { 'device':    0, 
                   'host':      0, 
                   'port':      0, 
@@ -410,74 +539,15 @@ class JsonProcessor(object):
                   'ipmi':      0, 
                   'bport':     0 }
     
-        critical = False
-    
-        # clear null keys
-#        for e, edict in data.items():
-#            for key, val in edict.items():
-#                if not val or val == "None":
-#                    edict.pop(key)
+        errors = []
     
         for e, edict in data.items():
     
             if e.startswith('Device/'):
                 count['device'] += 1
     
-                # Rack must be known.
-                rack = is_known(self.session, edict['rack'])
-                if not rack: 
-                    critical = True 
-                    self.log.warn('Rack: %s does not exist.\n' % edict['rack'])
-                data[e]['rack'] = rack
-    
-                # Chassis must be known.
-                chassis = is_known(self.session, edict['chassis'])
-                if not chassis: 
-                    critical = True 
-                    self.log.warn('Chassis: %s does not exist.\n'
-                                   % edict['chassis'])
-                data[e]['chassis'] = chassis
-    
-                # Console must be known, if given.
-                if edict.has_key('console') and edict['console'].startswith('Device/'):
-                    # must be an instance name
-                    console = is_known(self.session, edict['console'])
-                    if not console:
-                        critical = True 
-                        (a, b) = edict['console'].split('/')
-                        self.log.warn('Console: %s does not exist.\n' % b)
-                    else: 
-                        data[e]['console'] = console
-    
-                # Switch must be known
-                data[e]['switch'] = None
-                if edict['switch']:
-                    switch = is_known(self.session, edict['switch'])
-                    if not switch:
-                        critical = True
-                        self.log.warn('Switch: %s does not exist.\n' % edict['switch'])
-                    else:
-                        data[e]['switch'] = switch
-                        
-                
-    
             if e.startswith('Host/'):
                 count['host'] += 1
-    
-                # Pod must be known.
-                pod = is_known(self.session, edict['pod'])
-                if not pod: 
-                    critical = True 
-                    self.log.warn('Pod: %s does not exist.\n' % edict['pod'])
-                data[e]['pod'] = pod
-    
-                # Appliance must be known
-                appliance = is_known(self.session, edict['appliance'])
-                if not appliance: 
-                    critical = True 
-                    self.log.warn('Appliance: %s does not exist.\n' 
-                                  % edict['appliance'])
-                data[e]['appliance'] = appliance 
        
             if e.startswith('Port/'):
                 count['port'] += 1
@@ -493,49 +563,30 @@ class JsonProcessor(object):
                 count['interface'] += 1
     
             if e.startswith('IpAddress/'):
-                subnet = is_known(self.session, edict['subnet'])
-                if not subnet: 
-                    critical = True 
-                    self.log.warn('Subnet: %s does not exist.\n'
-                                   % edict['subnet'])
-                data[e]['subnet'] = subnet
                 count['addr'] += 1
     
-    
         # sanity check element counts
         if not count['device'] == 1: 
-            critical = True
-            self.log.warn('Data should contain 1 device, not %s.\n' 
-                          % count['device'])
+            errors.append('Data should contain 1 device, not %s.' % count['device'])
         if not count['host'] == 1:
-            critical = True
-            self.log.warn('Data should contain 1 host, not %s.\n' 
-                          % count['host'])
+            errors.append('Data should contain 1 host, not %s.' % count['host'])
         if not count['port'] >= 1:
-            critical = True
-            self.log.warn('Data must contain at least 1 port.\n' 
-                          % count['port'])
+            errors.append('Data must contain at least 1 port.')
         if not count['interface'] <= count['port']:
-            critical = True
-            self.log.warn('Data contains %s interfaces, but only %s ports.\n' 
+            errors.append('Data contains %s interfaces, but only %s ports.' 
                           % (count['interface'], count['port']))
         if not count['addr'] == count['interface']:
-            self.log.warn('Data should have 1 address per interface. \
-                          Ifaces: %s, Addrs: %s\n'
+            errors.append('Data should have 1 address per interface. Ifaces: %s, Addrs: %s'
                           % (count['interface'], count['addr']))
-            critical = True
         if not count['bport'] == 1:
-            critical = True
-            self.log.warn('Data should contain 1 blessed port, not %s.\n' 
-                          % count['bport'])
+            errors.append('Data should contain 1 blessed port, not %s.' % count['bport'])
     
         # ipmi port should not be blessed port
         for e, edict in data.items():
             if e.startswith('Port/') and \
                edict.has_key('is_blessed') and edict['is_blessed'] == 1 and \
                edict.has_key('is_ipmi')    and edict['is_ipmi']    == 1:
-                critical = True
-                self.log.warn('ipmi port cannot be blessed port\n') 
+                errors.append('ipmi port cannot be blessed port') 
     
         # must have either a console port, or an ipmi port.
         for e, edict in data.items():
@@ -545,29 +596,69 @@ class JsonProcessor(object):
                 count['ipmi'] += 1
     
         if count['ipmi'] == 0 and count['console'] == 0:
-            critical = 1
-            self.log.warn('Must have either console or ipmi port.\n')
+            errors.append('Must have either console or ipmi port.')
             
-        # stop if there are critical errors.
-        if critical: 
-            err = '''Critical errors were found in the validation process. 
-                            Please see the log for details.\n'''
-            raise CommandExecutionError(self, err)
+        return errors
     
-        return(data)
+    
+    def _resolve_server(self, data):
+        ''' Replace the names of the elements a server refers to with the elements '''
+        
+        errors = []
+        for e, edict in data.items():
+    
+            if e.startswith('Device/'):
+                # Rack and Chassis must be known.
+                self._resolve(edict, 'rack', 'Rack', errors)
+                self._resolve(edict, 'chassis', 'Chassis', errors)
+    
+                # Console must be known, if given.
+                if edict.has_key('console') and edict['console'].startswith('Device/'):
+                    # must be an instance name
+                    console = self.find(edict['console'])
+                    if not console:
+                        (a, b) = edict['console'].split('/')
+                        errors.append('Console: %s does not exist.' % b)
+                    else: 
+                        data[e]['console'] = console
+    
+                # Switch must be known
+                data[e]['switch'] = None
+                if edict['switch']:
+                    self._resolve(edict, 'switch', 'Switch', errors)
+    
+            if e.startswith('Host/'):
+                # Pod and Appliance must be known.
+                self._resolve(edict, 'pod', 'Pod', errors)
+                self._resolve(edict, 'appliance', 'Appliance', errors)
+    
+            if e.startswith('IpAddress/'):
+                self._resolve(edict, 'subnet', 'Subnet', errors)
+                
+        return errors
+    
+    
+    def _resolve(self, edict, key, label, errors):
+        instance = self.find(edict[key])
+        if not instance: 
+            errors.append('%s: %s does not exist.' % (label, edict[key]))
+        edict[key] = instance
             
             
 
 
-
     def v1_transform(self, data_v1):
        
         '''
         Transform a dino 1.0 json description into a dino 2.0 json description.
+        Without a session, the lookups of the console and switch devices,
+        the subnets and the dhcp range check are listed in the Header as 
+        'deferred', for resolve_deferred().
         '''
        
         # initialize v2 struct
         data_v2 = {}
+        deferred = []
     
         # strip blank keys
         for key, val in data_v1.items():
@@ -618,23 +709,12 @@ class JsonProcessor(object):
         if data_v1.has_key('hnode.console_id'):
             tmp = data_v1['hnode.console_id'].split('.')
             console_host_spec = E[1] + '/' + '.'.join(tmp[:3])
-            console_host = is_known(self.session, console_host_spec)
-            if console_host is None: 
-                self.log.info("  Cannot find console host: %s" % console_host_spec)
-                data_v2[Device]['console'] = None
-            else:
-                data_v2[Device]['console'] = console_host.device.element_name
+            data_v2[Device]['console'] = self._reference(deferred, Device, 'console', 'device', console_host_spec)
     
         # switch
         tmp = data_v1['switch_handle'].split('.')
         switch_host_spec = E[1] + '/' + '.'.join(tmp[:3])
-        switch_host = is_known(self.session, switch_host_spec)
-        if switch_host is None:
-            self.log.info("  Cannot find console host: %s" % switch_host_spec)
-            data_v2[Device]['switch'] = None
-        else:
-            switch_device = switch_host.device
-            data_v2[Device]['switch'] = switch_device.element_name
+        data_v2[Device]['switch'] = self._reference(deferred, Device, 'switch', 'device', switch_host_spec)
     
         #
         # host keys
@@ -703,16 +783,17 @@ class JsonProcessor(object):
                 if data_v1.has_key('ip_mac.addr ' + iface):
                     ip = data_v1['ip_mac.addr ' + iface]
                     # if ip is from a range, reserve a new one. 
-                    if is_dynamic(self.session, ip):
+                    if self.session is None:
+                        deferred.append((E[4] + '/' + ip, 'value', 'dynamic', ip))
+                    elif is_dynamic(self.session, ip):
                         new_addr = get_ip(ip, iface)
                         ip = new_addr.instance_name
                     IpAddress = E[4] + '/' + ip
                     data_v2[IpAddress] = {}
                     # find my subnet
-                    subnet = find_subnet(self.session, ip)
+                    subnet = self._reference(deferred, IpAddress, 'subnet', 'subnet', ip)
                     if subnet: 
-                        data_v2[IpAddress]['subnet'] = 'Subnet/' \
-                        + subnet.instance_name
+                        data_v2[IpAddress]['subnet'] = subnet
                     data_v2[IpAddress]['interface'] = Interface
                     data_v2[IpAddress]['value'] = ip
     
@@ -720,9 +801,317 @@ class JsonProcessor(object):
     
         # add v2 header.
         data_v2['Header'] = { "version" : 2, "type": "server" }
+        if deferred:
+            data_v2['Header']['deferred'] = deferred
     
         return data_v2
     
+    
+    def _reference(self, deferred, spec, key, kind, arg):
+        ''' lookup_reference() now, or without a session, add it to deferred '''
+        if self.session is None:
+            deferred.append((spec, key, kind, arg))
+            return None
+        return self.lookup_reference(kind, arg)
+    
+    
+    def lookup_reference(self, kind, arg):
+        '''
+        The value of a v1 reference:
+          device:  ElementName of the Device of the Host named arg 
+          subnet:  ElementName of the Subnet of the address arg
+          dynamic: arg, an address that must not be in a dhcp range
+        '''
+        if kind == 'device':
+            host = self.find(arg)
+            if host is None:
+                self.log.info("  Cannot find host: %s" % arg)
+                return None
+            device = host.device
+            if self.known is not None:
+                self.known[device.element_name] = device
+            return device.element_name
+        
+        if kind == 'subnet':
+            subnet = find_subnet(self.session, arg)
+            if subnet is None:
+                return None
+            return 'Subnet/' + subnet.instance_name
+        
+        if kind == 'dynamic':
+            # get_ip() reserves another address, that changes the IpAddress
+            # name after the file was parsed
+            if is_dynamic(self.session, arg):
+                raise CommandExecutionError(self, "Address is in a dhcp range: %s" % arg)
+            return arg
+        
+        raise RuntimeError("Unknown reference kind: %s" % kind)
+    
+    
+    def resolve_deferred(self, data):
+        ''' Look up the references v1_transform() deferred, a None value leaves the key unset '''
+        for (spec, key, kind, arg) in data['Header'].pop('deferred', []):
+            value = self.lookup_reference(kind, arg)
+            if value is not None:
+                data[spec][key] = value
+    
+      
+class NameIndex(object):
+    '''
+    The names of the elements json files refer to, for JsonValidator.
+    Loaded over a connection, one query per entity: no ORM instances.
+    '''
+
+    # Entities json files refer to by ElementName
+    ENTITIES = (Rack, Chassis, Pod, Appliance, Device, Subnet)
+
+    log = logging.getLogger("dino.cmd.json.nameindex")
+
+    def __init__(self):
+        self.names = set()
+        # Host ElementName -> ElementName of its Device
+        self.host_devices = {}
+        # Subnet ElementNames, by longest prefix match
+        self.subnets = PrefixIndex()
+        # (first naddr, last naddr) of the dhcp ranges
+        self.dhcp_ranges = []
+
+    def load(self, connection):
+        for entity in self.ENTITIES:
+            prefix = entity.__name__ + '/'
+            for (name,) in connection.execute(select([ entity.table.c.instance_name ])):
+                self.names.add(prefix + name)
+
+        (host, device) = (Host.table, Device.table)
+        query = select([ host.c.instance_name, device.c.instance_name ], host.c.device_id == device.c.id)
+        for (host_name, device_name) in connection.execute(query):
+            self.host_devices['Host/' + host_name] = 'Device/' + device_name
+
+        subnet = Subnet.table
+        for (name, addr, mask_len) in connection.execute(select([ subnet.c.instance_name, subnet.c.addr, subnet.c.mask_len ])):
+            self.subnets.insert(IpType.aton(addr), mask_len, 'Subnet/' + name)
+
+        ranges = Range.table
+        query = select([ subnet.c.addr, ranges.c.start, ranges.c.end ], 
+                       and_(ranges.c.subnet_id == subnet.c.id, ranges.c.range_type == 'dhcp'))
+        for (addr, start, end) in connection.execute(query):
+            naddr = IpType.aton(addr)
+            self.dhcp_ranges.append((naddr + start, naddr + end))
+
+        self.log.info("Loaded %d names, %d hosts, %d subnets, %d dhcp ranges", 
+                      len(self.names), len(self.host_devices), len(self.subnets), len(self.dhcp_ranges))
+        return self
+
+    def has(self, spec):
+        return spec in self.names
+
+    def host_device(self, spec):
+        return self.host_devices.get(spec)
+
+    def subnet(self, ip):
+        return self.subnets.lookup(IpType.aton(ip))
+
+    def is_dynamic(self, ip):
+        naddr = IpType.aton(ip)
+        for (first, last) in self.dhcp_ranges:
+            if first <= naddr <= last:
+                return True
+        return False
+
+
+class JsonValidator(JsonProcessor):
+    '''
+    The reference checks of JsonProcessor.verify(), against a NameIndex
+    instead of a session. validate() returns the errors of a struct 
+    from parse(), nothing is created or changed in the database.
+    '''
+
+    log = logging.getLogger("dino.cmd.json.validator")
+
+    def __init__(self, index):
+        JsonProcessor.__init__(self, None)
+        self.index = index
+        self.errors = []
+
+    def validate(self, data):
+        self.errors = []
+        self.resolve_deferred(data)
+
+        if data['Header'].get('type') == 'server':
+            self.errors += self._resolve_server(data)
+        elif data['Header'].get('type') == 'special':
+            self.errors += self._resolve_special(data)
+        else:
+            self.errors.append('Passed in Header that has no update type.')
+        return self.errors
+
+    def find(self, spec):
+        return self.index.has(spec)
+
+    def lookup_reference(self, kind, arg):
+        if kind == 'device':
+            return self.index.host_device(arg)
+        if kind == 'subnet':
+            return self.index.subnet(arg)
+        if kind == 'dynamic':
+            if self.index.is_dynamic(arg):
+                self.errors.append('Address is in a dhcp range: %s' % arg)
+            return arg
+        raise RuntimeError("Unknown reference kind: %s" % kind)
+
+    def _resolve_server(self, data):
+        # verify() does not look up the switch, the index can
+        switches = [ edict.get('switch') for e, edict in data.items() if e.startswith('Device/') ]
+        errors = JsonProcessor._resolve_server(self, data)
+        for switch in switches:
+            if switch and not self.find(switch):
+                errors.append('Switch: %s does not exist.' % switch)
+        return errors
+
+
+class JsonExporter(object):
+    '''
+    JsonProcessor.host_to_dict() of many hosts, from a connection.
+    Hosts are read CHUNK_SIZE at a time, in id order, with three queries 
+    per chunk: the hosts with the names they refer to, their ports, and 
+    their interfaces with the addresses. Only one chunk is held in memory.
+    '''
+
+    CHUNK_SIZE = 500
+
+    log = logging.getLogger("dino.cmd.json.exporter")
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def iter_hosts(self, site=None, host_ids=None):
+        ''' host_to_dict() of every Host (with a Device), of the Hosts in 
+        a site, or of the host_ids '''
+        if host_ids is not None:
+            host_ids = sorted(host_ids)
+            for i in xrange(0, len(host_ids), self.CHUNK_SIZE):
+                chunk = host_ids[i:i + self.CHUNK_SIZE]
+                for (host_id, data) in self._export_chunk(Host.table.c.id.in_(chunk), site):
+                    yield data
+            return
+
+        last_id = 0
+        while True:
+            chunk = self._export_chunk(Host.table.c.id > last_id, site, limit=self.CHUNK_SIZE)
+            if not chunk:
+                return
+            for (host_id, data) in chunk:
+                yield data
+            last_id = chunk[-1][0]
+
+    def _export_chunk(self, where, site, limit=None):
+        ''' [ (host id, host_to_dict()) ] of the Hosts matching where '''
+        (h, d, p, a) = (Host.table, Device.table, Pod.table, Appliance.table)
+        (r, s, c) = (Rack.table, Site.table, Chassis.table)
+        console = Device.table.alias('console')
+        switch = Device.table.alias('switch')
+
+        joined = h.join(d, h.c.device_id == d.c.id) \
+                  .outerjoin(p, h.c.pod_id == p.c.id) \
+                  .outerjoin(a, h.c.appliance_id == a.c.id) \
+                  .outerjoin(r, d.c.rack_id == r.c.id) \
+                  .outerjoin(s, r.c.site_id == s.c.id) \
+                  .outerjoin(c, d.c.chassis_id == c.c.id) \
+                  .outerjoin(console, d.c.console_id == console.c.id) \
+                  .outerjoin(switch, d.c.switch_id == switch.c.id)
+        if site is not None:
+            where = and_(where, s.c.name == site)
+
+        query = select([ h.c.id, h.c.instance_name, p.c.instance_name, a.c.instance_name, 
+                         d.c.id, d.c.instance_name, d.c.hid, d.c.hw_type, d.c.status, d.c.notes, d.c.rackpos, 
+                         d.c.serialno, d.c.pdu_port, d.c.hw_class, r.c.instance_name, c.c.instance_name, 
+                         console.c.instance_name, switch.c.instance_name ], 
+                       where, from_obj=[ joined ], use_labels=True).order_by(h.c.id)
+        if limit is not None:
+            query = query.limit(limit)
+
+        hosts = []
+        for (host_id, host_name, pod, appliance, device_id, device_name, hid, hw_type, status, notes, rackpos, 
+             serialno, pdu_port, hw_class, rack, chassis, console_name, switch_name) in self.connection.execute(query):
+            hn = element_name('Host', host_name)
+            dn = element_name('Device', device_name)
+            data = {}
+            data['Header'] = { "version" : 2, "type" : hw_class == 'server' and "server" or "special" }
+            data[hn] = { 'id' : host_id, 
+                         'name' : host_name.split('.')[0], 
+                         'pod' : element_name('Pod', pod), 
+                         'device' : dn, 
+                         'appliance' : element_name('Appliance', appliance) }
+            data[dn] = { 'hid' : hid, 'hw_type' : hw_type, 'status' : status, 'notes' : notes, 
+                         'rackpos' : rackpos, 'serialno' : serialno, 'pdu_port' : pdu_port, 'hw_class' : hw_class,
+                         'rack' : element_name('Rack', rack), 
+                         'console' : element_name('Device', console_name),
+                         'switch' : element_name('Device', switch_name), 
+                         'chassis' : element_name('Chassis', chassis) }
+            hosts.append((host_id, device_id, hn, dn, data))
+
+        if not hosts:
+            return []
+
+        # device_id -> [ (port name, Port ElementName, port dict) ]
+        ports = {}
+        p = Port.table
+        query = select([ p.c.device_id, p.c.instance_name, p.c.name, p.c.mac, p.c.vlan, p.c.is_blessed, p.c.is_ipmi ], 
+                       p.c.device_id.in_([ device_id for (host_id, device_id, hn, dn, data) in hosts ])).order_by(p.c.id)
+        for (device_id, port_name, name, mac, vlan, is_blessed, is_ipmi) in self.connection.execute(query):
+            pdict = { 'name' : name, 'mac' : mac, 'vlan' : vlan, 'is_blessed' : is_blessed, 'is_ipmi' : is_ipmi }
+            ports.setdefault(device_id, []).append((name, element_name('Port', port_name), pdict))
+
+        # (host_id, port_name) -> (Interface ElementName, IpAddress ElementName, Subnet ElementName)
+        interfaces = {}
+        (i, ip, sn) = (Interface.table, IpAddress.table, Subnet.table)
+        query = select([ i.c.host_id, i.c.port_name, i.c.instance_name, ip.c.instance_name, sn.c.instance_name ], 
+                       i.c.host_id.in_([ host_id for (host_id, device_id, hn, dn, data) in hosts ]), 
+                       from_obj=[ i.outerjoin(ip, ip.c.interface_id == i.c.id).outerjoin(sn, ip.c.subnet_id == sn.c.id) ], 
+                       use_labels=True).order_by(i.c.id)
+        for (host_id, port_name, iface, address, subnet) in self.connection.execute(query):
+            # the first one, like Port.interface
+            interfaces.setdefault((host_id, port_name), (iface, address, subnet))
+
+        chunk = []
+        for (host_id, device_id, hn, dn, data) in hosts:
+            for (name, pn, pdict) in ports.get(device_id, []):
+                pdict['device'] = dn
+                data[pn] = pdict
+                if not interfaces.has_key((host_id, name)):
+                    continue
+                (iface, address, subnet) = interfaces[(host_id, name)]
+                inn = element_name('Interface', iface)
+                data[inn] = { 'port' : pn }
+                if address is not None:
+                    data[element_name('IpAddress', address)] = { 'interface' : inn, 
+                                                                'subnet' : element_name('Subnet', subnet), 
+                                                                'value' : address }
+            chunk.append((host_id, data))
+
+        self.log.fine("Exported %d hosts", len(chunk))
+        return chunk
+
+
+def element_name(entity_name, instance_name):
+    ''' str() of an Element, from its instance_name: "None" for None '''
+    if instance_name is None:
+        return "None"
+    return "%s/%s" % (entity_name, instance_name)
+
+
+def parse_file(filepath):
+    '''
+    Process pool entry point: JsonProcessor.parse() without a session.
+    Returns (filepath, data, errors), data is None if the file could 
+    not be read.
+    '''
+    try:
+        (data, errors) = JsonProcessor(None).parse(filepath)
+    except Exception, e:
+        return (filepath, None, [ "%s: %s" % (e.__class__.__name__, e) ])
+    return (filepath, data, errors)
+
       
 def get_ip(addr, iface):
     
@@ -828,14 +1217,8 @@ def find_subnet(session, ip):
     matches.
     '''
 
-    naddr = IpType.aton(ip)
-    sql_netmask = func.power(2,32) - func.power(2, (32-Subnet.mask_len))
-
-    q = session.query(Subnet).filter(
-        Subnet.addr == sql_netmask.op('&')(naddr)
-        ).order_by( Subnet.mask_len.desc() )
-
-    return q.first()
-
-
+    subnet_id = session.subnet_index.lookup(IpType.aton(ip))
+    if subnet_id is None:
+        return None
 
+    return session.query(Subnet).get(subnet_id)
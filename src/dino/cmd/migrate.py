@@ -62,7 +62,8 @@ class MigrateCommand(MainCommand):
     NAME = 'migrate'
     USAGE = '''[ -s <source_url> ] 
                [ -i|--import-dir <import-dir> ] 
-               [ -p|--special-dir <special-dir> ]'''
+               [ -p|--special-dir <special-dir> ]
+               [ -j|--jobs <jobs> ]'''
     GROUP = "system"    
     OPTIONS = ( 
         Option('-s', '--src', dest='source_url', default=None),  
@@ -70,6 +71,7 @@ class MigrateCommand(MainCommand):
         Option('-p', '--special-dir', dest='special_dir', default=None),
         Option('--no-import', dest='doimport', action='store_false', default=True),
         Option('--cleardb', dest='cleardb', action='store_true', default=True),
+        Option('-j', '--jobs', dest='jobs', type='int', default=1),
     )
 
     
@@ -356,7 +358,11 @@ class MigrateCommand(MainCommand):
         
         imp_cmd_cls = MainCommand.get_command('jsonimport')
         imp_cmd = imp_cmd_cls(self.db_config, self.cli)  
-        imp_cmd.parse(files) 
+        if self.option.jobs > 1:
+            # parse the files in parallel, then write them in batches
+            imp_cmd.parse([ '-b', '-j', str(self.option.jobs) ] + files)
+        else:
+            imp_cmd.parse(files) 
         l = imp_cmd.execute()
         
         
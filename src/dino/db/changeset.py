@@ -8,7 +8,7 @@ from copy import copy
                 
 import sqlalchemy
 import sqlalchemy.schema
-from sqlalchemy import and_, or_, between
+from sqlalchemy import and_, or_
 from sqlalchemy import func, types
 from sqlalchemy import exceptions
 
@@ -38,7 +38,9 @@ class ChangeSetSession(sqlalchemy.orm.session.Session):
         self.changeset_ext = None
         self.last_changeset = None
         self.opened_changeset = None
+        self.revision_batch = RevisionBatch()
         self._changeset_cls = None
+        self._revisioned_entities = [ e for e in entity_set if hasattr(e, 'Revision') ]
         
         if entity_set.has_entity("ChangeSet"): 
             self._changeset_cls = entity_set.resolve("ChangeSet")       
@@ -101,8 +103,72 @@ class ChangeSetSession(sqlalchemy.orm.session.Session):
             raise exceptions.InvalidRequestError("Cannot flush with ChangeSet that has already been committed")
         
         return self.opened_changeset
-         
-    
+
+    def snapshot(self, changeset):
+        """ Read-only view of Revisioned entities at the changeset (see RevisionSnapshot) """
+        assert self.using_changeset(), self.NO_CHANGESET_ENTITY_MESSAGE
+        return RevisionSnapshot(self, changeset)
+
+    def diff_changesets(self, changeset_a, changeset_b, entities=None):
+        """ Generate a RevisionChange for each head added, deleted or modified 
+        between the two changesets, with one query per revision table (see RevisionDiff) """
+        assert self.using_changeset(), self.NO_CHANGESET_ENTITY_MESSAGE
+        if entities is None:
+            entities = self._revisioned_entities
+        return RevisionDiff(self, changeset_a, changeset_b).changes(entities)
+
+    def bulk_update(self, entity, ids, values):
+        """ Set column values on the rows of a Revisioned entity in one UPDATE
+        (WHERE id IN ids), without loading the instances.
+
+        The rows are updated as part of the open changeset: current revisions
+        are invalidated and new revisions are inserted (executemany) just as
+        RevisionMapperExtension would per instance. Returns the number of rows updated.
+        """
+        assert self.using_changeset(), self.NO_CHANGESET_ENTITY_MESSAGE
+        if not ids:
+            return 0
+
+        # The ChangeSet must have an id to reference from the rows
+        if self.opened_changeset is None:
+            self._assert_changeset()
+        changeset = self.opened_changeset
+        if changeset.id is None:
+            self.flush()
+        ids = list(set(ids))
+
+        table = entity.table
+        revision_table = entity.Revision.table
+        connection = self.connection()
+
+        values = dict(values)
+        values['changeset_id'] = changeset.id
+        values['revision'] = table.c.revision + 1
+
+        stmt = table.update() \
+            .values(values) \
+            .where(table.c.id.in_(ids))
+        count = connection.execute(stmt).rowcount
+
+        batch = RevisionBatch()
+        batch.invalidate(revision_table, changeset.id, ids)
+        for row in connection.execute(table.select(table.c.id.in_(ids))):
+            revision_dict = { 'head_id' : row['id'] }
+            for field in table.c.keys():
+                if field in entity.__ignored_fields__:
+                    continue
+                revision_dict[field] = row[field]
+            batch.add(revision_table, revision_dict)
+        batch.execute(connection)
+
+        # Loaded instances no longer match their rows
+        id_set = set(ids)
+        for inst in self.identity_map.values():
+            if isinstance(inst, entity) and inst.id in id_set:
+                self.expire(inst)
+
+        return count
+
     class ChangeSetSessionExtension(sqlalchemy.orm.session.SessionExtension): 
         """ 
         Extension to a standard session which handles the automatic updating 
@@ -123,6 +189,13 @@ class ChangeSetSession(sqlalchemy.orm.session.Session):
             if session.opened_changeset:
                 session.opened_changeset.committed = datetime.datetime.utcnow()
             
+            # Left over from a flush that failed
+            session.revision_batch.clear()
+            
+        def after_flush(self, session, flush_context):
+            if len(session.revision_batch) > 0:
+                session.revision_batch.execute()
+            
         def after_attach(self, session, instance):
             assert isinstance(session, ChangeSetSession)
           
@@ -171,24 +244,351 @@ class RevisionMapperExtension(sqlalchemy.orm.MapperExtension):
         self._invalidate_revision(mapper, connection, instance)     
         return sqlalchemy.orm.EXT_CONTINUE
 
+    # Revision rows are not written here, but collected in the session's RevisionBatch
+    # and written once per flush by ChangeSetSessionExtension.after_flush
+
+    def _batch(self, connection, instance):
+        session = sqlalchemy.orm.object_session(instance)
+        assert isinstance(session, ChangeSetSession), "Revisioned instances must use a ChangeSetSession"
+        session.revision_batch.connection = connection
+        return session.revision_batch
 
     def _add_revision(self, mapper, connection, instance ):
         revision_dict = instance.get_revision_map()
-        stmt = instance.Revision.table.insert( revision_dict )
-        #import pdb; pdb.set_trace()
-        connection.execute(stmt)
+        self._batch(connection, instance).add(instance.Revision.table, revision_dict)
 
     def _invalidate_revision(self, mapper, connection, instance):
-        revision_table = instance.Revision.table                
+        self._batch(connection, instance).invalidate(instance.Revision.table, instance.changeset.id, [ instance.id ])
+        
         
-        stmt = revision_table.update() \
-            .values({ 'changeset_invalid_id' : instance.changeset.id } ) \
-            .where(and_( revision_table.c.head_id == instance.id, revision_table.c.changeset_invalid_id == None))
-        connection.execute(stmt)
+class RevisionBatch(object):
+    """ Revision table writes collected over a flush. 
+    Written per revision table as one UPDATE ... WHERE head_id IN (...) to invalidate 
+    the current revisions, then one executemany INSERT of the new revisions. 
+    """
+    
+    # Max number of head ids in a single IN (...) clause
+    CHUNK_SIZE = 1000
+    
+    def __init__(self):
+        self.clear()
+        
+    def clear(self):
+        self.connection = None
+        self._tables = []          # in the order first written (parents first, for FKs)
+        self._invalidations = {}   # revision_table -> { changeset_id : [ head_id ] }
+        self._revisions = {}       # revision_table -> [ revision_dict ]
+    
+    def __len__(self):
+        return len(self._tables)
+        
+    def _add_table(self, revision_table):
+        if revision_table not in self._revisions:
+            self._tables.append(revision_table)
+            self._revisions[revision_table] = []
+            self._invalidations[revision_table] = {}
+        
+    def add(self, revision_table, revision_dict):
+        self._add_table(revision_table)
+        self._revisions[revision_table].append(revision_dict)
+        
+    def invalidate(self, revision_table, changeset_id, head_ids):
+        self._add_table(revision_table)
+        self._invalidations[revision_table].setdefault(changeset_id, []).extend(head_ids)
+        
+    def execute(self, connection=None):
+        if connection is None:
+            connection = self.connection
+            
+        try:
+            for revision_table in self._tables:
+                for (changeset_id, head_ids) in self._invalidations[revision_table].iteritems():
+                    for i in xrange(0, len(head_ids), self.CHUNK_SIZE):
+                        stmt = revision_table.update() \
+                            .values({ 'changeset_invalid_id' : changeset_id }) \
+                            .where(and_( revision_table.c.head_id.in_(head_ids[i:i + self.CHUNK_SIZE]), 
+                                         revision_table.c.changeset_invalid_id == None))
+                        connection.execute(stmt)
+                
+                if self._revisions[revision_table]:
+                    connection.execute(revision_table.insert(), self._revisions[revision_table])
+        finally:
+            self.clear()
 
 _revision_mapper_extension = RevisionMapperExtension()
 
 
+def revision_valid_clause(revision_table, changeset=None):
+    """ Rows of a revision table valid at the changeset:  
+        changeset_id <= changeset < changeset_invalid_id (or not invalidated)
+        
+    With no changeset, only the current revisions (changeset_invalid_id IS NULL). 
+    Both forms are range scans on the (head_id, changeset_id, changeset_invalid_id) index;
+    for a single head, order by changeset_id DESC so the current revision is the first entry read.
+    """
+    if changeset is None:
+        return revision_table.c.changeset_invalid_id == None
+    
+    return and_(
+        revision_table.c.changeset_id <= changeset,
+        or_(revision_table.c.changeset_invalid_id == None, revision_table.c.changeset_invalid_id > changeset) 
+    )
+
+
+class RevisionSnapshot(object):
+    """ Read-only view of Revisioned entities as they were at a ChangeSet.
+    
+    Loads the Revision of a set of heads, and the Revisions of the related 
+    heads named by relation paths, with one query per entity type. 
+    The relations are wired between the loaded Revisions in memory, so 
+    walking them does not query.
+    
+    The Revisions handed out are copies private to the snapshot, one per 
+    revision row, and are not attached to the session: two snapshots 
+    in the same session do not share state, and nothing is flushed.
+    
+        snapshot = session.snapshot(changeset)
+        for host in snapshot.load(Host, relations=['interfaces.address']):
+            for iface in host.interfaces:
+                print iface.address
+    """
+    
+    def __init__(self, session, changeset=None):
+        self.session = session
+        if changeset is None:
+            self.changeset = None
+        else:
+            self.changeset = int(changeset)
+        # identity key -> copy of the Revision
+        self._copies = {}
+        
+    def query(self, entity):
+        clause = revision_valid_clause(entity.Revision.table, self.changeset)
+        return self.session.query(entity.Revision).filter(clause)
+        
+    def load(self, entity, heads=None, relations=()):
+        """ Load the Revisions of entity (all, or only heads: instances or ids).
+        relations is a list of dotted relation paths to load along with them.
+        """
+        query = self.query(entity)
+        if heads is not None:
+            head_ids = [ getattr(h, 'id', h) for h in heads ]
+            if not head_ids:
+                return []
+            query = query.filter(entity.Revision.table.c.head_id.in_(head_ids))
+            
+        revisions = self._prepare(query.all())
+        for path in relations:
+            self._load_path(entity, revisions, path.split('.'))
+        return revisions
+        
+    def get(self, entity, head):
+        """ Revision of a single head (instance or id), or None """
+        revisions = self.load(entity, [ head ])
+        if revisions:
+            return revisions[0]
+        return None
+            
+    def _prepare(self, revisions):
+        return [ self._copy(rev) for rev in revisions ]
+        
+    def _copy(self, rev):
+        """ Detached copy of a Revision, with the column values only """
+        mapper = sqlalchemy.orm.object_mapper(rev)
+        key = mapper.identity_key_from_instance(rev)
+        
+        copy = self._copies.get(key)
+        if copy is None:
+            copy = mapper.class_manager.new_instance()
+            for prop in mapper.iterate_properties:
+                if isinstance(prop, sqlalchemy.orm.properties.ColumnProperty):
+                    setattr(copy, prop.key, getattr(rev, prop.key))
+            copy._changeset_view = self.changeset
+            copy._snapshot = self
+            copy._snapshot_relations = {}
+            self._copies[key] = copy
+        return copy
+        
+    def _load_path(self, entity, revisions, names):
+        (name, rest) = (names[0], names[1:])
+        
+        prop = self._find_relation(entity, name)
+        target = prop.target
+        if not hasattr(target, 'Revision'):
+            raise exceptions.InvalidRequestError("Relation is not Revisioned: %s.%s" % (entity.__name__, name))
+        
+        if isinstance(prop, ManyToOne):
+            local_column_name = prop.foreign_key[0].name
+            keys = set([ getattr(r, local_column_name) for r in revisions ])
+            keys.discard(None)
+            
+            targets = self._load_by(target, 'head_id', keys)
+            by_head = dict([ (t.head_id, t) for t in targets ])
+            for r in revisions:
+                r._snapshot_relations[name] = by_head.get(getattr(r, local_column_name))
+                
+        elif isinstance(prop, (OneToMany, OneToOne)):
+            target_column_name = prop._inverse.foreign_key[0].name
+            keys = set([ r.head_id for r in revisions ])
+            
+            targets = self._load_by(target, target_column_name, keys)
+            by_key = {}
+            for t in targets:
+                by_key.setdefault(getattr(t, target_column_name), []).append(t)
+                
+            for r in revisions:
+                related = by_key.get(r.head_id, [])
+                if isinstance(prop, OneToMany):
+                    r._snapshot_relations[name] = related
+                elif related:
+                    r._snapshot_relations[name] = related[0]
+                else:
+                    r._snapshot_relations[name] = None
+        else:
+            raise exceptions.InvalidRequestError("Cannot snapshot relation type %s: %s.%s" % 
+                (prop.__class__.__name__, entity.__name__, name))
+        
+        if rest:
+            self._load_path(target, targets, rest)
+        
+    def _load_by(self, entity, column_name, keys):
+        if not keys:
+            return []
+        column = entity.Revision.table.c[column_name]
+        query = self.query(entity).filter(column.in_(list(keys)))
+        return self._prepare(query.all())
+        
+    @staticmethod
+    def _find_relation(entity, name):
+        for cls in entity.__mro__:
+            if not hasattr(cls, '_descriptor'):
+                continue
+            for builder in cls._descriptor.builders:
+                if isinstance(builder, elixir.relationships.Relationship) and builder.name == name:
+                    return builder
+        raise exceptions.InvalidRequestError("Unknown relation: %s.%s" % (entity.__name__, name))
+
+
+class RevisionChange(object):
+    """ Difference of one head between two changesets. 
+    old / new are the revision rows valid at each changeset (None if not valid) """
+    
+    ADD, DELETE, UPDATE = ('add', 'delete', 'update')
+    
+    # Columns that change with every revision
+    SYSTEM_COLUMNS = ('id', 'head_id', 'revision', 'changeset_id', 'changeset_invalid_id')
+    
+    def __init__(self, entity, head_id, old, new):
+        self.entity = entity
+        self.head_id = head_id
+        self.old = old
+        self.new = new
+        
+    @property
+    def kind(self):
+        if self.old is None:
+            return self.ADD
+        elif self.new is None:
+            return self.DELETE
+        else:
+            return self.UPDATE
+    
+    @property
+    def name(self):
+        row = self.new or self.old
+        if 'instance_name' in row.keys():
+            return "%s/%s" % (self.entity.__name__, row['instance_name'])
+        return "%s/{%d}" % (self.entity.__name__, self.head_id)
+        
+    def changed_columns(self):
+        """ [ (column, old_value, new_value) ] for an UPDATE """
+        if self.kind != self.UPDATE:
+            return []
+        return [ (k, self.old[k], self.new[k]) for k in self.new.keys() 
+                    if k not in self.SYSTEM_COLUMNS and self.old[k] != self.new[k] ]
+    
+    def __str__(self):
+        return "%s %s" % ({ self.ADD : '+', self.DELETE : '-', self.UPDATE : '~' }[self.kind], self.name)
+            
+            
+class RevisionDiff(object):
+    """ Set based difference of all the heads of Revisioned entities between two changesets.
+    
+    Per revision table, a query selects only the rows valid at exactly one of 
+    the two changesets, ordered by head_id. A head with only an old row was deleted, 
+    only a new row was added, both was modified. Each change is generated as soon 
+    as its head is complete.
+    
+    MySQLdb reads the whole result of a query into the client before the first 
+    row is fetched, so the rows are selected FETCH_SIZE at a time, each query 
+    starting after the last (head_id, changeset_id) read: memory does not grow 
+    with the size of the diff. Rows older than b are only changed by setting a 
+    changeset_invalid_id newer than b, so the chunks are consistent.
+    """
+    
+    FETCH_SIZE = 1000
+    
+    def __init__(self, session, changeset_a, changeset_b):
+        self.session = session
+        (self.changeset_a, self.changeset_b) = sorted((int(changeset_a), int(changeset_b)))
+        
+    def changes(self, entities):
+        seen_tables = set()
+        for entity in entities:
+            revision_table = entity.Revision.table
+            # Entities with single table inheritance share one revision table
+            if revision_table in seen_tables:
+                continue
+            seen_tables.add(revision_table)
+            
+            for change in self.table_changes(entity):
+                yield change
+            
+    def query(self, revision_table, after=None):
+        """ The next FETCH_SIZE rows, after the (head_id, changeset_id) given """
+        (a, b) = (self.changeset_a, self.changeset_b)
+        c = revision_table.c
+        
+        # valid at a, invalidated by b  /  created after a, still valid at b
+        old_rows = and_(c.changeset_id <= a, c.changeset_invalid_id > a, c.changeset_invalid_id <= b)
+        new_rows = and_(c.changeset_id > a, c.changeset_id <= b, 
+                        or_(c.changeset_invalid_id == None, c.changeset_invalid_id > b))
+        
+        query = revision_table.select(or_(old_rows, new_rows))
+        if after is not None:
+            (head_id, changeset_id) = after
+            query = query.where(or_(c.head_id > head_id, 
+                                    and_(c.head_id == head_id, c.changeset_id > changeset_id)))
+        return query.order_by(c.head_id, c.changeset_id).limit(self.FETCH_SIZE)
+            
+    def table_changes(self, entity):
+        a = self.changeset_a
+        connection = self.session.connection()
+        
+        (head_id, old, new) = (None, None, None)
+        after = None
+        while True:
+            rows = connection.execute(self.query(entity.Revision.table, after)).fetchall()
+            
+            for row in rows:
+                if row['head_id'] != head_id:
+                    if head_id is not None:
+                        yield RevisionChange(entity, head_id, old, new)
+                    (head_id, old, new) = (row['head_id'], None, None)
+                    
+                if row['changeset_id'] <= a:
+                    old = row
+                else:
+                    new = row
+                    
+            if len(rows) < self.FETCH_SIZE:
+                break
+            after = (rows[-1]['head_id'], rows[-1]['changeset_id'])
+                    
+        if head_id is not None:
+            yield RevisionChange(entity, head_id, old, new)
+        
+        
 def create_changeset_entity():
     """ Create a new ChangeSet Entity.
     Each entity collection should have its own ChangeSet Entity.
@@ -285,7 +685,7 @@ class RevisionEntityBuilder(elixir.properties.EntityBuilder):
             # New Fields
             'head' : ManyToOne(entity.__name__, 
                 constraint_kwargs={ 'ondelete' : 'NO ACTION'}, 
-                column_kwargs={ 'index' : True } ), 
+                column_kwargs={ 'index' : False } ),   # see ix_*_validity in after_table 
             'changeset_invalid' : ManyToOne('ChangeSet'),            
         }        
         
@@ -371,6 +771,13 @@ class RevisionEntityBuilder(elixir.properties.EntityBuilder):
                             
                 if len(c.elements) == 0:
                     self.entity.Revision.table.constraints.remove(c)
+        
+        # Every revision lookup is by head_id and a changeset range (see revision_valid_clause)
+        # The composite index also serves plain head_id lookups, so head_id has no index of its own
+        # Databases created before 2.1.11 get it from 'dino admin upgrade' (dino.db.upgrade)
+        revision_table = self.entity.Revision.table
+        sqlalchemy.schema.Index("ix_%s_validity" % revision_table.name, 
+            revision_table.c.head_id, revision_table.c.changeset_id, revision_table.c.changeset_invalid_id)
                             
 
                     
@@ -422,34 +829,53 @@ class RevisionEntityBuilder(elixir.properties.EntityBuilder):
                 
                 
                 # Create the methods (two get methods for two types of relationships)
+                # Bind loop values as defaults, the methods outlive this iteration.
+                # Relations already loaded by a RevisionSnapshot are read from _snapshot_relations,
+                # the others of a snapshot copy are queried through the snapshot
                 # 
-                def target_get_entity(self):
-                    session = sqlalchemy.orm.object_session(self)
+                def target_get_entity(self, name=prop.name, target_entity=target_entity, 
+                        target_table=target_table, target_column=target_column, local_column_name=local_column_name):
+                    if name in self.__dict__.get('_snapshot_relations', ()):
+                        return self._snapshot_relations[name]
+                    snapshot = self.__dict__.get('_snapshot')
+                    if snapshot is not None:
+                        session = snapshot.session
+                    else:
+                        session = sqlalchemy.orm.object_session(self)
                     assert session is not None, "Instance has no session: Must have session to read relations"
                     query = session.query(target_entity).filter( 
                         and_( 
                             target_column == getattr(self,local_column_name),                     
-                            target_table.c.changeset_id >= self._changeset_view,
-                            between(self._changeset_view, target_table.c.changeset_id, target_table.c.changeset_invalid_id)
+                            revision_valid_clause(target_table, self._changeset_view)
                         )
                     ) 
                 
                     e = query.first()
+                    if snapshot is not None:
+                        return e and snapshot._copy(e)
                     e._changeset_view = self._changeset_view
                     return e
                     
-                def target_get_collection(self):
-                    session = sqlalchemy.orm.object_session(self)
+                def target_get_collection(self, name=prop.name, target_entity=target_entity, 
+                        target_table=target_table, target_column=target_column, local_column_name=local_column_name):
+                    if name in self.__dict__.get('_snapshot_relations', ()):
+                        return self._snapshot_relations[name][:]
+                    snapshot = self.__dict__.get('_snapshot')
+                    if snapshot is not None:
+                        session = snapshot.session
+                    else:
+                        session = sqlalchemy.orm.object_session(self)
                     assert session is not None, "Instance has no session: Must have session to read relations"
                     query = session.query(target_entity).filter( 
                         and_(    
                             target_column == getattr(self,local_column_name),                     
-                            target_table.c.changeset_id >= self._changeset_view,
-                            between(self._changeset_view, target_table.c.changeset_id, target_table.c.changeset_invalid_id)
+                            revision_valid_clause(target_table, self._changeset_view)
                         )
                     ) 
                 
                     list = query.all()
+                    if snapshot is not None:
+                        return snapshot._prepare(list)
                     for e in list:
                         e._changeset_view = self._changeset_view
                     return list
@@ -501,18 +927,32 @@ class RevisionEntityBuilder(elixir.properties.EntityBuilder):
             
             q = sess.query(self.Revision)
             q = q.filter(and_(
-                    self.Revision.head == self, 
-                    self.Revision.changeset_id >= changeset,
-                    between(changeset, self.Revision.changeset_id, self.Revision.changeset_invalid_id)
+                    self.Revision.head_id == self.id, 
+                    revision_valid_clause(self.Revision.table, int(changeset))
                     )).limit(1)
                     
             r = q.first()
             if r:
                 r._changeset_view = changeset
             return r
+        
+        def get_current_revision(self):
+            sess = sqlalchemy.orm.object_session(self)
+            
+            q = sess.query(self.Revision)
+            q = q.filter(and_(
+                    self.Revision.head_id == self.id, 
+                    revision_valid_clause(self.Revision.table)
+                    )).order_by(self.Revision.table.c.changeset_id.desc()).limit(1)
+            
+            r = q.first()
+            if r:
+                r._changeset_view = None
+            return r
                     
         self.entity.get_revision = get_revision
         self.entity.get_at_changeset = get_at_changeset
+        self.entity.get_current_revision = get_current_revision
         self.entity.get_revision_map = get_revision_map
 
 
@@ -36,7 +36,13 @@ class DbConfig(object):
         'host' : None,
         'db' : None,
         'url' : None,
+        'element_cache_size' : None,
     }
+    
+    # Max Elements held in each session's ElementCache (0 disables the cache).
+    # Off by default: cached instances are not refreshed when other sessions 
+    # change the same rows, so only enable it for single writer batch jobs.
+    ELEMENT_CACHE_SIZE = 0
 
     @classmethod
     def create(cls, **kwargs):  
@@ -66,8 +72,13 @@ class DbConfig(object):
 
 
     def __init__(self, **kwargs):
+        # What it was created with, for an equal DbConfig in another process
+        self.options = dict([ (k, kwargs.get(k)) for k in self.BASE_OPTS ])
+        
         self.uri = self._create_uri(kwargs)         
         self.engine = engine.create_engine(self.uri, echo=False)
+        if self.db is None:
+            self.db = self.engine.url.database
         
         self.entity_set = kwargs.get('entity_set')
         if self.entity_set is None:
@@ -80,6 +91,11 @@ class DbConfig(object):
         
         self.use_changesets = self.entity_set.has_entity("ChangeSet") 
         
+        self.element_cache_size = kwargs.get('element_cache_size')
+        if self.element_cache_size is None:
+            self.element_cache_size = self.ELEMENT_CACHE_SIZE
+        self.element_cache_size = int(self.element_cache_size)
+        
         self._schema_info = None
     
     def __str__(self):
@@ -87,6 +103,8 @@ class DbConfig(object):
 
     def _create_uri(self, kwargs):
         if kwargs.has_key('url') and kwargs['url'] is not None:
+            for arg in ('user', 'password', 'host', 'db'):
+                setattr(self, arg, kwargs.get(arg))
             return kwargs['url']
             
         kwargs.setdefault('user', 'dino')
@@ -111,7 +129,8 @@ class DbConfig(object):
         return self._session()
         
     def _session(self):
-        return ElementSession(bind=self.engine, autocommit=True, autoflush=False, entity_set=self.entity_set)
+        return ElementSession(bind=self.engine, autocommit=True, autoflush=False, entity_set=self.entity_set,
+                              element_cache_size=self.element_cache_size)
     
     @property
     def schema_info(self):
@@ -179,6 +198,46 @@ class DbConfig(object):
         
         connection.execute("SET FOREIGN_KEY_CHECKS = 1")
     
+    def snapshot(self, path):
+        ''' Write every table to a snapshot directory, see dino.db.snapshot '''
+        from dino.db import snapshot
+        connection = self.connection()
+        try:
+            return snapshot.snapshot(connection, self.metadata_set, path)
+        finally:
+            connection.close()
+
+    def restore(self, path):
+        ''' Replace the contents of every table with a snapshot '''
+        from dino.db import snapshot
+        connection = self.connection()
+        try:
+            return snapshot.restore(connection, self.metadata_set, path)
+        finally:
+            connection.close()
+            
+    def upgrade(self):
+        ''' Upgrade the tables of an older schema version and record the 
+        new version, see dino.db.upgrade. Returns the versions upgraded from '''
+        from dino.db import upgrade
+        info = self.schema_info
+        connection = self.connection()
+        try:
+            steps = upgrade.upgrade(connection, self.metadata_set, info.version)
+        finally:
+            connection.close()
+        
+        if steps:
+            session = self._session()
+            session.open_changeset()
+            session.add(info)
+            info.version = info.model_version
+            session.submit_changeset()
+            session.refresh(info)
+            session.expunge(info)
+            session.close()
+        return steps
+            
     def dump_schema(self):
         import StringIO
         buf = StringIO.StringIO()        
@@ -2,7 +2,6 @@ import logging
 import types     
 import re
 import datetime
-import yaml
 
 import sqlalchemy.orm.properties as sa_props   
 import sqlalchemy.orm as sa_orm
@@ -397,6 +396,8 @@ class BasicElementFormProcessor(ElementFormProcessor):
 
 
     def create_all(self, form, force_rollback=False):
+        # yaml is slow to import, and only needed here (not at startup)
+        import yaml
         form = self._quote_element_names(form)
         form_dict_list = yaml.load_all(form)
         
@@ -436,6 +437,8 @@ class BasicElementFormProcessor(ElementFormProcessor):
         return desc
         
     def update_all(self, form, force_rollback=False):        
+        # yaml is slow to import, and only needed here (not at startup)
+        import yaml
         form = self._quote_element_names(form)
         form_dict_list = yaml.load_all(form)
 
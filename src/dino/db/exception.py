@@ -30,6 +30,12 @@ class ElementException(DinoException):
 class DbConfigError(ElementException):
     pass
 
+class SnapshotError(ElementException):
+    pass
+
+class UpgradeError(ElementException):
+    pass
+
 class InvalidElementClassError(ElementException):
     pass
 
@@ -21,24 +21,33 @@ class IndexedList(list):
     Replacement collection class for SQL Alchemy relations
     
     Behaves just like a list, but addes 'Map-like' traits, indexing items on the list
-    using a specified attribute on the child class.
+    using a specified attribute on the child class. Integer (and slice) indexes
+    are list indexes, anything else is looked up by key. If more than one item
+    has the same key, the first one in the list is found.
     
     Example
     A Host has Ports
     
     class Host:
         ...
-        ports = OneToMany("Port", collection_class=IndexedList.factory('value'))
+        ports = OneToMany("Port", collection_class=IndexedList.factory('name'))
     
     class Port
         ...
-        value = Field(types.String() )
+        name = Field(types.String() )
+        
+        @validates('name')
+        def validate_name(self, key, value):
+            IndexedList.rekey_parent(self, 'host', 'ports')
+            return value
         ...
     
     
     port = Port(name='name1')
     host.ports.append(port)
     host.ports['name1']
+    host.ports.get('name1')
+    host.ports[0]
     
     
     # Using Mapper
@@ -46,8 +55,9 @@ class IndexedList(list):
         children = relation(Child, collection_class=IndexedList.factory('child_attribute'))
     })
 
-    
-     
+    The index is updated on append, and rebuilt (on the next lookup) after any
+    other change to the list. The list cannot see an item's key attribute 
+    change, so the child class must call rekey_parent() when it does.
     '''
     
     @staticmethod
@@ -55,6 +65,15 @@ class IndexedList(list):
         def new_list():
             return IndexedList(attr_name)
         return new_list
+    
+    @staticmethod
+    def rekey_parent(item, parent_attr, collection_attr):
+        ''' Mark the index of the parent's collection stale, if both are loaded '''
+        parent = item.__dict__.get(parent_attr)
+        if parent is not None:
+            collection = parent.__dict__.get(collection_attr)
+            if isinstance(collection, IndexedList):
+                collection.rekey()
       
     def __init__(self, attr_name):
         import operator
@@ -62,49 +81,91 @@ class IndexedList(list):
         self.key_func = operator.attrgetter(attr_name)
         self._map = {}
     
+    @property
+    def _index(self):
+        if self._map is None:
+            self._map = {}
+            for item in self:
+                key = self.key_func(item)
+                if key is not None:
+                    self._map.setdefault(key, item)
+        return self._map
+    
+    def rekey(self):
+        self._map = None
+        
+    #
+    # List functions
+    #
     def append(self, item):
         list.append(self, item)
-        key = self.key_func(item)             
-        if key is not None:
-            if self._map.has_key(key) and self._map[key] != item:                
-                self.log.warn("Key exists: %s", key)
-            else:
-                self._map[key] = item        
+        if self._map is not None:
+            key = self.key_func(item)             
+            if key is not None:
+                self._map.setdefault(key, item)
         return item
     
     def remove(self, item):
         list.remove(self, item)
-        
-        key = self.key_func(item)
-        if key is not None and self._map.has_key(key):
-            assert self._map[key] == item 
-            del self._map[key]
-        
+        self.rekey()
         return item
     
-    def rekey(self):
-        for item in self:
-            key = self.key_func(item)
-            self._map[key] = item     
+    def insert(self, index, item):
+        list.insert(self, index, item)
+        self.rekey()
+        
+    def extend(self, items):
+        list.extend(self, items)
+        self.rekey()
     
+    def __iadd__(self, items):
+        self.extend(items)
+        return self
+        
+    def pop(self, index=-1):
+        item = list.pop(self, index)
+        self.rekey()
+        return item
+        
+    def __setslice__(self, start, end, items):
+        list.__setslice__(self, start, end, items)
+        self.rekey()
+        
+    def __delslice__(self, start, end):
+        list.__delslice__(self, start, end)
+        self.rekey()
+        
     #
     # Map-like functions
     #
     def __getitem__(self, key):
-        return self._map[key]
+        if isinstance(key, (int, long, slice)):
+            return list.__getitem__(self, key)
+        return self._index[key]
+    
     def __setitem__(self, key, item):
-        raise NotImplemented()
+        if not isinstance(key, (int, long, slice)):
+            raise NotImplementedError("Cannot assign by key: %s" % key)
+        list.__setitem__(self, key, item)
+        self.rekey()
+        
     def __delitem__(self, key):
-        self.remove(self._map[key])
+        if isinstance(key, (int, long, slice)):
+            list.__delitem__(self, key)
+        else:
+            list.remove(self, self._index[key])
+        self.rekey()
     
+    def has_key(self, key):
+        return self._index.has_key(key)
     def keys(self):
-        return self._map.keys() 
+        return self._index.keys() 
     def values(self):
-        return self._map.values() 
+        return self._index.values() 
     def items(self):
-        return self._map.items()   
+        return self._index.items()   
     def get(self, key, default=None):
-        return self._map.get(key, default)
+        return self._index.get(key, default)
         
 class_logger(IndexedList)
 
@@ -221,6 +282,8 @@ def name_depends(*args):
 
 class ElementInstrumentationManager(InstrumentationManager):
     MANAGERS = []
+    # Managers with depend_specs not processed yet
+    PENDING = []
     DEP_MAPPING = {}
       
     def __init__(self, class_):
@@ -230,6 +293,8 @@ class ElementInstrumentationManager(InstrumentationManager):
         
         derive_name_func = getattr(class_, "derive_name").im_func        
         self.depend_specs = list(getattr(derive_name_func, '__name_depends__', ()))        
+        if self.depend_specs:
+            self.PENDING.append(self)
 
     
     def old_post_configure_attribute(self, class_, key, instr_attr):
@@ -241,9 +306,10 @@ class ElementInstrumentationManager(InstrumentationManager):
         # Process all the dependencies in all managers first.
         # If any other class depends on this one, make sure that class
         # gets its info into DEP_MAPPING, before this class starts
-        # looking on that list for attributes
-        for manager in self.MANAGERS:
-            manager.process_all_depend_specs()
+        # looking on that list for attributes.
+        # Only the managers created since the last attribute have any left 
+        # (looping over every manager for every attribute is quadratic)
+        self.process_pending()
         
         
         if class_.__name__ in self.DEP_MAPPING:
@@ -256,6 +322,11 @@ class ElementInstrumentationManager(InstrumentationManager):
                
 
 
+    @classmethod
+    def process_pending(cls):
+        while cls.PENDING:
+            cls.PENDING.pop(0).process_all_depend_specs()
+
     def process_all_depend_specs(self):        
         while self.depend_specs:
             self._process_depend_spec(self.depend_specs.pop())     
@@ -376,15 +447,21 @@ class ElementMapperExtension(MapperExtension):
         return sa_orm.EXT_CONTINUE
                     
     def after_insert(self, mapper, connection, instance):
-        self._session(instance).cache_add(instance, "insert")
+        session = self._session(instance)
+        session.cache_add(instance, "insert")
+        session.subnet_index_update(instance)
         return sa_orm.EXT_CONTINUE
                     
     def after_update(self, mapper, connection, instance):
-        self._session(instance).cache_add(instance,"update")
+        session = self._session(instance)
+        session.cache_add(instance,"update")
+        session.subnet_index_update(instance)
         return sa_orm.EXT_CONTINUE      
               
     def after_delete(self, mapper, connection, instance):
-        self._session(instance).cache_delete(instance)
+        session = self._session(instance)
+        session.cache_delete(instance)
+        session.subnet_index_delete(instance)
         return sa_orm.EXT_CONTINUE
 
 
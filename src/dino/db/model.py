@@ -1,6 +1,8 @@
 
+from bisect import bisect_right
+
 from sqlalchemy.orm import ColumnProperty, validates, object_session
-from sqlalchemy import func, types
+from sqlalchemy import types
 from sqlalchemy.databases.mysql import MSInteger
 
 import schema
@@ -26,6 +28,8 @@ class IpType(types.TypeDecorator):
         return self.aton(value)
 
     def process_result_value(self, value, dialect):
+        if value is None:
+            return None
         return self.ntoa(value)
         
     @staticmethod
@@ -87,6 +91,161 @@ class StringSetType(types.TypeDecorator):
         
             
 
+# # # # # # # # # # # # # # # # # # # 
+#  Address Runs
+# # # # # # # # # # # # # # # # # # # 
+
+class AddressRuns(object):
+    ''' Set of integer addresses, stored as a sorted list of 
+    non-overlapping, inclusive (start, end) runs.
+    
+    Used in place of set(range(first, last)), so the cost of an 
+    operation follows the number of runs, not the number of addresses.
+    
+    runs = AddressRuns([ (10, 20), (30, 40) ])
+    free = runs.subtract(AddressRuns([ (12, 12), (15, 32) ]))
+    free.first(3)   # [10, 11, 13]
+    '''
+    
+    def __init__(self, runs=()):
+        self.runs = self._merge(sorted(runs))
+        self._starts = [ start for (start, end) in self.runs ]
+    
+    @staticmethod
+    def _merge(sorted_runs):
+        '''Merge overlapping or adjacent runs. Drop empty runs (start > end)'''
+        merged = []
+        for (start, end) in sorted_runs:
+            if start > end:
+                continue
+            if merged and start <= merged[-1][1] + 1:
+                if end > merged[-1][1]:
+                    merged[-1] = (merged[-1][0], end)
+            else:
+                merged.append((start, end))
+        return merged
+        
+    def size(self):
+        return sum([ end - start + 1 for (start, end) in self.runs ])
+        
+    def contains(self, naddr):
+        i = bisect_right(self._starts, naddr) - 1
+        return i >= 0 and naddr <= self.runs[i][1]
+    
+    def subtract(self, other):
+        '''Return a new AddressRuns with all addresses in other removed.
+        Both run lists are sorted, so this is a single pass over each.'''
+        result = []
+        used = other.runs
+        j = 0
+        for (start, end) in self.runs:
+            # skip used runs that end before this run starts
+            while j < len(used) and used[j][1] < start:
+                j += 1
+                
+            k = j
+            while start <= end and k < len(used) and used[k][0] <= end:
+                (used_start, used_end) = used[k]
+                if used_start > start:
+                    result.append((start, used_start - 1))
+                start = used_end + 1
+                k += 1
+                
+            if start <= end:
+                result.append((start, end))
+                
+        return AddressRuns(result)
+        
+    def first(self, count):
+        '''Return a sorted list of (at most) the first count addresses'''
+        naddrs = []
+        for (start, end) in self.runs:
+            if len(naddrs) >= count:
+                break
+            last = min(end, start + (count - len(naddrs)) - 1)
+            naddrs.extend(xrange(start, last + 1))
+        return naddrs
+    
+    def __iter__(self):
+        for (start, end) in self.runs:
+            for naddr in xrange(start, end + 1):
+                yield naddr
+    
+    def __nonzero__(self):
+        return len(self.runs) > 0
+        
+
+# # # # # # # # # # # # # # # # # # # 
+#  Prefix Index
+# # # # # # # # # # # # # # # # # # # 
+
+class PrefixIndex(object):
+    ''' Binary (radix) trie of network prefixes ( naddr / mask_len ) 
+    mapping each prefix to a value (eg Subnet.id).
+    
+    lookup() returns the value of the longest prefix containing an address,
+    walking at most 32 nodes, regardless of the number of prefixes.
+    
+    Each value may only be stored under one prefix: inserting a value 
+    again moves it to the new prefix.
+    '''
+    # node layout: [ zero_child, one_child, value ]
+    ZERO, ONE, VALUE = 0, 1, 2
+    
+    def __init__(self):
+        self.root = [ None, None, None ]
+        self.prefixes = {}
+        
+    def __len__(self):
+        return len(self.prefixes)
+        
+    @staticmethod
+    def _bit(naddr, depth):
+        return (naddr >> (31 - depth)) & 1
+        
+    def insert(self, naddr, mask_len, value):
+        self.discard(value)
+        
+        node = self.root
+        for depth in xrange(mask_len):
+            bit = self._bit(naddr, depth)
+            if node[bit] is None:
+                node[bit] = [ None, None, None ]
+            node = node[bit]
+            
+        node[self.VALUE] = value
+        self.prefixes[value] = (naddr, mask_len)
+        
+    def discard(self, value):
+        if value not in self.prefixes:
+            return 
+            
+        (naddr, mask_len) = self.prefixes.pop(value)
+        
+        node = self.root
+        for depth in xrange(mask_len):
+            node = node[self._bit(naddr, depth)]
+            if node is None:
+                return 
+                
+        if node[self.VALUE] == value:
+            node[self.VALUE] = None
+        
+    def lookup(self, naddr):
+        '''Return the value of the longest matching prefix, or None'''
+        node = self.root
+        match = node[self.VALUE]
+        
+        for depth in xrange(32):
+            node = node[self._bit(naddr, depth)]
+            if node is None:
+                break
+            if node[self.VALUE] is not None:
+                match = node[self.VALUE]
+            
+        return match
+
+        
 # # # # # # # # # # # # # # # # # # # 
 #  Validators
 # # # # # # # # # # # # # # # # # # # 
@@ -120,19 +279,10 @@ class IpAddress(object):
     
     @property
     def nsubnet(self):
-        if self._subnet is None:
-            
-            session = object_session(self)
-            assert session is not None, "Object must have session to perform query"
-            
-            sql_netmask = func.power(2,32) - func.power(2, (32-schema.Subnet.mask_len))
-            
-            self._subnet = session.query(Subnet)\
-                    .filter( schema.Subnet.addr == sql_netmask.op('&')(self.nvalue) )\
-                    .order_by( schema.Subnet.mask_len.desc() )\
-                    .first()
+        if self.__dict__.get('_subnet') is None:
+            self.__dict__['_subnet'] = self.query_subnet()
     
-        return self._subnet
+        return self.__dict__['_subnet']
     #
     # Methods
     #   
@@ -141,16 +291,15 @@ class IpAddress(object):
   
       
     def query_subnet(self):
+        '''Find the Subnet with the longest prefix containing this address'''
         session = object_session(self)
         assert session is not None, "Object must have session to perform query"
         
-        sql_netmask = func.power(2,32) - func.power(2, (32-schema.Subnet.mask_len))
-        
-        q = session.query(schema.Subnet)\
-                .filter( schema.Subnet.addr == sql_netmask.op('&')(self.nvalue) )\
-                .order_by( schema.Subnet.mask_len.desc() )
-                
-        return q.first()
+        subnet_id = session.subnet_index.lookup(self.nvalue)
+        if subnet_id is None:
+            return None
+            
+        return session.query(schema.Subnet).get(subnet_id)
   
     @staticmethod
     def int2bin(n, count=32):
@@ -210,6 +359,14 @@ class Subnet(object):
     @property
     def broadcast(self):
         return (self.naddr + (~self.nmask & 0xFFFFFFFF)) 
+    
+    @classmethod
+    def create_prefix_index(cls, session):
+        '''Create a PrefixIndex of the id of every Subnet in the database'''
+        index = PrefixIndex()
+        for (id, addr, mask_len) in session.query(cls.id, cls.addr, cls.mask_len):
+            index.insert(IpType.aton(addr), mask_len, id)
+        return index
         
     #
     # Methods
@@ -225,32 +382,37 @@ class Subnet(object):
             raise ValueError("method contains takes { IpAddress | int | str }, not %s" % type(address))
 
     
+    def naddr_runs(self):
+        """ return the host addresses of the subnet as AddressRuns """
+        first = (self.naddr & self.nmask) + 1        
+        last = self.broadcast - 1
+        return AddressRuns([ (first, last) ])
+        
     def naddr_set(self):
         """ return a set of integers representing IP addresses """
-                
-        first = (self.naddr & self.nmask) + 1        
-        last = self.broadcast
-        return set( range(first, last) )
+        return set( self.naddr_runs() )
 
     def size(self):
         first = (self.naddr & self.nmask) + 1        
         last = self.broadcast        
         return last - first + 1
         
-        
-    def avail_ip_set(self):
+    def avail_ip_runs(self):
+        """ return the unallocated addresses of the subnet as AddressRuns """
         if len(self.children) > 0:
             raise ModelError("Cannot get available IP set from Non-Leaf subnet")
         
-        ip_set = self.naddr_set()
-                
-        for r in self.ranges:
-            ip_set -= r.naddr_set()
-                    
-        for ip in self.addresses:
-            ip_set -= ip.naddr
-
-        return ip_set
+        used = [ (r.start_naddr, r.end_naddr) for r in self.ranges ]
+        used.extend([ (ip.nvalue, ip.nvalue) for ip in self.addresses ])
+        
+        return self.naddr_runs().subtract(AddressRuns(used))
+        
+    def avail_ip_set(self):
+        return set( self.avail_ip_runs() )
+        
+    def avail_ips(self, count):
+        """ return a sorted list of the first <count> available addresses """
+        return self.avail_ip_runs().first(count)
         
 class Range(object):
     TYPES = ('dhcp', 'policy')
@@ -320,33 +482,23 @@ class Range(object):
     end_naddr = property(_get_end_naddr, _set_end_naddr)
     
 
+    def naddr_runs(self):
+        return AddressRuns([ (self.start_naddr, self.end_naddr) ])
+        
     def naddr_set(self):
-        start = self.subnet.naddr + self.start
-        end = self.subnet.naddr + self.end + 1
-        return set( range(start, end) )
+        return set( self.naddr_runs() )
         
     def size(self):
-        start = self.subnet.naddr + self.start
-        end = self.subnet.naddr + self.end + 1
-        return end - start + 1
+        return self.naddr_runs().size()
         
     def contains(self, arg):
-        naddr_set = self.naddr_set()        
-        
-        if isinstance(arg, int):
-            return arg in naddr_set
+        if isinstance(arg, (int, long)):
+            naddr = arg
         elif isinstance(arg, basestring):
-            return IpType.aton(arg) in naddr_set
+            naddr = IpType.aton(arg)
         elif isinstance(arg, schema.IpAddress):
-            return arg.nvalue in naddr_set
+            naddr = arg.nvalue
         else:
             raise ModelArgumentError("Argument to contains must be a str or int")
-
-        
-        
-        
-        
-        
-        
-        
-        
\ No newline at end of file
+            
+        return self.naddr_runs().contains(naddr)
@@ -30,7 +30,7 @@ __entity_collection__ = entity_set = collection.EntityCollection()
 __metadata__ = metadata = MetaData()
 
 
-SCHEMA_VERSION = 0x020110 # 020109 == 2.1.9
+SCHEMA_VERSION = 0x020111 # 020109 == 2.1.9, see dino.db.upgrade
 
 class SchemaInfo(elixir.Entity):    
     #
@@ -125,7 +125,7 @@ class Device(Element, model.Device):
     # Relationships
     #
     host = OneToOne('Host', cascade='all')    
-    ports = OneToMany('Port', cascade='all, delete-orphan') #, collection_class=IndexedList.factory('name'))
+    ports = OneToMany('Port', cascade='all, delete-orphan', collection_class=IndexedList.factory('name'))
     rack = ManyToOne('Rack', required=True, lazy=False)
     
     
@@ -174,12 +174,15 @@ class Port(Element):
     @property
     def interface(self):
         if self.device.host:       
-            for iface in self.device.host.interfaces:
-                if iface.port_name == self.name:
-                    return iface          
+            return self.device.host.interfaces.get(self.name)
         
         return None
 
+    @validates('name')
+    def validate_name(self, key, value):
+        IndexedList.rekey_parent(self, 'device', 'ports')
+        return value
+
     def derive_name(self):
         return "%s_%s" % (self.mac, self.name)
 
@@ -226,7 +229,7 @@ class Host(Element):
     # Relationships
     #
     device = ManyToOne('Device', lazy=False)   
-    interfaces = OneToMany('Interface', cascade='all, delete-orphan') #, collection_class=IndexedList.factory('port_name'))
+    interfaces = OneToMany('Interface', cascade='all, delete-orphan', collection_class=IndexedList.factory('port_name'))
 
     pod = ManyToOne('Pod', required=True, lazy=False)
     appliance = ManyToOne('Appliance')    
@@ -288,11 +291,14 @@ class Interface(Element):
     @property
     def port(self):
         if self.host.device:
-            for port in self.host.device.ports:
-                if port.name == self.port_name:
-                    return port
+            return self.host.device.ports.get(self.port_name)
                     
         return None        
+
+    @validates('port_name')
+    def validate_port_name(self, key, value):
+        IndexedList.rekey_parent(self, 'host', 'interfaces')
+        return value
         
     def name(self):
         if self.ifindex:
@@ -24,11 +24,15 @@ class ElementSession(changeset.ChangeSetSession):
     
     def __init__(self, *args, **kwargs):
         self.entity_set = kwargs['entity_set'] 
-        cache = kwargs.pop('element_name_cache', False)
+        cache_size = kwargs.pop('element_cache_size', 0)
         
         self.rename_elements = []
         
-        self.element_cache = None
+        if cache_size:
+            self.element_cache = ElementCache(cache_size)
+        else:
+            self.element_cache = None
+        self._subnet_index = None
             
         kwargs['weak_identity_map'] = False
         changeset.ChangeSetSession.__init__(self, *args, **kwargs)
@@ -39,7 +43,9 @@ class ElementSession(changeset.ChangeSetSession):
     
     def commit(self):
         while self.rename_elements:
-            self.rename_elements.pop().update_name()
+            instance = self.rename_elements.pop()
+            self.cache_delete(instance, "rename")
+            instance.update_name()
         
         try:   
             changeset.ChangeSetSession.commit(self)
@@ -47,6 +53,12 @@ class ElementSession(changeset.ChangeSetSession):
         except sa_exc.DatabaseError, e:
             raise DatabaseError("Error during commit", e)
             
+    def rollback(self):
+        # Index / Cache may hold Elements that were never committed
+        self._subnet_index = None
+        if self.element_cache is not None:
+            self.element_cache.clear()
+        changeset.ChangeSetSession.rollback(self)
     
     def create_change_description(self):
         return ChangeDescription(self)    
@@ -88,9 +100,9 @@ class ElementSession(changeset.ChangeSetSession):
         
         self.log.fine("Resolve Instance: %s" % element_spec.object_name)
         
-        if self.element_cache and element_spec.object_name in self.element_cache:
-            self.log.fine("  Found in ElementCache")
-            return self.element_cache[element_spec.object_name]   
+        instance = self._cache_get(element_spec)
+        if instance is not None:
+            return instance
         
         return element_spec.resolve(self).next()
 
@@ -104,9 +116,9 @@ class ElementSession(changeset.ChangeSetSession):
         
         self.log.fine("Find Instance: %s" % element_spec.object_name)
         
-        if self.element_cache and element_spec.object_name in self.element_cache:
-            self.log.fine("  Found in ElementCache")
-            return self.element_cache[element_spec.object_name]  
+        instance = self._cache_get(element_spec)
+        if instance is not None:
+            return instance
         
         try:
             return element_spec.resolve(self).next()
@@ -127,48 +139,189 @@ class ElementSession(changeset.ChangeSetSession):
         return obj_query.create_query(self).all()
 
 
+    def _cache_get(self, element_spec):
+        if self.element_cache is None:
+            return None
+        
+        instance = self.element_cache.get(element_spec.object_name)
+        if instance is None:
+            return None
+        
+        # Expunged from this session since it was cached
+        if instance not in self:
+            self.element_cache.discard(instance)
+            return None
+            
+        self.log.fine("  Found in ElementCache")
+        return instance
+        
     def cache_add(self, instance, info=""):
         if self.element_cache is None:
             return 
         
-        self.log.info("CACHE START ADD: %s", instance.object_id)
-        if instance.element_name not in self.element_cache:
-            self.log.info("  Add to ElementCache (%s) %s" % (info, str(instance)))
-            #self.element_cache[instance.element_name] = instance
-            
-        if instance.object_id not in self.element_cache: 
-            self.log.info("  Add to ElementIdCache (%s) %s" % (info, str(instance)))                                         
-            #self.element_cache[instance.object_id] = instance       
-
-        self.log.info("CACHE END ADD: %s", instance.object_id)
+        self.log.finer("  Add to ElementCache (%s) %s", info, instance.element_name)
+        self.element_cache.add(instance)
 
     def cache_delete(self, instance, info=""):
         if self.element_cache is None:
             return 
         
-        self.log.info("CACHE START DELETE: %s", instance.object_id)
+        self.log.finer("  Delete from ElementCache (%s) %s", info, instance.element_name)
+        self.element_cache.discard(instance)
 
-        if instance.element_name in self.element_cache:
-            del self.element_cache[instance.element_name]
-            
-        if instance.object_id in self.element_cache:
-            del self.element_cache[instance.object_id]
-
-        self.log.info("CACHE END DELETE: %s", instance.object_id)
 
+    @property
+    def subnet_index(self):
+        ''' PrefixIndex of all Subnet ids, used for longest-prefix-match of addresses.
+        Loaded on first use, then kept in sync by subnet_index_update / subnet_index_delete
+        '''
+        if self._subnet_index is None:
+            self.log.fine("Loading Subnet PrefixIndex")
+            self._subnet_index = self.resolve_entity("Subnet").create_prefix_index(self)
+        return self._subnet_index
+        
+    def _is_subnet(self, instance):
+        return self.entity_set.has_entity("Subnet") and isinstance(instance, self.resolve_entity("Subnet"))
+    
+    def subnet_index_update(self, instance):
+        if self._subnet_index is None or not self._is_subnet(instance):
+            return
+        self._subnet_index.insert(instance.naddr, instance.mask_len, instance.id)
+        
+    def subnet_index_delete(self, instance):
+        if self._subnet_index is None or not self._is_subnet(instance):
+            return
+        self._subnet_index.discard(instance.id)
+        
 
     class ElementSessionExtension(sqlalchemy.orm.session.SessionExtension):             
+        
+        # Max number of names in a single IN (...) clause
+        QUERY_CHUNK_SIZE = 500
+        
         def before_flush(self, session, flush_context, instances):
             from dino.db.element import Element
+            
+            # class -> { instance_name : element }
+            # Check the derived name, which is what the insert will store 
+            new_elements = {}
             for element in session.new:
-                if isinstance(element, Element):
-                    if session.query(element.__class__).filter_by(instance_name=element.instance_name).count() > 0:
-                        raise ElementExistsError("Element already exists: %s" % element.element_name)
+                if not isinstance(element, Element):
+                    continue
+                
+                instance_name = element.derive_name()
+                if instance_name is None:
+                    continue
+                
+                names = new_elements.setdefault(element.__class__, {})
+                if instance_name in names:
+                    raise ElementExistsError("Element already exists: %s" % element.derive_element_name())
+                names[instance_name] = element
+            
+            for (cls, names) in new_elements.iteritems():
+                name_list = names.keys()
+                for i in xrange(0, len(name_list), self.QUERY_CHUNK_SIZE):
+                    chunk = name_list[i:i + self.QUERY_CHUNK_SIZE]
+                    query = session.query(cls._instance_name).filter(cls._instance_name.in_(chunk)).limit(1)
+                    for (instance_name,) in query:
+                        raise ElementExistsError("Element already exists: %s" % names[instance_name].derive_element_name())
 
 
 class_logger(ElementSession)
 
 
+class ElementCache(object):
+    ''' Bounded cache of Element instances, keyed by both element_name and element_id. 
+    When full, the least recently used instance is evicted. 
+    '''
+    
+    # Link layout: [ prev, next, instance, keys ]
+    PREV, NEXT, INSTANCE, KEYS = 0, 1, 2, 3
+    
+    def __init__(self, max_size=1000):
+        assert max_size > 0, "ElementCache max_size must be positive"
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.clear()
+        
+    def clear(self):
+        # Circular list, root.NEXT is most recently used
+        self._root = root = []
+        root[:] = [ root, root, None, () ]
+        self._links = {}   # id(instance) -> link
+        self._keys = {}    # key -> link
+        
+    def __len__(self):
+        return len(self._links)
+
+    def __contains__(self, key):
+        return key in self._keys
+
+    def get(self, key):
+        link = self._keys.get(key)
+        if link is None:
+            self.misses += 1
+            return None
+        
+        self.hits += 1
+        self._move_to_front(link)
+        return link[self.INSTANCE]
+            
+    def add(self, instance):
+        keys = tuple([ k for k in (instance.element_name, instance.element_id) if k is not None ])
+        
+        link = self._links.get(id(instance))
+        if link is None:
+            root = self._root
+            link = [ root, root[self.NEXT], instance, () ]
+            root[self.NEXT][self.PREV] = link
+            root[self.NEXT] = link
+            self._links[id(instance)] = link
+        else:
+            self._move_to_front(link)
+        
+        # Drop keys from before a rename 
+        for key in link[self.KEYS]:
+            if key not in keys and self._keys.get(key) is link:
+                del self._keys[key]
+        
+        for key in keys:
+            other = self._keys.get(key)
+            if other is not None and other is not link:
+                self._unlink(other)
+            self._keys[key] = link
+        link[self.KEYS] = keys
+        
+        while len(self._links) > self.max_size:
+            self._unlink(self._root[self.PREV])
+            
+    def discard(self, instance):
+        link = self._links.get(id(instance))
+        if link is not None:
+            self._unlink(link)
+            
+    def _move_to_front(self, link):
+        root = self._root
+        if root[self.NEXT] is link:
+            return
+        link[self.PREV][self.NEXT] = link[self.NEXT]
+        link[self.NEXT][self.PREV] = link[self.PREV]
+        link[self.PREV] = root
+        link[self.NEXT] = root[self.NEXT]
+        root[self.NEXT][self.PREV] = link
+        root[self.NEXT] = link
+        
+    def _unlink(self, link):
+        link[self.PREV][self.NEXT] = link[self.NEXT]
+        link[self.NEXT][self.PREV] = link[self.PREV]
+        del self._links[id(link[self.INSTANCE])]
+        for key in link[self.KEYS]:
+            if self._keys.get(key) is link:
+                del self._keys[key]
+        link[:] = [ None, None, None, () ]
+
+
 class ChangeDescription(list):    
     def __init__(self, session):
         for inst in session.new:
@@ -0,0 +1,278 @@
+'''
+Logical snapshot of a database (dino admin snapshot / restore)
+
+Every table of the metadata, head and revision tables alike, is written
+to a directory, one file per table:
+
+    <dir>/MANIFEST        json: format, schema version, the tables in 
+                          dependency order and their row counts
+    <dir>/<table>.snap    the column names and value types, then blocks of 
+                          up to BLOCK_ROWS rows, each a list of columns. 
+                          Each is json, zlib compressed, after its length 
+                          (32 bit LE)
+
+Values are read and written through the column types, so a snapshot
+can be restored into another database engine (eg. MySQL to SQLite).
+Values json has no type for (dates and times) are written as strings 
+and converted back by the type recorded for their column. Nothing in a 
+snapshot is executed when it is read.
+
+A snapshot is only restored into the schema version it was taken from.
+The schema_info row of the target is restored with its own 'protected'
+flag, so a copy of a protected database can still be written to.
+'''
+import datetime
+import logging
+import os
+import struct
+import time
+import zlib
+from os.path import join as pjoin
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from sqlalchemy import select, types
+
+from dino.db.exception import SnapshotError
+from dino.db.schema import SCHEMA_VERSION
+
+FORMAT = 2
+MANIFEST = "MANIFEST"
+SUFFIX = ".snap"
+
+BLOCK_ROWS = 10000
+COMPRESS_LEVEL = 6
+
+SCHEMA_INFO_TABLE = "schema_info"
+
+# Column type -> (name, to string, from string) of the values json cannot hold
+DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
+TIME_FORMAT = "%H:%M:%S.%f"
+VALUE_TYPES = (
+    (types.DateTime, 'datetime', 
+        lambda v: v.strftime(DATETIME_FORMAT), lambda s: datetime.datetime.strptime(s, DATETIME_FORMAT)),
+    (types.Date, 'date', 
+        lambda v: v.strftime("%Y-%m-%d"), lambda s: datetime.datetime.strptime(s, "%Y-%m-%d").date()),
+    (types.Time, 'time', 
+        lambda v: v.strftime(TIME_FORMAT), lambda s: datetime.datetime.strptime(s, TIME_FORMAT).time()),
+)
+DECODERS = dict([ (name, decode) for (type_, name, encode, decode) in VALUE_TYPES ])
+
+log = logging.getLogger("dino.db.snapshot")
+
+
+def sorted_tables(metadata_set):
+    ''' The tables of every metadata, referenced tables first '''
+    tables = []
+    for md in metadata_set:
+        tables.extend(md.sorted_tables)
+    return tables
+
+
+def value_type(column):
+    ''' (name, encode) of the conversion the values of column need, or (None, None) '''
+    for (type_, name, encode, decode) in VALUE_TYPES:
+        if isinstance(column.type, type_):
+            return (name, encode)
+    return (None, None)
+
+
+def convert(values, fn):
+    ''' fn of each value that is not None '''
+    result = []
+    for v in values:
+        if v is not None:
+            v = fn(v)
+        result.append(v)
+    return result
+
+
+def write_block(f, value):
+    data = zlib.compress(json.dumps(value, separators=(',', ':')), COMPRESS_LEVEL)
+    f.write(struct.pack('<L', len(data)))
+    f.write(data)
+
+
+def write_table(connection, table, path):
+    ''' Write the rows of table to path, returns the row count '''
+    value_types = [ value_type(c) for c in table.c ]
+    
+    f = open(path, 'wb')
+    try:
+        write_block(f, { 'columns' : [ c.key for c in table.c ], 
+                         'types' : [ name for (name, encode) in value_types ] })
+
+        count = 0
+        result = connection.execute(select(list(table.c)).order_by(*list(table.primary_key)))
+        while True:
+            rows = result.fetchmany(BLOCK_ROWS)
+            if not rows:
+                break
+            
+            columns = zip(*rows)
+            for (i, (name, encode)) in enumerate(value_types):
+                if encode is not None:
+                    columns[i] = convert(columns[i], encode)
+            write_block(f, columns)
+            count += len(rows)
+    finally:
+        f.close()
+    return count
+
+
+def read_table(path):
+    ''' The header, then each block of columns, of a table file '''
+    f = open(path, 'rb')
+    try:
+        while True:
+            header = f.read(4)
+            if not header:
+                return
+            (length,) = struct.unpack('<L', header)
+            data = f.read(length)
+            if len(data) != length:
+                raise SnapshotError("Truncated snapshot file: %s" % path)
+            try:
+                yield json.loads(zlib.decompress(data))
+            except (zlib.error, ValueError), e:
+                raise SnapshotError("Corrupt snapshot file: %s: %s" % (path, e))
+    finally:
+        f.close()
+
+
+def restore_table(connection, table, path):
+    ''' Insert the rows of a table file, one executemany per block. Returns the row count '''
+    blocks = read_table(path)
+    header = blocks.next()
+    columns = [ str(c) for c in header['columns'] ]
+    unknown = [ c for c in columns if c not in table.c ]
+    if unknown:
+        raise SnapshotError("Columns not in table %s: %s" % (table.name, ", ".join(unknown)))
+    
+    decoders = []
+    for name in header['types']:
+        if name is not None and name not in DECODERS:
+            raise SnapshotError("Unknown value type in %s: %s" % (path, name))
+        decoders.append(DECODERS.get(name))
+
+    insert = table.insert()
+    count = 0
+    for block in blocks:
+        for (i, decode) in enumerate(decoders):
+            if decode is not None:
+                block[i] = convert(block[i], decode)
+        rows = [ dict(zip(columns, row)) for row in zip(*block) ]
+        connection.execute(insert, rows)
+        count += len(rows)
+    return count
+
+
+def snapshot(connection, metadata_set, path):
+    ''' Write every table to the directory path. Returns the manifest '''
+    if not os.path.isdir(path):
+        os.makedirs(path)
+
+    manifest = { 'format' : FORMAT, 'schema_version' : SCHEMA_VERSION, 'created' : time.time(), 'tables' : [] }
+
+    # All tables are read in one transaction
+    trans = connection.begin()
+    try:
+        for table in sorted_tables(metadata_set):
+            start = time.time()
+            count = write_table(connection, table, pjoin(path, table.name + SUFFIX))
+            manifest['tables'].append({ 'name' : table.name, 'rows' : count })
+            log.info("Snapshot %s: %d rows %.2fs", table.name, count, time.time() - start)
+    finally:
+        trans.rollback()
+
+    f = open(pjoin(path, MANIFEST), 'w')
+    f.write(json.dumps(manifest, indent=4))
+    f.close()
+    return manifest
+
+
+def load_manifest(path):
+    manifest_file = pjoin(path, MANIFEST)
+    if not os.path.exists(manifest_file):
+        raise SnapshotError("Not a snapshot: %s" % path)
+
+    f = open(manifest_file)
+    manifest = json.loads(f.read())
+    f.close()
+
+    if manifest.get('format') != FORMAT:
+        raise SnapshotError("Unknown snapshot format: %s" % manifest.get('format'))
+    if manifest.get('schema_version') != SCHEMA_VERSION:
+        raise SnapshotError("Snapshot of schema version %s, the schema is version %s" % 
+                            (manifest.get('schema_version'), SCHEMA_VERSION))
+    return manifest
+
+
+def read_protected(connection, table):
+    ''' The protected flag of a schema_info table (False without a row) '''
+    row = connection.execute(select([ table.c.protected ])).fetchone()
+    return row is not None and bool(row[0])
+
+
+def set_protected(connection, tables, protected):
+    ''' Set the protected flag of the schema_info row and its current revision '''
+    info = tables[SCHEMA_INFO_TABLE]
+    connection.execute(info.update(values={ 'protected' : protected }))
+    
+    revision = tables.get(SCHEMA_INFO_TABLE + "_revision")
+    if revision is not None:
+        connection.execute(revision.update(revision.c.changeset_invalid_id == None, values={ 'protected' : protected }))
+
+
+def restore(connection, metadata_set, path):
+    '''
+    Replace the rows of every table with the snapshot in the directory 
+    path, in one transaction. Missing tables are created first. Foreign 
+    key checks are off while the rows are inserted (MySQL). The row count
+    of each table is checked against the manifest, and the target keeps
+    its protected flag. Returns the manifest.
+    '''
+    manifest = load_manifest(path)
+
+    tables = dict([ (t.name, t) for t in sorted_tables(metadata_set) ])
+    missing = [ t['name'] for t in manifest['tables'] if not tables.has_key(t['name']) ]
+    if missing:
+        raise SnapshotError("Tables not in the schema: %s" % ", ".join(missing))
+
+    # DDL commits in MySQL, before the restore transaction
+    for md in metadata_set:
+        md.create_all(connection)
+
+    mysql = connection.engine.name == 'mysql'
+    if mysql:
+        connection.execute("SET FOREIGN_KEY_CHECKS = 0")
+    try:
+        trans = connection.begin()
+        try:
+            protected = tables.has_key(SCHEMA_INFO_TABLE) and read_protected(connection, tables[SCHEMA_INFO_TABLE])
+            
+            # referencing tables first
+            for table in reversed(sorted_tables(metadata_set)):
+                connection.execute(table.delete())
+
+            for entry in manifest['tables']:
+                start = time.time()
+                table = tables[entry['name']]
+                count = restore_table(connection, table, pjoin(path, table.name + SUFFIX))
+                if count != entry['rows']:
+                    raise SnapshotError("Restored %d rows of %s, the snapshot has %d" % (count, table.name, entry['rows']))
+                log.info("Restore %s: %d rows %.2fs", table.name, count, time.time() - start)
+
+            if tables.has_key(SCHEMA_INFO_TABLE):
+                set_protected(connection, tables, protected)
+            trans.commit()
+        except:
+            trans.rollback()
+            raise
+    finally:
+        if mysql:
+            connection.execute("SET FOREIGN_KEY_CHECKS = 1")
+
+    return manifest
@@ -0,0 +1,76 @@
+'''
+Schema upgrades of an existing database (dino admin upgrade)
+
+createall builds a new database at SCHEMA_VERSION. A database created by
+an older version is brought to it by the steps of UPGRADES, run in order:
+
+    <from version> : (<to version>, <function(connection, metadata_set)>)
+
+A step only changes the tables; the new version is then recorded in
+schema_info by DbConfig.upgrade. Steps check what exists before they
+change it, so a step that was interrupted can be run again.
+'''
+import logging
+
+import sqlalchemy.schema
+
+from dino.db.exception import UpgradeError
+from dino.db.schema import SCHEMA_VERSION
+
+
+log = logging.getLogger("dino.db.upgrade")
+
+
+def index_names(connection, table):
+    ''' The names of the indexes of a table in the database '''
+    if connection.dialect.name == 'sqlite':
+        return set([ row[1] for row in connection.execute("PRAGMA index_list(%s)" % table.name) ])
+    return set([ row[2] for row in connection.execute("SHOW INDEX FROM %s" % table.name) ])
+
+def revision_tables(metadata_set):
+    for md in metadata_set:
+        for table in md.sorted_tables:
+            if table.name.endswith("_revision"):
+                yield table
+
+#
+# 2.1.10 -> 2.1.11
+#
+def upgrade_revision_indexes(connection, metadata_set):
+    ''' Add ix_<table>_validity (head_id, changeset_id, changeset_invalid_id)
+    to the revision tables. It serves the head_id lookups too, so the
+    single column ix_<table>_head_id is dropped '''
+    for table in revision_tables(metadata_set):
+        existing = index_names(connection, table)
+
+        validity_name = "ix_%s_validity" % table.name
+        if validity_name not in existing:
+            log.info("Create Index: %s", validity_name)
+            [ index for index in table.indexes if index.name == validity_name ][0].create(bind=connection)
+
+        head_name = "ix_%s_head_id" % table.name
+        if head_name in existing:
+            log.info("Drop Index: %s", head_name)
+            # not attached to the table: the model has no such index
+            head_index = sqlalchemy.schema.Index(head_name)
+            head_index.table = table
+            head_index.drop(bind=connection)
+
+
+UPGRADES = {
+    0x020110 : (0x020111, upgrade_revision_indexes),
+}
+
+def upgrade(connection, metadata_set, version):
+    ''' Run the steps from version to SCHEMA_VERSION. Returns the versions
+    upgraded from, in order '''
+    steps = []
+    while version != SCHEMA_VERSION:
+        if version not in UPGRADES:
+            raise UpgradeError("No upgrade from schema version 0x%08x to 0x%08x" % (version, SCHEMA_VERSION))
+        (next_version, step) = UPGRADES[version]
+        log.info("Upgrade: 0x%08x -> 0x%08x", version, next_version)
+        step(connection, metadata_set)
+        steps.append(version)
+        version = next_version
+    return steps
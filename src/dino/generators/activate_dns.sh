@@ -58,10 +58,17 @@ echo "Copying generated config $DNS_DATA_SOURCE_FILE to $DNS_DATA_FILE"
 cp -f $DNS_DATA_SOURCE_FILE $DNS_DATA_FILE || exit 1
 cd $DNS_ROOT
 
-# update the data.cdb file by running tinydns-data
-echo "Updating tinydns data file"
+# update the data.cdb file, with the one compiled by the generator
+# (dns_compile_cdb) if there is one, otherwise by running tinydns-data
 cd $DNS_ROOT/root
-tinydns-data || exit 1
+if [[ "$DNS_DATA_CDB_SOURCE_FILE" != "" ]]; then
+  echo "Installing compiled $DNS_DATA_CDB_SOURCE_FILE"
+  cp -f $DNS_DATA_CDB_SOURCE_FILE data.cdb.tmp || exit 1
+  mv -f data.cdb.tmp data.cdb || exit 1
+else
+  echo "Updating tinydns data file"
+  tinydns-data || exit 1
+fi
 
 # restart services
 echo "Restarting services"
@@ -2,10 +2,12 @@ import sys
 import os
 import subprocess
 import logging, traceback
+import hashlib
 from optparse import OptionParser
 from os.path import join as pjoin
 
 import sqlalchemy.exc as sa_exc
+from sqlalchemy import and_, or_, func, select
 
 from dino.exception import DinoException
 import dino.basecli
@@ -62,18 +64,41 @@ class GeneratorMeta(type):
         
         cls.activate = cls.activate_decorator(cls.activate)
          
-        if cls.NAME is None:
+        # NAME None (abstract) or REGISTER False (eg. in tests): not listed or run by name
+        if cls.NAME is None or not cls.REGISTER:
             return        
         else:
             cls.MAP[cls.NAME] = cls
     
     def activate_decorator(cls, fn):
         def new_activate(self):
-            if not int(self.settings.disable_activate):
-                return fn(self)
-            else:
+            if int(self.settings.disable_activate):
                 self.log.info("Activate is disabled")
                 return None
+            
+            # None: no manifest was saved, or a full run (eg. the target was 
+            # rebuilt): activate everything
+            if self.full:
+                self.manifest = None
+            else:
+                self.manifest = self.load_manifest()
+            if self.manifest is not None and len(self.manifest) == 0:
+                self.log.info("activate: nothing changed since the last activate")
+                return None
+            
+            if self.profile is None:
+                result = fn(self)
+            else:
+                self.profile.attach(self.db_config.engine)
+                self.profile.phase('activate')
+                try:
+                    result = fn(self)
+                finally:
+                    self.profile.stop()
+                    self.profile.detach()
+                    
+            self.clear_manifest()
+            return result
                 
         new_activate.__doc__ = fn.__doc__
         new_activate.__name__ = fn.__name__
@@ -83,6 +108,7 @@ class Generator(object):
     __metaclass__ = GeneratorMeta
         
     PROG_NAME = "dino"
+    REGISTER = True
     
     #
     # Default/Abstract Instance Methods
@@ -91,6 +117,13 @@ class Generator(object):
         self.db_config = db_config                    
         self.settings = dino.config.load_config(section="generate")
         self.workdir = pjoin(self.settings.workdir, self.NAME)
+        # Kept next to (not in) the workdir, so setup_dir() does not wipe it
+        self.state_file = pjoin(self.settings.workdir, "%s.state" % self.NAME)
+        self.manifest_file = pjoin(self.settings.workdir, "%s.manifest" % self.NAME)
+        self.manifest = None
+        self.full = False
+        # GeneratorProfile, when run with generate --profile
+        self.profile = None
    
     @classmethod
     def find_generator_class(cls, name):
@@ -134,6 +167,12 @@ class Generator(object):
     def activate(self): 
         raise NotImplementedError("_activate")
 
+    def phase(self, name):
+        """ Start a named phase of generate() (eg. query, render, write), 
+        it lasts until the next one. Only recorded with --profile """
+        if self.profile is not None:
+            self.profile.phase(name)
+
 
 
     # helper methods for (un)setting a lock during generation and activation
@@ -177,6 +216,255 @@ class Generator(object):
             self.log.error('cannot unlock previously locked %s' % lock_file)
             raise   
 
+    #
+    # Incremental runs
+    #
+    # A generator that supports incremental runs saves the id of the newest
+    # ChangeSet it generated from (plus a fingerprint of the settings and
+    # schema version) in its state file. The next run only has to regenerate
+    # what the revision tables say the ChangeSets submitted since then changed.
+    #
+    # ChangeSet ids are handed out when a changeset is opened, not when it
+    # is submitted, so a lower id can be submitted after a higher one. The
+    # ids up to PENDING_WINDOW below the newest one that were not submitted
+    # yet are kept in the state as 'pending', and picked up once they are.
+    #
+    # pxe and rapids write a file per Host and run incrementally. dns and 
+    # dhcp write a single file from every Host of the site, so they always 
+    # run in full; OutputWriter keeps them from touching unchanged output.
+    #
+    # (entity, revision column, what the column refers to)
+    HOST_CHANGE_COLUMNS = (
+        ('Host', 'head_id', 'host'),
+        ('Device', 'head_id', 'device'),
+        ('Port', 'device_id', 'device'),
+        ('Interface', 'host_id', 'host'),
+        ('IpAddress', 'interface_id', 'interface'),
+        ('Subnet', 'head_id', 'subnet'),
+        ('SshKeyInfo', 'host_id', 'host'),
+        ('Rack', 'head_id', 'rack'),
+    )
+    PENDING_WINDOW = 1000
+    QUERY_CHUNK_SIZE = 500
+
+    def fingerprint(self):
+        """ Hash of everything besides the database that the output depends on """
+        from dino.db.schema import SCHEMA_VERSION
+        h = hashlib.sha1()
+        h.update("schema=%s\n" % SCHEMA_VERSION)
+        for (name, value) in sorted(self.settings.items()):
+            h.update("%s=%s\n" % (name, value))
+        return h.hexdigest()
+
+    def load_state(self):
+        """ State saved by the last run, or None if the next run must be a full run """
+        if self.full:
+            self.log.info("Full run requested")
+            return None
+
+        if not os.path.exists(self.state_file) or not os.path.isdir(self.workdir):
+            self.log.info("No previous run found: full run")
+            return None
+
+        import yaml
+        f = open(self.state_file, 'r')
+        try:
+            state = yaml.safe_load(f)
+        finally:
+            f.close()
+
+        if not isinstance(state, dict) or state.get('changeset') is None:
+            self.log.info("Unreadable state file %s: full run", self.state_file)
+            return None
+
+        if state.get('fingerprint') != self.fingerprint():
+            self.log.info("Settings or schema version changed: full run")
+            return None
+
+        return state
+
+    def save_state(self, changeset, **kwargs):
+        import yaml
+        state = dict(kwargs)
+        state['changeset'] = changeset
+        state['fingerprint'] = self.fingerprint()
+
+        # write then rename, a crash must not leave a truncated state file
+        tmp_file = self.state_file + ".tmp"
+        f = open(tmp_file, 'w')
+        try:
+            yaml.safe_dump(state, stream=f)
+        finally:
+            f.close()
+        os.rename(tmp_file, self.state_file)
+
+    def scan_changesets(self, session, state=None):
+        """ (changeset, pending, ids) from the ChangeSet log:
+        changeset   id of the newest submitted ChangeSet (0 if there is none)
+        pending     ids in the PENDING_WINDOW below it that are not submitted
+        ids         ids submitted since the run that saved state (None without state)
+        """
+        ChangeSet = session.resolve_entity("ChangeSet")
+        submitted = ChangeSet.committed != None
+        
+        changeset = session.query(func.max(ChangeSet.id)).filter(submitted).scalar() or 0
+        
+        ids = None
+        if state is not None:
+            last = state['changeset']
+            ids = set([ id for (id,) in session.query(ChangeSet.id).filter(submitted).filter(ChangeSet.id > last) ])
+            ids.update(self._select_in(session, ChangeSet.id, ChangeSet.id, state.get('pending', ()), submitted))
+        
+        low = max(changeset - self.PENDING_WINDOW, 0)
+        recent = set([ id for (id,) in session.query(ChangeSet.id).filter(submitted).filter(ChangeSet.id > low) ])
+        pending = [ id for id in xrange(low + 1, changeset + 1) if id not in recent ]
+        
+        return (changeset, pending, ids)
+
+    def changed_hosts(self, session, changeset_ids):
+        """ Ids of the Hosts whose Device, Ports, Interfaces, IpAddresses,
+        Subnets, SshKeyInfo or Rack were added, deleted or modified by the 
+        given changesets.
+
+        Ids of deleted Hosts are included, so their output can be removed.
+        """
+        changed = { 'host' : set(), 'device' : set(), 'interface' : set(), 'subnet' : set(), 'rack' : set() }
+        
+        changeset_ids = list(changeset_ids)
+        connection = session.connection()
+        for (name, column_name, kind) in self.HOST_CHANGE_COLUMNS:
+            c = session.resolve_entity(name).Revision.table.c
+            
+            # The rows a changeset created hold the new values, the rows 
+            # it invalidated the old ones
+            for i in xrange(0, len(changeset_ids), self.QUERY_CHUNK_SIZE):
+                chunk = changeset_ids[i:i + self.QUERY_CHUNK_SIZE]
+                stmt = select([ c[column_name] ], or_(c.changeset_id.in_(chunk), c.changeset_invalid_id.in_(chunk)))
+                changed[kind].update([ row[0] for row in connection.execute(stmt) ])
+        
+        (Host, Device, Interface, IpAddress) = [ session.resolve_entity(name) 
+                                                 for name in ('Host', 'Device', 'Interface', 'IpAddress') ]
+
+        # Walk the changes up to the Hosts they belong to
+        host_ids = changed['host']
+        changed['device'].update(self._select_in(session, Device.id, Device.rack_id, changed['rack']))
+        changed['interface'].update(self._select_in(session, IpAddress.interface_id, IpAddress.subnet_id, changed['subnet']))
+        host_ids.update(self._select_in(session, Interface.host_id, Interface.id, changed['interface']))
+        host_ids.update(self._select_in(session, Host.id, Host.device_id, changed['device']))
+
+        host_ids.discard(None)
+        self.log.fine("changed hosts in %d changesets: %d", len(changeset_ids), len(host_ids))
+        return host_ids
+
+    def select_hosts(self, query, host_ids=None):
+        """ The Hosts of a Host query, only those in host_ids if given """
+        from dino.db import Host
+        if host_ids is None:
+            return query.all()
+        
+        host_ids = list(host_ids)
+        hosts = []
+        for i in xrange(0, len(host_ids), self.QUERY_CHUNK_SIZE):
+            hosts.extend(query.filter(Host.id.in_(host_ids[i:i + self.QUERY_CHUNK_SIZE])).all())
+        return hosts
+
+    def _select_in(self, session, column, key_column, keys, *criterion):
+        keys = [ k for k in keys if k is not None ]
+        for i in xrange(0, len(keys), self.QUERY_CHUNK_SIZE):
+            chunk = keys[i:i + self.QUERY_CHUNK_SIZE]
+            for (value,) in session.query(column).filter(and_(key_column.in_(chunk), *criterion)):
+                yield value
+
+    #
+    # Shared queries
+    #
+    def query_port_rows(self, session, port_filter):
+        """ (port_id, mac, host name, pod name, site name, rackpos, rack name, ip) 
+        of each Port matching port_filter on a Host in this site, from a 
+        joined SELECT of QUERY_CHUNK_SIZE rows at a time in Port.id order.
+        
+        Rows are plain tuples (nothing goes through the identity map). ip is
+        None if the Port has no Interface or the Interface has no IpAddress.
+        MySQLdb reads the whole result of a query into the client, so each 
+        chunk is its own query, starting after the last Port read.
+        """
+        from dino.db import Port, Device, Host, Pod, Rack, Site, Interface, IpAddress
+        
+        query = session.query(Port.id, Port.mac, Host.name, Pod.name, Site.name, Device.rackpos, Rack.name, IpAddress.value)\
+            .join((Device, Port.device_id == Device.id))\
+            .join((Host, Host.device_id == Device.id))\
+            .join((Pod, Host.pod_id == Pod.id))\
+            .join((Rack, Device.rack_id == Rack.id))\
+            .join((Site, Rack.site_id == Site.id))\
+            .outerjoin((Interface, and_(Interface.host_id == Host.id, Interface.port_name == Port.name)))\
+            .outerjoin((IpAddress, IpAddress.interface_id == Interface.id))\
+            .filter(Site.name == self.settings.site)\
+            .filter(port_filter)\
+            .order_by(Port.id, Interface.id)
+        
+        last_port_id = 0
+        while True:
+            rows = query.filter(Port.id > last_port_id).limit(self.QUERY_CHUNK_SIZE).all()
+            for row in rows:
+                # Port.interface is the first Interface with the Port's name,
+                # the rows of its other Interfaces are skipped
+                if row[0] == last_port_id:
+                    continue
+                last_port_id = row[0]
+                yield tuple(row)
+                
+            if len(rows) < self.QUERY_CHUNK_SIZE:
+                break
+            
+    #
+    # Output / Change Manifest
+    #
+    # Generators write their output through an OutputWriter, which only
+    # touches files whose content changed. The names of the changed files 
+    # are added to the manifest, and activate() is skipped if the manifest
+    # is empty (unless full is set). A successful activate() clears the manifest.
+    #
+    def open_output(self, prune=False):
+        if not os.path.isdir(self.workdir):
+            self.setup_dir(self.workdir)
+        return OutputWriter(self.workdir, prune=prune)
+    
+    def close_output(self, output):
+        """ Close the writer and add its changes to the manifest """
+        changed = output.close()
+        
+        # Generate may run more than once before activate
+        manifest = self.load_manifest() or set()
+        manifest.update(changed)
+        self._write_manifest(manifest)
+        
+        self.log.info("output: %d files changed", len(changed))
+        return changed
+    
+    def load_manifest(self):
+        """ Set of files changed since the last activate, or None if unknown """
+        if not os.path.exists(self.manifest_file):
+            return None
+        f = open(self.manifest_file, 'r')
+        try:
+            return set([ line.rstrip('\n') for line in f if line.strip() ])
+        finally:
+            f.close()
+        
+    def clear_manifest(self):
+        if os.path.exists(self.manifest_file):
+            self._write_manifest(())
+    
+    def _write_manifest(self, names):
+        tmp_file = self.manifest_file + ".tmp"
+        f = open(tmp_file, 'w')
+        try:
+            for name in sorted(names):
+                f.write(name + "\n")
+        finally:
+            f.close()
+        os.rename(tmp_file, self.manifest_file)
+
     @staticmethod
     def setup_dir(dir, wipe=True, default_mode=0755):
         '''clean a directory for use as a dumping ground'''
@@ -208,7 +496,8 @@ class Generator(object):
         # inject it as a subdir
         src = src.rstrip('/') + '/'
         trg = trg.rstrip('/') + '/'
-        args = ['rsync', src, trg, '-ruaHI']
+        # No -I: unchanged output keeps its mtime, so rsync can skip it
+        args = ['rsync', src, trg, '-ruaH']
         if verbose:
             args.append('-v')
         if delete:
@@ -222,6 +511,109 @@ class Generator(object):
 
 
 
+class OutputWriter(object):
+    """ Writes files into a directory, but only if the content changed.
+    
+    A file is written to a temporary file in the same directory and renamed 
+    over the old one, so readers never see a partial file. Files with the 
+    same content (compared by sha1) are not touched at all. 
+    
+    remove() deletes a file at close(), unless it was written again. With 
+    prune=True, close() deletes every file that was not written.
+    close() returns the names of the files that were written or deleted.
+    """
+    
+    TMP_PREFIX = ".tmp-"
+    
+    def __init__(self, dir, prune=False):
+        self.dir = dir
+        self.prune = prune
+        self.written = set()
+        self.removed = set()
+        self.changed = set()
+        
+    def write(self, filename, content):
+        f = self.open(filename)
+        f.write(content)
+        return f.close()
+    
+    def open(self, filename):
+        """ OutputFile for writing filename a piece at a time """
+        self.written.add(filename)
+        return OutputFile(self, filename, pjoin(self.dir, self.TMP_PREFIX + filename))
+    
+    def temp_path(self, filename):
+        """ Temporary path for a file written by other means, see install() """
+        self.written.add(filename)
+        return pjoin(self.dir, self.TMP_PREFIX + filename)
+    
+    def install(self, filename, tmp_path):
+        """ Replace filename with tmp_path if the content differs """
+        return self._commit(filename, tmp_path, self.file_digest(tmp_path))
+    
+    def _commit(self, filename, tmp_path, digest):
+        path = pjoin(self.dir, filename)
+        if os.path.exists(path) and self.file_digest(path) == digest:
+            os.unlink(tmp_path)
+            return False
+        
+        os.rename(tmp_path, path)
+        self.changed.add(filename)
+        return True
+    
+    def remove(self, filename):
+        self.removed.add(filename)
+        
+    def close(self):
+        if self.prune:
+            self.removed.update(os.listdir(self.dir))
+            
+        for filename in self.removed - self.written:
+            path = pjoin(self.dir, filename)
+            if os.path.isfile(path):
+                os.unlink(path)
+                self.changed.add(filename)
+        
+        return self.changed
+    
+    @staticmethod
+    def file_digest(path):
+        h = hashlib.sha1()
+        f = open(path, 'rb')
+        try:
+            while True:
+                data = f.read(65536)
+                if not data:
+                    break
+                h.update(data)
+        finally:
+            f.close()
+        return h.digest()
+
+
+
+class OutputFile(object):
+    """ File returned by OutputWriter.open(). Content is hashed as it is
+    written to the temporary file; close() decides if it replaces the 
+    existing file and returns True if it did """
+    
+    def __init__(self, writer, filename, tmp_path):
+        self.writer = writer
+        self.filename = filename
+        self.tmp_path = tmp_path
+        self.hash = hashlib.sha1()
+        self.file = open(tmp_path, 'w')
+        
+    def write(self, data):
+        self.hash.update(data)
+        self.file.write(data)
+        
+    def close(self):
+        self.file.close()
+        return self.writer._commit(self.filename, self.tmp_path, self.hash.digest())
+
+
+
 class GeneratorCli(dino.basecli.CommandLineInterface):    
     
     def __init__(self, generator_cls):
@@ -234,6 +626,7 @@ class GeneratorCli(dino.basecli.CommandLineInterface):
         parser.allow_interspersed_args = False    
         parser.add_option('-g', '--generate', action='store_true', default=False, help='generate only')
         parser.add_option('-a', '--activate', action='store_true', default=False, help='activate only')
+        parser.add_option('-f', '--full', action='store_true', default=False, help='ignore the last run: regenerate and activate everything')
         parser.add_option('-v', '--verbose', action='callback', callback=self.increase_verbose_cb)
         parser.add_option('-d', '--debug', action='store_true', default=False, help='debug output')
         parser.add_option('-x', '--xception-trace', action='store_true', dest='exception_trace', default=False)
@@ -251,6 +644,7 @@ class GeneratorCli(dino.basecli.CommandLineInterface):
             db_config = self.create_db_config(options)
             
             gen = self.generator_cls(db_config)
+            gen.full = options.full
             gen.parse(args)
             
             if options.generate:
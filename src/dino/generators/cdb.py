@@ -0,0 +1,126 @@
+'''
+Constant database (cdb) reader and writer, in the file format of
+D. J. Bernstein's cdb package (http://cr.yp.to/cdb/cdb.txt), as read by tinydns.
+
+    +----------------+---------+-------+-------+-----+---------+
+    | 256 table ptrs | records | hash0 | hash1 | ... | hash255 |
+    +----------------+---------+-------+-------+-----+---------+
+
+All numbers are 32 bit little endian. A record is key length, data length,
+key, data. A key hashes to table (hash & 255), slot (hash >> 8) % table
+length, with linear probing. Tables are twice the size of their entries.
+'''
+
+import struct
+
+HEADER_SIZE = 2048
+
+
+def cdb_hash(key):
+    h = 5381
+    for c in key:
+        h = (((h << 5) + h) & 0xffffffff) ^ ord(c)
+    return h
+
+
+class CdbWriter(object):
+    ''' Write a cdb file. Records go straight to the file; only the (hash,
+    position) of each record is kept until close() writes the tables.
+    Multiple records may have the same key, they are found in the order added.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'wb')
+        self.file.write('\0' * HEADER_SIZE)
+        self.pos = HEADER_SIZE
+        self.tables = [ [] for i in xrange(256) ]
+
+    def __len__(self):
+        return sum([ len(t) for t in self.tables ])
+
+    def add(self, key, data):
+        h = cdb_hash(key)
+        self.file.write(struct.pack('<LL', len(key), len(data)))
+        self.file.write(key)
+        self.file.write(data)
+        self.tables[h & 255].append((h, self.pos))
+        self._advance(8 + len(key) + len(data))
+
+    def close(self):
+        header = []
+        for entries in self.tables:
+            size = len(entries) * 2
+            slots = [ (0, 0) ] * size
+            for (h, pos) in entries:
+                i = (h >> 8) % size
+                while slots[i][1] != 0:
+                    i = (i + 1) % size
+                slots[i] = (h, pos)
+
+            header.append((self.pos, size))
+            self.file.write(''.join([ struct.pack('<LL', h, pos) for (h, pos) in slots ]))
+            self._advance(8 * size)
+
+        self.file.seek(0)
+        self.file.write(''.join([ struct.pack('<LL', pos, size) for (pos, size) in header ]))
+        self.file.close()
+        self.tables = None
+
+    def _advance(self, count):
+        self.pos += count
+        if self.pos > 0xffffffff:
+            raise OverflowError("cdb file larger than 4GB: %s" % self.path)
+
+
+class CdbReader(object):
+    ''' Read a cdb file '''
+
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        data = struct.unpack('<512L', self.file.read(HEADER_SIZE))
+        self.header = zip(data[0::2], data[1::2])
+
+    def close(self):
+        self.file.close()
+
+    def get_all(self, key):
+        ''' data of every record with the key, in the order they were added '''
+        h = cdb_hash(key)
+        (table_pos, size) = self.header[h & 255]
+        if size == 0:
+            return []
+
+        values = []
+        slot = (h >> 8) % size
+        for i in xrange(size):
+            self.file.seek(table_pos + 8 * slot)
+            (slot_hash, pos) = struct.unpack('<LL', self.file.read(8))
+            if pos == 0:
+                break
+            if slot_hash == h:
+                self.file.seek(pos)
+                (klen, dlen) = struct.unpack('<LL', self.file.read(8))
+                if klen == len(key) and self.file.read(klen) == key:
+                    values.append(self.file.read(dlen))
+            slot = (slot + 1) % size
+        return values
+
+    def get(self, key, default=None):
+        values = self.get_all(key)
+        if values:
+            return values[0]
+        return default
+
+    def __iter__(self):
+        ''' (key, data) of every record, in file order '''
+        # The records end where the first table starts
+        end = self.header[0][0]
+        pos = HEADER_SIZE
+        while pos < end:
+            self.file.seek(pos)
+            (klen, dlen) = struct.unpack('<LL', self.file.read(8))
+            key = self.file.read(klen)
+            data = self.file.read(dlen)
+            yield (key, data)
+            pos += 8 + klen + dlen
@@ -153,18 +153,14 @@ class DhcpGenerator(Generator):
         
         data = dict(base_data)
         
-        ports = session.query(Port).filter_by(is_blessed=True)\
-            .join(Device).join(Rack).join(Site)\
-            .filter_by(name=self.settings.site)\
-            .filter(Device.host!=None).all()
-        for port in ports:    
-            if port.interface is None:
-                self.log.info("Skipping Port with no Interface: " % port)
+        for (port_id, mac, host_name, pod_name, site_name, rackpos, rack_name, ip) in self.query_port_rows(session, Port.is_blessed == True):
+            if ip is None:
+                self.log.info("Skipping Port with no Interface/Address: %s", mac)
                 continue
                     
-            data['hostname'] = port.device.host.hostname() + "." + self.settings.domain            
-            data['ip'] = port.interface.address.value
-            data['mac'] = port.mac
+            data['hostname'] = "%s.%s.%s.%s" % (host_name, pod_name, site_name, self.settings.domain)
+            data['ip'] = ip
+            data['mac'] = mac
             data['boot_filename'] = self.settings.dhcp_boot_filename
             data['rapids_ver'] = str(self.settings.dhcp_rapids_ver)
             data['options'] = ""
@@ -185,18 +181,13 @@ class DhcpGenerator(Generator):
     
         data = dict(base_data)    
             
-        ports = session.query(Port).filter_by(is_ipmi=True)\
-            .join(Device).join(Rack).join(Site)\
-            .filter(Site.name==self.settings.site)\
-            .filter(Device.host!=None).all()
-            
-        for port in ports:
-            if port.interface is None:
-                self.log.info("Skipping Port with no Interface: " % port)
+        for (port_id, mac, host_name, pod_name, site_name, rackpos, rack_name, ip) in self.query_port_rows(session, Port.is_ipmi == True):
+            if ip is None:
+                self.log.info("Skipping Port with no Interface/Address: %s", mac)
                 continue
-            data['hostname'] = "ipmi-%s.%s" % (port.device.host.hostname(), self.settings.domain)
-            data['mac'] = port.mac
-            data['ip'] = port.interface.address.value
+            data['hostname'] = "ipmi-%s.%s.%s.%s" % (host_name, pod_name, site_name, self.settings.domain)
+            data['mac'] = mac
+            data['ip'] = ip
             data['options'] = ""
             self.log.fine("   IpmiHost: %s", data['hostname'])
             
@@ -211,37 +202,36 @@ class DhcpGenerator(Generator):
 
 
     def generate(self):
+        self.phase('query')
                  
-        write_loc = pjoin(self.workdir, 'dhcp.conf')
-        self.setup_dir(self.workdir)
-        
         session = self.db_config.session()
         # currently not possible to fail; except wrap it when it becomes
-        # possible.
-        generated_config = []
-
-
-        global_section = GLOBAL_TEMPLATE % self.query_global()
-        generated_config.append(global_section)
+        # possible. The query methods reuse one dict for every row
+        global_data = self.query_global()
 
         self.log.info("generate: reading subnets")        
-        sections = [ SUBNET_TEMPLATE % d for d in self.query_subnets(session) ] 
-        generated_config.extend(sections)
+        subnets = [ dict(d) for d in self.query_subnets(session) ]
         
         self.log.info("generate: reading hosts")
-        sections = [ HOST_TEMPLATE % d for d in self.query_hosts(session) ] 
-        generated_config.extend(sections)
+        hosts = [ dict(d) for d in self.query_hosts(session) ]
         
         self.log.info("generate: reading ipmi hosts")
-        sections = [ IPMI_TEMPLATE % d for d in self.query_ipmi_hosts(session) ] 
-        generated_config.extend(sections)
+        ipmi_hosts = [ dict(d) for d in self.query_ipmi_hosts(session) ]
                                 
+        session.close()
+
+        self.phase('render')
+        generated_config = [ GLOBAL_TEMPLATE % global_data ]
+        generated_config.extend([ SUBNET_TEMPLATE % d for d in subnets ])
+        generated_config.extend([ HOST_TEMPLATE % d for d in hosts ])
+        generated_config.extend([ IPMI_TEMPLATE % d for d in ipmi_hosts ])
 
-        self.log.info("generate: updating %r", write_loc)
+        self.phase('write')
+        self.log.info("generate: updating %r", pjoin(self.workdir, 'dhcp.conf'))
         
-        f = open(write_loc, 'w')
-        f.write('\n'.join(generated_config))
-        f.close()
+        output = self.open_output(prune=True)
+        output.write('dhcp.conf', '\n'.join(generated_config))
+        self.close_output(output)
         
         self.log.info("generate: completed")
     
@@ -258,9 +248,11 @@ class DhcpGenerator(Generator):
         data = f.read()
         f.close()
         
-        f = open(write_loc, 'w')
+        tmp_loc = write_loc + ".tmp"
+        f = open(tmp_loc, 'w')
         f.write(data)
         f.close()
+        os.rename(tmp_loc, write_loc)
 
         self.log.debug("activate: config updated")
  
@@ -1,6 +1,10 @@
 #!/usr/bin/env python
 
 import sys, os, subprocess
+import hashlib
+import heapq
+import shutil
+import tempfile
 from os.path import join as pjoin
 
 if __name__ == "__main__":
@@ -8,7 +12,7 @@ if __name__ == "__main__":
     
 from dino.generators.base import Generator, GeneratorException
 from dino.config import load_config
-from dino.db import (Device, Port, Rack, Site)
+from dino.db import Port
 
 
 from dino.generators.dnsrecord import *
@@ -29,124 +33,153 @@ class DnsGenerator(Generator):
         self.check_call(['svn', 'export', svn_uri, filepath])
 
                     
-    def query_dynamic_set(self):
-        dynamic = list()
-        
-        sess = self.db_config.session()
+    # Records sorted in memory at once, before spilling to a temporary file
+    SORT_CHUNK_SIZE = 100000
+    # Copy buffer for the static files
+    COPY_SIZE = 1024 * 1024
+    
+    def query_dynamic(self, session):
+        """ Generate the records for the blessed and ipmi ports of the site """
+        domain = self.settings.domain
         
         self.log.info("Looking for blessed interfaces")
-        ports = sess.query(Port).filter_by(is_blessed=True)\
-            .join(Device).join(Rack).join(Site).filter_by(name=self.settings.site).all()            
-        self.log.info("Found %d blessed ports" % len(ports))
-            
-        for port in ports:
-            
-            if port.interface is None:
-                self.log.warn("Skipping Port with no Interface: " % port)
+        count = 0
+        for (port_id, mac, host_name, pod_name, site_name, rackpos, rack_name, ip) in self.query_port_rows(session, Port.is_blessed == True):
+            if ip is None:
+                self.log.warn("Skipping Port with no Interface/Address: %s", mac)
                 continue
-            
-            host = port.device.host
-            device = port.device
+            count += 1
             
             rec = FullARecord()
-            rec.fqdn = "%s.%s.%s.%s" % (host.name, host.pod.name, host.site.name, self.settings.domain) 
-            rec.ip = port.interface.address.value
-            dynamic.append(rec)
+            rec.fqdn = "%s.%s.%s.%s" % (host_name, pod_name, site_name, domain) 
+            rec.ip = ip
+            yield rec
             
             rec = ForwardARecord()
-            rec.fqdn = "slot%s.rack%s.%s.%s" % (device.rackpos, device.rack.name, device.site.name, self.settings.domain)
-            rec.ip = port.interface.address.value
-            dynamic.append(rec)
-            
+            rec.fqdn = "slot%s.rack%s.%s.%s" % (rackpos, rack_name, site_name, domain)
+            rec.ip = ip
+            yield rec
+        self.log.info("Found %d blessed ports" % count)
             
         self.log.info("Looking for IPMI interfaces")
-        ports = sess.query(Port).filter_by(is_ipmi=True)\
-            .join(Device).join(Rack).join(Site).filter_by(name=self.settings.site).all()
-            
-        self.log.info("Found %d ipmi ports" % len(ports))
-        
-        for port in ports:
-            
-            if port.interface is None:
-                self.log.warn("Skipping Port with no Interface: " % port)
+        count = 0
+        for (port_id, mac, host_name, pod_name, site_name, rackpos, rack_name, ip) in self.query_port_rows(session, Port.is_ipmi == True):
+            if ip is None:
+                self.log.warn("Skipping Port with no Interface/Address: %s", mac)
                 continue
+            count += 1
                 
-            host = port.device.host            
             rec = FullARecord()
-            rec.fqdn = "ipmi-%s.%s.%s.%s" % (host.name, host.pod.name, host.site.name, self.settings.domain) 
-            rec.ip = port.interface.address.value
-            dynamic.append(rec)
+            rec.fqdn = "ipmi-%s.%s.%s.%s" % (host_name, pod_name, site_name, domain) 
+            rec.ip = ip
+            yield rec
             
-            device = port.device
             rec = ForwardARecord()
-            rec.fqdn = "ipmi-slot%s.rack%s.%s.%s" % (device.rackpos, device.rack.name, device.site.name, self.settings.domain)
-            rec.ip = port.interface.address.value
-            dynamic.append(rec)
-            
-        sess.close()
-        return dynamic
+            rec.fqdn = "ipmi-slot%s.rack%s.%s.%s" % (rackpos, rack_name, site_name, domain)
+            rec.ip = ip
+            yield rec
+        self.log.info("Found %d ipmi ports" % count)
     
     
-    def check_sets(self, static_set, dynamic_set):
-        #
-        # Check Records
-        # 
-        overlap = static_set & dynamic_set
+    @staticmethod
+    def record_digest(line):
+        # 8 bytes of md5 per record keeps the index small. A collision 
+        # would drop a dynamic record, at ~1/2^64 per pair it is ignored
+        return hashlib.md5(line).digest()[:8]
+    
+    def index_static(self, filenames):
+        """ Digest of every record in the static files (see record_digest) """
+        index = set()
+        for filename in filenames:
+            f = open(filename)
+            try:
+                for line in f:
+                    line = line.split("#", 1)[0].strip()
+                    if line == "":
+                        continue
+                    if line[0] not in DnsRecord.REC_TYPES:
+                        raise DnsError("Unknown Record Type in %s: %s" % (filename, line))
+                    index.add(self.record_digest(line))
+            finally:
+                f.close()
+        self.log.info("Indexed %d static records", len(index))
+        return index
+    
+    def sorted_lines(self, records, tmpdir):
+        """ The records as sorted lines. Chunks of SORT_CHUNK_SIZE are sorted
+        and written to temporary files, which are merged as they are read """
+        chunk_files = []
         
-        if len(overlap) > 0:
-            self.log.warning("The following records are duplicated in static and dynamic files")
-            for r in overlap:
-                dynamic_set.remove(r) 
-                self.log.warning(r)                
+        def spill(chunk):
+            chunk.sort()
+            f = tempfile.TemporaryFile(dir=tmpdir)
+            for line in chunk:
+                f.write(line + "\n")
+            f.seek(0)
+            chunk_files.append(f)
             
-        #
-        # Anything else we should do here?
-         
-            
-    def generate(self):
-        #
-        # Setup base work dir
-        # 
-        self.setup_dir(self.workdir)
+        chunk = []
+        for rec in records:
+            chunk.append(str(rec))
+            if len(chunk) >= self.SORT_CHUNK_SIZE:
+                spill(chunk)
+                chunk = []
+                
+        if not chunk_files:
+            chunk.sort()
+            return [ line + "\n" for line in chunk ]
+        
+        if chunk:
+            spill(chunk)
+        return heapq.merge(*chunk_files)
         
+    def copy_file(self, filename, output):
+        f = open(filename)
+        try:
+            while True:
+                data = f.read(self.COPY_SIZE)
+                if not data:
+                    break
+                output.write(data)
+        finally:
+            f.close()
+        
+    def generate(self):
         #
-        # Pull Static files from SVN
+        # Pull Static files from SVN 
         #
-        internal_fp = pjoin(self.workdir, 'static-internal')
-        shared_fp = pjoin(self.workdir, 'static-shared')
+        self.phase('svn')
+        tmpdir = tempfile.mkdtemp(prefix="dino-dns-")
+        try:
+            internal_fp = pjoin(tmpdir, 'static-internal')
+            shared_fp = pjoin(tmpdir, 'static-shared')
+                 
+            self.get_svn_uri(self.settings.dns_internal_uri, internal_fp)   
+            self.get_svn_uri(self.settings.dns_shared_uri, shared_fp)
+            
+            self.write_data(tmpdir, [ internal_fp, shared_fp ])
+        finally:
+            shutil.rmtree(tmpdir)
+            
+    def write_data(self, tmpdir, static_files):
+        """ Write the static files, then the dynamic records that are not in 
+        them, sorted. Memory use does not grow with the size of the static 
+        files (besides their index) or of the dynamic set """
+        self.phase('index')
+        static_index = self.index_static(static_files)
         
-             
-        self.get_svn_uri(self.settings.dns_internal_uri, internal_fp)   
-        self.get_svn_uri(self.settings.dns_shared_uri, shared_fp)
+        # the dynamic records are queried and sorted as the output is written
+        self.phase('write')
         
-        internal_recs = DnsRecord.parse_data_file(internal_fp)
-        shared_recs = DnsRecord.parse_data_file(shared_fp)
-        static_set = set( internal_recs + shared_recs )
+        session = self.db_config.session()
         
-        dynamic = self.query_dynamic_set()
-    
-        #
-        # check static and dynamic files
-        #  
-        self.check_sets(static_set, set(dynamic))
-
-
-        #
-        # Write the output file
-        #        
-        self.setup_dir(self.workdir)
+        output = self.open_output(prune=True)
         output_fp = pjoin(self.workdir, self.settings.dns_combinded_file)
-        
         self.log.info("Writing output file: %s" % output_fp) 
-        f = open(output_fp, 'w')
-        
-        x = open(internal_fp)
-        f.write(x.read())
-        x.close()
         
-        x = open(shared_fp)
-        f.write(x.read())
-        x.close()
+        f = output.open(self.settings.dns_combinded_file)
+        for filename in static_files:
+            self.copy_file(filename, f)
         
         f.write("\n")
         f.write("#\n")
@@ -154,17 +187,56 @@ class DnsGenerator(Generator):
         f.write("#\n")
         f.write("\n")
         
-        dynamic.sort()        
-        for r in dynamic:
-            f.write(str(r) + "\n")
-
+        #
+        # Records that are already static are not repeated
+        #
+        duplicates = 0
+        for line in self.sorted_lines(self.query_dynamic(session), tmpdir):
+            if self.record_digest(line.rstrip("\n")) in static_index:
+                if duplicates == 0:
+                    self.log.warning("The following records are duplicated in static and dynamic files")
+                self.log.warning(line.rstrip("\n"))
+                duplicates += 1
+                continue
+            f.write(line)
+        
         f.close()
+        session.close()
+        
+        if self.compile_cdb():
+            self.phase('cdb')
+            self.write_cdb(output, output_fp)
+        
+        self.close_output(output)
+
+    #
+    # data.cdb
+    #
+    CDB_FILE = "data.cdb"
+    
+    def compile_cdb(self):
+        """ Build data.cdb here instead of running tinydns-data on activate """
+        return int(self.settings.get('dns_compile_cdb', 0)) != 0
+    
+    def write_cdb(self, output, data_fp):
+        """ Compile the data file into data.cdb. The default SOA serial is 
+        the modification time of the data file, like tinydns-data, so an 
+        unchanged data file gives an unchanged data.cdb """
+        tmp_path = output.temp_path(self.CDB_FILE)
+        serial = int(os.stat(data_fp).st_mtime)
+        
+        count = write_cdb(DnsRecord.iter_tinydns_data(data_fp), tmp_path, serial)
+        self.log.info("Wrote %d entries to %s" % (count, self.CDB_FILE))
+        output.install(self.CDB_FILE, tmp_path)
 
 
     def activate(self):
         script_path = pjoin(os.path.abspath(os.path.dirname(__file__)), 'activate_dns.sh')
-        p = subprocess.Popen([script_path], stdout=subprocess.PIPE, 
-            env={'MW_BLESSED_PORT' : self.settings.dns_blessed_port})
+        env = {'MW_BLESSED_PORT' : self.settings.dns_blessed_port}
+        if self.compile_cdb():
+            env['DNS_DATA_CDB_SOURCE_FILE'] = pjoin(self.workdir, self.CDB_FILE)
+            
+        p = subprocess.Popen([script_path], stdout=subprocess.PIPE, env=env)
         p.wait()
         if p.returncode != 0:
             (out, err) = p.communicate()
@@ -1,13 +1,21 @@
-
 ''' 
 Set of classes to parse and modify tinydns data files
 '''
+import re
+import struct
+
+from dino.generators.cdb import CdbWriter
 
 class MetaDnsRecord(type):
+    def __new__(meta, name, bases, dict_):
+        # Records are small and numerous (one per data file line): no __dict__
+        dict_.setdefault('__slots__', ())
+        return type.__new__(meta, name, bases, dict_)
+        
     def __init__(cls, name, bases, dict_):
         super(MetaDnsRecord, cls).__init__(name, bases, dict_)
         
-        if bases[0] == list:
+        if bases[0] == object:
             cls.REC_TYPES = {}
 
         if not hasattr(cls,'FORMAT'):
@@ -30,80 +38,337 @@ class MetaDnsRecord(type):
     def index_property(index):
         
         def _get(self, index=index):
-            if index < len(self):
-                return self[index]
+            if index < len(self.values):
+                return self.values[index]
             else:
                 return None
             
         def _set(self, value, index=index):
-            for i in xrange(len(self), index+1):
-                self.append("")
-            self[index] = str(value)
+            values = list(self.values)
+            for i in xrange(len(values), index+1):
+                values.append("")
+            values[index] = str(value)
+            self.values = tuple(values)
+            self._key = None
             
         return property(_get, _set)    
 
 
-class DnsRecord(list):
+class DnsRecord(object):
+    ''' A tinydns data line. The fields are held in a tuple; the line 
+    itself (the canonical key used for hashing, comparing and sorting) 
+    is built once and cached until a field is set.
+    '''
     __metaclass__ = MetaDnsRecord
+    __slots__ = ('values', '_key')
     
     FORMAT = None
     
-    def __init__(self, values=(), *args, **kwargs):
-        list.__init__(self, values)
-        
+    def __init__(self, values=(), **kwargs):
+        self.values = tuple(values)
+        self._key = None
+        for (name, value) in kwargs.items():
+            setattr(self, name, value)
+    
+    @property
+    def key(self):
+        if self._key is None:
+            self._key = "%s%s" % (self.KEY, ":".join(self.values))
+        return self._key
+    
     def __str__(self):
-        return "%s%s" % (self.KEY, ":".join(self))
+        return self.key
 
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, self.key)
+    
+    def __len__(self):
+        return len(self.values)
+    
+    def __iter__(self):
+        return iter(self.values)
+    
+    def __getitem__(self, index):
+        return self.values[index]
+        
     def __hash__(self):
-       return hash(tuple(self.KEY) + tuple(self))
+        return hash(self.key)
 
-    def __lt__(self, other):
-        if isinstance(other, DnsRecord):
-            return str.__lt__(str(self), str(other))            
-        else:   
-            return NotImplemented
-            
+    # The KEY character is part of the key, so equal keys mean equal types
     def __eq__(self, other):
-        return self.__class__ == other.__class__ and str(self) == str(other)
+        if isinstance(other, DnsRecord):
+            return self.key == other.key
+        return NotImplemented
             
     def __ne__(self, other):
+        if isinstance(other, DnsRecord):
+            return self.key != other.key
         return NotImplemented
             
-    def __gt__(self, other):
+    def __lt__(self, other):
+        if isinstance(other, DnsRecord):
+            return self.key < other.key
         return NotImplemented
             
-    def __ge__(self, other):
+    def __le__(self, other):
+        if isinstance(other, DnsRecord):
+            return self.key <= other.key
         return NotImplemented
             
-    def __le__(self, other):
+    def __gt__(self, other):
+        if isinstance(other, DnsRecord):
+            return self.key > other.key
+        return NotImplemented
+            
+    def __ge__(self, other):
+        if isinstance(other, DnsRecord):
+            return self.key >= other.key
         return NotImplemented
     
     
-    @staticmethod
-    def parse_data_file(file):        
+    @classmethod
+    def parse_data_file(cls, file):        
+        ''' All records of a data file, comments and blank lines skipped '''
+        return list(cls.iter_data_file(file))
+    
+    @classmethod
+    def iter_data_file(cls, file):
+        ''' Generate the records of a data file, one line at a time. 
+        Lines are stripped and split once; the stripped line is the key '''
+        rec_types = cls.REC_TYPES
+        
         f = open(file)
         try:
-            # read lines, remove comments 
-            lines = [ line.split("#", 1)[0].strip() for line in f.readlines() ]            
-            # parse non-empty lines
-            return [ DnsRecord.parse_record(line) for line in lines if line != "" ]
+            for line in f:
+                if "#" in line:
+                    line = line[:line.index("#")]
+                line = line.strip()
+                if not line:
+                    continue
+                
+                rec_cls = rec_types.get(line[0])
+                if rec_cls is None:
+                    raise Exception("Unknown Record Type: %s" % line[0])
+                yield rec_cls._from_line(line)
                 
         finally:
             f.close()
     
+    @classmethod
+    def iter_tinydns_data(cls, file):
+        ''' Generate the records of a data file as tinydns-data reads it:
+        trailing whitespace is dropped, and only lines starting with '#' are
+        comments. A '#' anywhere else is part of the record (eg. TXT text) '''
+        rec_types = cls.REC_TYPES
+
+        f = open(file)
+        try:
+            for line in f:
+                line = line.rstrip(" \t\n")
+                if not line or line[0] == "#":
+                    continue
+
+                rec_cls = rec_types.get(line[0])
+                if rec_cls is None:
+                    raise Exception("Unknown Record Type: %s" % line[0])
+                yield rec_cls._from_line(line)
+
+        finally:
+            f.close()
+
     @classmethod
     def parse_record(cls, record):
         
         key = record[0]
-        values = record[1:].split(":")
         
-        if key not in cls.REC_TYPES.keys():
+        if key not in cls.REC_TYPES:
             raise Exception("Unknown Record Type: %s" % key)        
         else:
-            return cls.REC_TYPES[key](values=values)
+            return cls.REC_TYPES[key]._from_line(record)
     
-
+    @classmethod
+    def _from_line(cls, line):
+        rec = cls.__new__(cls)
+        rec.values = tuple(line[1:].split(":"))
+        rec._key = line
+        return rec
+    
+    def field(self, index):
+        if index < len(self.values):
+            return self.values[index]
+        return ""
     
+    def tinydns_entries(self, defaultsoa):
+        ''' The (key, data) pairs tinydns-data adds to data.cdb for this record '''
+        raise NotImplementedError("%s: %s" % (self.__class__.__name__, self.key))
+
+
+#
+# tinydns-data
+#
+# Compile records into the data.cdb read by tinydns, as tinydns-data
+# (djbdns 1.05) does: owner names in lower case wire format are the cdb
+# keys, each value is
+#
+#     type (2) | '=' or '>' location (2) | ttl (4) | ttd (8) | rdata
+#
+# Location ('%') lines are not supported.
+#
+TTL_NS = 259200
+TTL_POSITIVE = 86400
+TTL_NEGATIVE = 2560
+
+DNS_T_A = '\x00\x01'
+DNS_T_NS = '\x00\x02'
+DNS_T_CNAME = '\x00\x05'
+DNS_T_SOA = '\x00\x06'
+DNS_T_PTR = '\x00\x0c'
+DNS_T_MX = '\x00\x0f'
+DNS_T_TXT = '\x00\x10'
+
+# Types a generic (':') record may not have
+GENERIC_REJECT = (0, 2, 5, 6, 12, 15, 252)
+
+def default_soa(serial):
+    ''' serial, refresh, retry, expire, minimum used by '.' and 'Z' records '''
+    return struct.pack('>LLLLL', serial & 0xffffffff, 16384, 2048, 1048576, 2560)
+
+def write_cdb(records, path, serial):
+    ''' Compile records into a tinydns data.cdb at path, returns the number
+    of entries. serial is the default SOA serial (tinydns-data uses the
+    modification time of the data file) '''
+    defaultsoa = default_soa(serial)
+
+    writer = CdbWriter(path)
+    count = 0
+    try:
+        for rec in records:
+            for (key, data) in rec.tinydns_entries(defaultsoa):
+                writer.add(key, data)
+                count += 1
+    finally:
+        writer.close()
+    return count
+
+def _unescape(s, i):
+    ''' (character, next index) for the escape sequence after the backslash
+    at s[i-1]: a character or up to 3 octal digits '''
+    ch = s[i]
+    i += 1
+    if '0' <= ch <= '7':
+        n = ord(ch) - 48
+        for j in (0, 1):
+            if i < len(s) and '0' <= s[i] <= '7':
+                n = (n << 3) + ord(s[i]) - 48
+                i += 1
+        ch = chr(n & 0xff)
+    return (ch, i)
+
+def txt_unescape(s):
+    if '\\' not in s:
+        return s
+
+    out = []
+    i = 0
+    while i < len(s):
+        ch = s[i]
+        i += 1
+        if ch == '\\':
+            if i >= len(s):
+                break
+            (ch, i) = _unescape(s, i)
+        out.append(ch)
+    return ''.join(out)
+
+def domain_wire(name):
+    ''' Dotted name to wire format (length prefixed labels ending in \\0).
+    Empty labels are skipped, \\ddd escapes are octal '''
+    labels = []
+    label = []
+    i = 0
+    while i < len(name):
+        ch = name[i]
+        i += 1
+        if ch == '.':
+            if label:
+                labels.append(''.join(label))
+                label = []
+            continue
+        if ch == '\\':
+            if i >= len(name):
+                break
+            (ch, i) = _unescape(name, i)
+        label.append(ch)
+    if label:
+        labels.append(''.join(label))
+
+    for label in labels:
+        if len(label) > 63:
+            raise ValueError("DNS label too long: %s" % name)
+
+    wire = ''.join([ chr(len(label)) + label for label in labels ]) + '\0'
+    if len(wire) > 255:
+        raise ValueError("DNS name too long: %s" % name)
+    return wire
+
+def scan_ulong(s, default):
+    ''' Value of the leading digits of s, default if there are none '''
+    i = 0
+    while i < len(s) and s[i].isdigit():
+        i += 1
+    if i == 0:
+        return default
+    return int(s[:i])
+
+IP4_PATTERN = re.compile(r"(\d+)\.(\d+)\.(\d+)\.(\d+)")
+
+def ip4_scan(s):
+    ''' 4 byte address of the dotted quad s starts with, or None. 
+    Like tinydns-data, anything after the address is ignored '''
+    m = IP4_PATTERN.match(s)
+    if m is None:
+        return None
+    octets = [ int(p) for p in m.groups() ]
+    for o in octets:
+        if o > 255:
+            return None
+    return struct.pack('4B', *octets)
+
+def ttd_parse(s):
+    ''' 8 byte time to die from (up to) 16 hex digits '''
+    if len(s) > 16:
+        raise ValueError("timestamp too long: %s" % s)
+    try:
+        digits = [ int(ch, 16) for ch in s.ljust(16, '0') ]
+    except ValueError:
+        raise ValueError("timestamp is not hex: %s" % s)
+    return ''.join([ chr((digits[i] << 4) + digits[i + 1]) for i in xrange(0, 16, 2) ])
+
+def loc_parse(s):
+    return (s + '\0\0')[:2]
+
+def rr(rtype, ttl, ttd, loc, rdata):
+    if loc == '\0\0':
+        head = rtype + '='
+    else:
+        head = rtype + '>' + loc
+    return head + struct.pack('>L', ttl) + ttd + rdata
+
+def rr_entry(owner, data):
+    ''' The cdb (key, data) for an owner name. Wildcards are stored without
+    the '*' label, with the '=' / '>' marker lowered to '*' / '+' '''
+    if owner[:2] == '\x01*':
+        owner = owner[2:]
+        data = data[:2] + chr(ord(data[2]) - 19) + data[3:]
+    return (owner.lower(), data)
+
+def _ns_name(x, fqdn, prefix):
+    ''' x is the full name if it has a dot, else x.<prefix>.fqdn '''
+    if '.' not in x:
+        x = "%s.%s.%s" % (x, prefix, fqdn)
+    return domain_wire(x)
+
+
 class FullSoaRecord(DnsRecord):
     FORMAT = ".fqdn:ip:x:ttl:timestamp:lo"
     '''
@@ -114,12 +379,31 @@ class FullSoaRecord(DnsRecord):
     
     KEY = '.'
 
+    def tinydns_entries(self, defaultsoa):
+        d1 = domain_wire(self.field(0))
+        d2 = _ns_name(self.field(2), self.field(0), "ns")
+        ttl = scan_ulong(self.field(3), TTL_NS)
+        ttd = ttd_parse(self.field(4))
+        loc = loc_parse(self.field(5))
+        
+        entries = []
+        if self.KEY == '.':
+            soa = d2 + '\x0ahostmaster' + d1 + defaultsoa
+            entries.append(rr_entry(d1, rr(DNS_T_SOA, ttl and TTL_NEGATIVE or 0, ttd, loc, soa)))
+        entries.append(rr_entry(d1, rr(DNS_T_NS, ttl, ttd, loc, d2)))
+        
+        ip = ip4_scan(self.field(1))
+        if ip:
+            entries.append(rr_entry(d2, rr(DNS_T_A, ttl, ttd, loc, ip)))
+        return entries
+
 class NsOnlyRecord(DnsRecord):
     FORMAT = "&fqdn:ip:x:ttl:timestamp:lo"
     '''    
     * an NS record showing x.ns.fqdn as a name server for fqdn and
     * an A record showing ip as the IP address of x.ns.fqdn.     
     '''
+    tinydns_entries = FullSoaRecord.__dict__['tinydns_entries']
     
 class FullARecord(DnsRecord):
     FORMAT = "=fqdn:ip:ttl:timestamp:lo"
@@ -128,11 +412,28 @@ class FullARecord(DnsRecord):
     * a PTR (``pointer'') record showing fqdn as the name of d.c.b.a.in-addr.arpa if ip is a.b.c.d. 
     '''
 
+    def tinydns_entries(self, defaultsoa):
+        ip = ip4_scan(self.field(1))
+        if not ip:
+            return []
+        
+        d1 = domain_wire(self.field(0))
+        ttl = scan_ulong(self.field(2), TTL_POSITIVE)
+        ttd = ttd_parse(self.field(3))
+        loc = loc_parse(self.field(4))
+        
+        entries = [ rr_entry(d1, rr(DNS_T_A, ttl, ttd, loc, ip)) ]
+        if self.KEY == '=':
+            arpa = "%d.%d.%d.%d.in-addr.arpa" % tuple(reversed(struct.unpack('4B', ip)))
+            entries.append(rr_entry(domain_wire(arpa), rr(DNS_T_PTR, ttl, ttd, loc, d1)))
+        return entries
+
 class ForwardARecord(DnsRecord):
     FORMAT = "+fqdn:ip:ttl:timestamp:lo"
     '''    
     * an A record showing ip as the IP address of fqdn 
     '''
+    tinydns_entries = FullARecord.__dict__['tinydns_entries']
     
 class MxRecord(DnsRecord):
     FORMAT = "@fqdn:ip:x:dist:ttl:timestamp:lo"
@@ -140,17 +441,45 @@ class MxRecord(DnsRecord):
     * an MX (``mail exchanger'') record showing x.mx.fqdn as a mail exchanger for fqdn at distance dist and
     * an A record showing ip as the IP address of x.mx.fqdn. 
     '''            
+
+    def tinydns_entries(self, defaultsoa):
+        d1 = domain_wire(self.field(0))
+        d2 = _ns_name(self.field(2), self.field(0), "mx")
+        dist = scan_ulong(self.field(3), 0)
+        ttl = scan_ulong(self.field(4), TTL_POSITIVE)
+        ttd = ttd_parse(self.field(5))
+        loc = loc_parse(self.field(6))
+        
+        entries = [ rr_entry(d1, rr(DNS_T_MX, ttl, ttd, loc, struct.pack('>H', dist & 0xffff) + d2)) ]
+        ip = ip4_scan(self.field(1))
+        if ip:
+            entries.append(rr_entry(d2, rr(DNS_T_A, ttl, ttd, loc, ip)))
+        return entries
     
 class IgnoreRecord(DnsRecord):
     FORMAT = "-fqdn:ip:ttl:timestamp:lo"
     '''    
     Record is ignored, but kept in the database all the same.
     '''
+
+    def tinydns_entries(self, defaultsoa):
+        return []
     
 class TextRecord(DnsRecord):
     FORMAT = "'fqdn:s:ttl:timestamp:lo"
     '''  TXT Record of string 's'
     '''
+
+    def tinydns_entries(self, defaultsoa):
+        d1 = domain_wire(self.field(0))
+        ttl = scan_ulong(self.field(2), TTL_POSITIVE)
+        ttd = ttd_parse(self.field(3))
+        loc = loc_parse(self.field(4))
+        
+        # character-strings of at most 127 bytes
+        text = txt_unescape(self.field(1))
+        rdata = ''.join([ chr(len(text[i:i+127])) + text[i:i+127] for i in xrange(0, len(text), 127) ])
+        return [ rr_entry(d1, rr(DNS_T_TXT, ttl, ttd, loc, rdata)) ]
     
     
 class PtrRecord(DnsRecord):
@@ -158,6 +487,14 @@ class PtrRecord(DnsRecord):
     '''
     PTR record for fqdn. tinydns-data creates a PTR record for fqdn pointing to the domain name p. 
     '''
+    RTYPE = DNS_T_PTR
+    
+    def tinydns_entries(self, defaultsoa):
+        d1 = domain_wire(self.field(0))
+        ttl = scan_ulong(self.field(2), TTL_POSITIVE)
+        ttd = ttd_parse(self.field(3))
+        loc = loc_parse(self.field(4))
+        return [ rr_entry(d1, rr(self.RTYPE, ttl, ttd, loc, domain_wire(self.field(1)))) ]
         
 class CnameRecord(DnsRecord):
     FORMAT = "Cfqdn:p:ttl:timestamp:lo"
@@ -165,6 +502,8 @@ class CnameRecord(DnsRecord):
     CNAME (``canonical name'') record for fqdn. tinydns-data creates a CNAME record for fqdn pointing to the domain name p. 
 
     '''
+    RTYPE = DNS_T_CNAME
+    tinydns_entries = PtrRecord.__dict__['tinydns_entries']
 
 class SimpleSoaRecord(DnsRecord):
     FORMAT = "Zfqdn:mname:rname:ser:ref:ret:exp:min:ttl:timestamp:lo"
@@ -184,6 +523,19 @@ class SimpleSoaRecord(DnsRecord):
     
     '''
     
+    def tinydns_entries(self, defaultsoa):
+        d1 = domain_wire(self.field(0))
+        mname = domain_wire(self.field(1))
+        rname = domain_wire(self.field(2))
+        
+        defaults = struct.unpack('>LLLLL', defaultsoa)
+        times = [ scan_ulong(self.field(3 + i), defaults[i]) & 0xffffffff for i in xrange(5) ]
+        
+        ttl = scan_ulong(self.field(8), TTL_NEGATIVE)
+        ttd = ttd_parse(self.field(9))
+        loc = loc_parse(self.field(10))
+        return [ rr_entry(d1, rr(DNS_T_SOA, ttl, ttd, loc, mname + rname + struct.pack('>LLLLL', *times))) ]
+    
 class GenericRecord(DnsRecord):
     FORMAT = ":fqdn:n:rdata:ttl:timestamp:lo"
     '''
@@ -192,9 +544,13 @@ class GenericRecord(DnsRecord):
     The proper format of rdata depends on n. You may use octal \nnn codes to include arbitrary bytes inside rdata. 
     '''
     
-    
-    
-    
-    
-    
-    
\ No newline at end of file
+    def tinydns_entries(self, defaultsoa):
+        d1 = domain_wire(self.field(0))
+        n = scan_ulong(self.field(1), None)
+        if n is None or n > 65535 or n in GENERIC_REJECT:
+            raise ValueError("bad generic record type: %s" % self.key)
+        
+        ttl = scan_ulong(self.field(3), TTL_POSITIVE)
+        ttd = ttd_parse(self.field(4))
+        loc = loc_parse(self.field(5))
+        return [ rr_entry(d1, rr(struct.pack('>H', n), ttl, ttd, loc, txt_unescape(self.field(2)))) ]
@@ -0,0 +1,136 @@
+'''
+Timing of generator runs (dino generate --profile)
+
+A generator run is split into phases by Generator.phase(): the time and
+the SQL statements of each phase are recorded. Phases with the same name
+add up. One phase can also be run under cProfile.
+'''
+import os
+import time
+from os.path import join as pjoin
+
+try:
+    import cProfile as profile_module
+except ImportError:
+    import profile as profile_module
+
+from sqlalchemy.interfaces import ConnectionProxy
+from sqlalchemy.engine.base import _proxy_connection_cls
+
+
+class StatementCounter(ConnectionProxy):
+    """ Counts the statements executed through an engine, and the time
+    spent in them (executemany counts once) """
+
+    def __init__(self):
+        self.count = 0
+        self.time = 0.0
+
+    def cursor_execute(self, execute, cursor, statement, parameters, context, executemany):
+        start = time.time()
+        try:
+            return execute(cursor, statement, parameters, context)
+        finally:
+            self.time += time.time() - start
+            self.count += 1
+
+    def attach(self, engine):
+        """ Count the statements of the connections the engine makes from now on """
+        self.engine = engine
+        self.connection_cls = engine.Connection
+        engine.Connection = _proxy_connection_cls(engine.Connection, self)
+
+    def detach(self):
+        self.engine.Connection = self.connection_cls
+        self.engine = None
+
+
+class GeneratorProfile(object):
+    """ Phase timings of one generator.
+
+    report() is a list of dicts, one per phase in the order they were
+    first entered: phase, time, sql (statements), sql_time and calls
+    (times entered). With cprofile_phase, that phase runs under cProfile
+    and its stats are dumped to <cprofile_dir>/<generator>.<phase>.prof
+    """
+
+    def __init__(self, name, cprofile_phase=None, cprofile_dir=None):
+        self.name = name
+        self.cprofile_phase = cprofile_phase
+        self.cprofile_dir = cprofile_dir
+        self.cprofile = None
+        self.cprofile_file = None
+
+        self.counter = StatementCounter()
+        self.phases = []
+        self.stats = {}
+        self.current = None
+
+    def attach(self, engine):
+        self.counter.attach(engine)
+
+    def detach(self):
+        self.counter.detach()
+
+    def phase(self, name):
+        """ End the current phase, if any, and start the named one """
+        self.stop()
+
+        if name not in self.stats:
+            self.phases.append(name)
+            self.stats[name] = dict(phase=name, time=0.0, sql=0, sql_time=0.0, calls=0)
+        self.current = (name, time.time(), self.counter.count, self.counter.time)
+
+        if name == self.cprofile_phase:
+            if self.cprofile is None:
+                self.cprofile = profile_module.Profile()
+            self.cprofile.enable()
+
+    def stop(self):
+        """ End the current phase """
+        if self.current is None:
+            return
+        (name, start, count, sql_time) = self.current
+        self.current = None
+
+        if name == self.cprofile_phase:
+            self.cprofile.disable()
+            self.dump_cprofile()
+
+        stats = self.stats[name]
+        stats['time'] += time.time() - start
+        stats['sql'] += self.counter.count - count
+        stats['sql_time'] += self.counter.time - sql_time
+        stats['calls'] += 1
+
+    def dump_cprofile(self):
+        if self.cprofile_dir is None:
+            return
+        if not os.path.isdir(self.cprofile_dir):
+            os.makedirs(self.cprofile_dir)
+        self.cprofile_file = pjoin(self.cprofile_dir, "%s.%s.prof" % (self.name, self.cprofile_phase))
+        self.cprofile.dump_stats(self.cprofile_file)
+
+    def report(self):
+        return [ dict(self.stats[name]) for name in self.phases ]
+
+    def update(self, report):
+        """ Add the phases of a report, eg. from a generate run in another process """
+        for phase in report:
+            name = phase['phase']
+            if name not in self.stats:
+                self.phases.append(name)
+                self.stats[name] = dict(phase=name, time=0.0, sql=0, sql_time=0.0, calls=0)
+            stats = self.stats[name]
+            for key in ('time', 'sql', 'sql_time', 'calls'):
+                stats[key] += phase[key]
+
+
+def format_report(reports):
+    """ Table lines for a { generator name : report } dict """
+    lines = [ "%-12s %-12s %6s %10s %8s %10s" % ("generator", "phase", "calls", "seconds", "sql", "sql secs") ]
+    for name in sorted(reports.keys()):
+        for p in reports[name]:
+            lines.append("%-12s %-12s %6d %10.3f %8d %10.3f" %
+                         (name, p['phase'], p['calls'], p['time'], p['sql'], p['sql_time']))
+    return lines
@@ -51,18 +51,19 @@ class PxeGenerator(Generator):
         'rapids_state_src' : None,       
     }
     
-    def query(self):
+    def query(self, session, host_ids=None):
         
         self.data['seed_server'] = socket.gethostbyname(socket.gethostname())
         
-        session = self.db_config.session() 
-     
         dc_info = self.pull_rapids_datacenter(self.settings, self.settings.site)
         
-        for host in session.query(Host)\
-            .join(Device).join(Rack).join(Site).filter_by(name=self.settings.site).all():
+        query = session.query(Host)\
+            .join(Device).join(Rack).join(Site).filter_by(name=self.settings.site)
+        
+        for host in self.select_hosts(query, host_ids):
             
             data = dict(self.data)
+            data['host_id'] = host.id
             data['kernel'] = data['os_codename'] = host.appliance.os.name
             data['fqdn'] = host.hostname() + "." + self.settings.domain            
 
@@ -85,29 +86,52 @@ class PxeGenerator(Generator):
 #            if debug:
 #                data['options'] += ' debug=1'                                
             yield data
-            
-        session.close()
 
     def generate(self):
     
         self.log.info("generate: started")        
 
-        dict_list = list(self.query())
-
-        # if we've made it this far, it's valid data. wipe the target dir
-        self.setup_dir(self.workdir)
-           
+        self.phase('query')
+        session = self.db_config.session()
+        state = self.load_state()
+        (changeset, pending, changeset_ids) = self.scan_changesets(session, state)
+        
+        if state is None:
+            dict_list = list(self.query(session))
+            
+            # if we've made it this far, it's valid data. Files not 
+            # written by this run are removed
+            output = self.open_output(prune=True)
+            files = {}
+        else:
+            host_ids = self.changed_hosts(session, changeset_ids)
+            self.log.info("generate: %d hosts changed in %d changesets", len(host_ids), len(changeset_ids))
+            dict_list = list(self.query(session, host_ids))
+            
+            # Remove the files of changed hosts, the mac may have changed
+            # or the host may be gone
+            output = self.open_output()
+            files = state.get('files', {})
+            for host_id in host_ids:
+                if host_id in files:
+                    output.remove(files.pop(host_id))
+            
+        session.close()
+        
+        self.phase('write')
         for data in dict_list:
             self.log.info("  Host: %s" % data['fqdn'])
           
             # goofy pattern admittedly, but this is what pxe requires; 01-mac
-            fp = pjoin(self.workdir, '01-%s' % data['mac'].lower().replace(':', '-'))
-            self.log.fine("      Filename: %s", fp)        
-            f = open(fp, 'w')
-            f.write(HOST_TEMPLATE % data)
-            f.close()
+            filename = '01-%s' % data['mac'].lower().replace(':', '-')
+            self.log.fine("      Filename: %s", filename)        
+            output.write(filename, HOST_TEMPLATE % data)
+            files[data['host_id']] = filename
+        
+        self.close_output(output)
+        self.save_state(changeset, pending=pending, files=files)
     
-        self.log.info("generate: completed")
+        self.log.info("generate: completed (%d hosts)", len(dict_list))
     
     def activate(self):
         pxe_dir = self.settings.pxe_conf_dir
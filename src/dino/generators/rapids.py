@@ -10,7 +10,6 @@ import sys
 import copy
 import os
 from os.path import join as pjoin
-import yaml
 from optparse import Option
 
 from dino.generators.base import Generator, GeneratorExecutionError
@@ -87,12 +86,10 @@ class RapidsGenerator(Generator):
         Option('-i', '--id', type="int", dest="hostid", default=None),
     )
     
-    def query(self):
-        session = self.db_config.session()
-        
+    def query(self, session, host_ids=None):
         query = session.query(Host).join(Device).join(Rack).join(Site).filter_by(name=self.settings.site)
         
-        for host in query:
+        for host in self.select_hosts(query, host_ids):
             d = copy.deepcopy(data_base)
             d['host_no'] = host.id
             d['fqdn'] = d['host'] = host.hostname() + "." + self.settings.domain
@@ -150,27 +147,50 @@ class RapidsGenerator(Generator):
                 raise GeneratorExecutionError("Host has no blessed interface: %s" % host)
             
             yield d 
-            
-        session.close()
         
     def generate(self):
-        self.setup_dir(self.workdir)
+        import yaml
+        
+        self.phase('query')
+        session = self.db_config.session()
+        try:
+            state = self.load_state()
+            (changeset, pending, changeset_ids) = self.scan_changesets(session, state)
+            
+            if state is None:
+                host_ids = None
+            else:
+                host_ids = self.changed_hosts(session, changeset_ids)
+                self.log.info("%d hosts changed in %d changesets", len(host_ids), len(changeset_ids))
+                
+            rows = list(self.query(session, host_ids))
+        finally:
+            session.close()
+        
+        self.phase('write')
+        output = self.open_output(prune=(host_ids is None))
         
-        for d in self.query():
+        # Changed hosts that are not written again were deleted, moved 
+        # to another site or skipped
+        if host_ids is not None:
+            for hid in host_ids:
+                output.remove(HID_YAML_PATTERN % hid)
+        
+        for d in rows:
             hid = d['host_no']
 
             self.log.info("updating hid %i", hid)
             
-            filename = pjoin(self.workdir, HID_YAML_PATTERN % hid)
+            filename = HID_YAML_PATTERN % hid
         
             self.log.fine("   state file: %s", filename)                    
 
-            f = open(filename, 'w')
-            yaml.safe_dump(d, stream=f)
-            f.close()
+            output.write(filename, yaml.safe_dump(d))
             
             self.log.finer("finished dumping yaml for %i", hid)
                     
+        self.close_output(output)
+        self.save_state(changeset, pending=pending)
         self.log.info("completed")
         
         
@@ -185,6 +205,9 @@ class RapidsGenerator(Generator):
         
         if self.option.hostid is not None:
             filenames = [ HID_YAML_PATTERN % self.option.hostid ]
+        elif self.manifest is not None:
+            # Only what changed, removed hosts are left in place as before
+            filenames = [ f for f in self.manifest if os.path.exists(pjoin(self.workdir, f)) ]
         else:
             filenames = os.listdir(self.workdir)
 
@@ -149,6 +149,25 @@ class AddEntityTest(SingleSessionTest):
         result = self.sess.query(Person).filter_by(name='eddie').all()
         
         assert len(result) == 0
+
+    def test_batch_revisions(self):
+        self.sess.open_changeset()
+        people = [ Person(name='p%d' % i, age=i) for i in range(3) ]
+        for p in people:
+            p.addresses.append(Address(value1='home', value2=1))
+            self.sess.add(p)
+        self.sess.submit_changeset()
+        
+        self.sess.open_changeset()
+        for p in people:
+            p.age += 10
+        cs = self.sess.submit_changeset()
+        
+        rows = self.sess.execute("SELECT head_id, age, changeset_id, changeset_invalid_id FROM person_revision").fetchall()
+        eq_( len(rows), 6 )
+        eq_( len([ r for r in rows if r['changeset_invalid_id'] == cs.id ]), 3 )
+        eq_( sorted([ r['age'] for r in rows if r['changeset_invalid_id'] is None ]), [10, 11, 12] )
+        eq_( self.sess.execute("SELECT COUNT(*) FROM address_revision").scalar(), 3 )
         
 
 class RevisionTest(SingleSessionTest):     
@@ -198,6 +217,13 @@ class RevisionTest(SingleSessionTest):
         
         assert rhost.revision == 3
         assert rhost._changeset_view == 3
+
+    def test_current_revision(self):
+        p = self.sess.query(Person).filter_by(name='eddie').first()
+        
+        rev = p.get_current_revision()
+        assert rev.revision == 5
+        assert rev.changeset_invalid_id is None
         
         
     def test_delete(self):
@@ -212,7 +238,121 @@ class RevisionTest(SingleSessionTest):
         cs = self.sess.submit_changeset()        
         assert self.sess.last_changeset is not None
         assert cs is not None
+
+    def test_bulk_update(self):
+        p = self.sess.query(Person).filter_by(name='eddie').first()
+
+        self.sess.open_changeset()
+        count = self.sess.bulk_update(Person, [p.id], { 'age' : 30 })
+        cs = self.sess.submit_changeset()
+
+        assert count == 1
+        assert p.age == 30
+        assert p.revision == 6
+        assert p.changeset_id == cs.id
+
+        rev = p.get_revision(6)
+        assert rev.age == 30
+        assert rev.changeset_invalid_id is None
+        assert p.get_revision(5).changeset_invalid_id == cs.id
+
+
+
+
+class SnapshotTest(SingleSessionTest):
+    ENTITY_SET = entity_set
+    
+    def setUp(self):
+        super(SnapshotTest, self).setUp()
+        
+        self.sess.open_changeset()
+        self.person = p = Person(name='eddie', age=12)
+        p.addresses.append(Address(value1='home', value2=1))
+        self.sess.add(p)
+        self.cs1 = self.sess.submit_changeset()
+        
+        self.sess.open_changeset()
+        p.age = 13
+        p.addresses.append(Address(value1='work', value2=2))
+        self.cs2 = self.sess.submit_changeset()
+        
+    def test_load(self):
+        snapshot = self.sess.snapshot(self.cs1)
+        
+        people = snapshot.load(Person, relations=['addresses.person'])
+        eq_( len(people), 1 )
+        eq_( people[0].age, 12 )
+        eq_( [ a.value1 for a in people[0].addresses ], ['home'] )
+        assert people[0].addresses[0].person is people[0]
         
+        snapshot = self.sess.snapshot(self.cs2)
+        p = snapshot.get(Person, self.person)
+        eq_( p.age, 13 )
+        
+        p = snapshot.load(Person, [ self.person.id ], relations=['addresses'])[0]
+        eq_( sorted([ a.value1 for a in p.addresses ]), ['home', 'work'] )
+
+    def test_two_snapshots(self):
+        snap1 = self.sess.snapshot(self.cs1)
+        snap2 = self.sess.snapshot(self.cs2)
+        
+        p1 = snap1.load(Person, relations=['addresses.person'])[0]
+        p2 = snap2.load(Person, relations=['addresses.person'])[0]
+        
+        # The 'home' address row is valid at both changesets
+        eq_( [ a.value1 for a in p1.addresses ], ['home'] )
+        eq_( p1.addresses[0].person.age, 12 )
+        eq_( p1._changeset_view, self.cs1.id )
+        eq_( sorted([ a.value1 for a in p2.addresses ]), ['home', 'work'] )
+        eq_( p2.addresses[0].person.age, 13 )
+        
+        assert p1 not in self.sess
+        assert p1.addresses[0] is not p2.addresses[0]
+
+
+
+class DiffTest(SingleSessionTest):
+    ENTITY_SET = entity_set
+    
+    def setUp(self):
+        super(DiffTest, self).setUp()
+        
+        self.sess.open_changeset()
+        (a, b, c) = [ Person(name=n, age=1) for n in ('a', 'b', 'c') ]
+        self.sess.add_all([a, b, c])
+        self.cs1 = self.sess.submit_changeset()
+        
+        self.sess.open_changeset()
+        a.age = 2
+        self.sess.delete(b)
+        self.sess.add(Person(name='d', age=1))
+        self.sess.submit_changeset()
+        
+        self.sess.open_changeset()
+        a.age = 3
+        self.cs3 = self.sess.submit_changeset()
+        
+    def test_diff(self):
+        changes = list(self.sess.diff_changesets(self.cs1, self.cs3, [ Person ]))
+        
+        eq_( [ (c.kind, (c.new or c.old)['name']) for c in changes ], 
+             [ ('update', 'a'), ('delete', 'b'), ('add', 'd') ] )
+        eq_( changes[0].changed_columns(), [ ('age', 1, 3) ] )
+        
+        eq_( list(self.sess.diff_changesets(self.cs3, self.cs3)), [] )
+        
+    def test_diff_chunks(self):
+        from dino.db.changeset import RevisionDiff
+        expected = [ (c.kind, c.head_id) for c in self.sess.diff_changesets(self.cs1, self.cs3, [ Person ]) ]
+        
+        # the two rows of the updated head are read by different queries
+        RevisionDiff.FETCH_SIZE = 1
+        try:
+            changes = list(self.sess.diff_changesets(self.cs1, self.cs3, [ Person ]))
+        finally:
+            RevisionDiff.FETCH_SIZE = 1000
+        eq_( [ (c.kind, c.head_id) for c in changes ], expected )
+        eq_( changes[0].changed_columns(), [ ('age', 1, 3) ] )
 
 
 
@@ -293,6 +433,67 @@ def do_revisions(db):
         print a.host == rhost
     
 
+
+
+def do_revision_bench(db, heads=1000, revisions=1000, lookups=1000):
+    """ Fill person_revision with heads * revisions rows (1M by default), then show the 
+    query plan and time of the point-in-time and current revision lookups, 
+    without and with the ix_person_revision_validity index """
+    import time
+    import random
+    
+    changeset_table = entity_set.resolve("ChangeSet").table
+    table = Person.Revision.table
+    index = [ i for i in table.indexes if i.name == "ix_person_revision_validity" ][0]
+    conn = db.engine.connect()
+    
+    # Changeset N writes revision N of every head
+    print "Generating %d revisions" % (heads * revisions)
+    conn.execute(changeset_table.insert(), [ { 'id' : cs } for cs in xrange(1, revisions + 1) ])
+    conn.execute(Person.table.insert(), [ 
+        { 'id' : h, 'name' : 'p%d' % h, 'age' : revisions, 'revision' : revisions, 'changeset_id' : revisions } 
+        for h in xrange(1, heads + 1) ])
+    
+    for cs in xrange(1, revisions + 1):
+        invalid = cs < revisions and cs + 1 or None
+        conn.execute(table.insert(), [ 
+            { 'head_id' : h, 'name' : 'p%d' % h, 'age' : cs, 'revision' : cs, 
+              'changeset_id' : cs, 'changeset_invalid_id' : invalid } 
+            for h in xrange(1, heads + 1) ])
+    
+    queries = {
+        'at_changeset' : "SELECT * FROM person_revision WHERE head_id = %(head)d AND changeset_id <= %(cs)d " 
+                         "AND (changeset_invalid_id IS NULL OR changeset_invalid_id > %(cs)d)",
+        'current'      : "SELECT * FROM person_revision WHERE head_id = %(head)d AND changeset_invalid_id IS NULL " 
+                         "ORDER BY changeset_id DESC LIMIT 1",
+    }
+    if db.engine.name == 'sqlite':
+        (explain, drop_index) = ("EXPLAIN QUERY PLAN ", "DROP INDEX %s")
+    else:
+        (explain, drop_index) = ("EXPLAIN ", "DROP INDEX %s ON person_revision")
+    
+    def run(label):
+        print "---- %s" % label
+        for (name, sql) in sorted(queries.items()):
+            args = { 'head' : heads / 2, 'cs' : revisions / 2 }
+            for row in conn.execute(explain + sql % args):
+                print "  %-13s %s" % (name, tuple(row))
+            
+            start = time.time()
+            for i in xrange(lookups):
+                args = { 'head' : random.randint(1, heads), 'cs' : random.randint(1, revisions) }
+                conn.execute(sql % args).fetchall()
+            print "  %-13s %d lookups: %.3fs" % (name, lookups, time.time() - start)
+        
+    index.drop(bind=conn)
+    run("head_id only (no validity index)")
+    conn.execute("CREATE INDEX ix_person_revision_head_id ON person_revision (head_id)")
+    run("head_id index")
+    conn.execute(drop_index % "ix_person_revision_head_id")
+    index.create(bind=conn)
+    run("ix_person_revision_validity")
+    
+    conn.close()
     
     
     
@@ -308,4 +509,5 @@ if __name__ == "__main__":
     #do_updates(db)
     #do_delete(db)
     #do_revisions(db)
+    #do_revision_bench(db)
     
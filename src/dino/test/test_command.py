@@ -1,6 +1,8 @@
 import logging
 import os
+import shutil
 import sys
+import tempfile
 
 from nose.tools import *
 
@@ -61,6 +63,23 @@ class ShowCommandTest(CommandTest, SingleSessionTest):
         self.runCommand('show', 'OtherThing')
 
 
+class CommandRegistryTest(DinoTest):
+
+    def test_registry(self):
+        # Every registered command is defined by its module, as registered
+        for entry in dino.cmd.MainCommand.REGISTRY:
+            cmd_cls = dino.cmd.MainCommand.find_command(entry.names()[0])
+            eq_( cmd_cls.__module__, entry.module )
+            eq_( (cmd_cls.NAME, cmd_cls.GROUP, cmd_cls.USAGE), (entry.NAME, entry.GROUP, entry.USAGE) )
+            
+        # and there are no others
+        classes = set(dino.cmd.MainCommand.commands())
+        eq_( len(classes), len(dino.cmd.MainCommand.REGISTRY) )
+        for group in dino.cmd.MainCommand.GROUPS.values():
+            for c in group:
+                assert_false( isinstance(c, dino.cmd.command.LazyCommand) )
+
+
 class GetSetCommandTest(CommandTest, ObjectTest, SingleSessionTest):
     def setUp(self):
         super(GetSetCommandTest, self).setUp()
@@ -227,7 +246,191 @@ class SetIpCommandTest(CommandTest, ObjectTest, SingleSessionTest):
         addr = self.sess.query(IpAddress).filter_by(value='127.0.0.20').first()
         
         self.assertEquals(addr, None)
-                
+
+
+class UpdateSubnetsCommandTest(CommandTest, ObjectTest, SingleSessionTest):
+
+    def setUp(self):
+        super(UpdateSubnetsCommandTest, self).setUp()
+
+        d = self.create_devices(self.sess)[0]
+        self.create_hosts(self.sess)
+        self.name = d.host.interfaces[0].element_name
+
+        self.sess.begin()
+        self.sess.add(Subnet(addr="127.0.0.0", mask_len=24))
+        self.sess.commit()
+
+        self.runCommand('ip', 'set', self.name, '127.0.0.200')
+
+        self.sess.begin()
+        self.sess.add(Subnet(addr="127.0.0.128", mask_len=25))
+        self.sess.commit()
+
+    def test_bulk(self):
+        self.runCommand('admin', 'update_subnets', '-b')
+
+        self.sess.expunge_all()
+        addr = self.sess.query(IpAddress).filter_by(value='127.0.0.200').first()
+        eq_( addr.subnet.mask_len, 25 )
+        eq_( addr.get_revision(addr.revision).subnet_id, addr.subnet_id )
+
+
+
+class SnapshotCommandTest(CommandTest, ObjectTest, SingleSessionTest):
+
+    def setUp(self):
+        super(SnapshotCommandTest, self).setUp()
+
+        self.create_devices(self.sess, count=8)
+        self.create_hosts(self.sess)
+
+        self.sess.open_changeset()
+        s = Subnet(addr="10.0.0.0", mask_len=24)
+        for (i, d) in enumerate(self.objects['devices']):
+            d.host.interfaces[0].address = IpAddress(value="10.0.0.%d" % (i + 10), subnet=s)
+        self.sess.submit_changeset()
+
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        super(SnapshotCommandTest, self).tearDown()
+        shutil.rmtree(self.tmpdir)
+
+    def dump(self):
+        from dino.db.snapshot import sorted_tables
+        conn = self.db.connection()
+        rows = dict([ (t.name, [ tuple(r) for r in conn.execute(t.select().order_by(*list(t.primary_key))) ])
+                      for t in sorted_tables(self.db.metadata_set) ])
+        conn.close()
+        return rows
+
+    def test_round_trip(self):
+        from dino.db import snapshot
+        snapshot.BLOCK_ROWS = 3
+        try:
+            before = self.dump()
+            manifest = self.runCommand('admin', 'snapshot', self.tmpdir)
+            eq_( dict([ (t['name'], t['rows']) for t in manifest['tables'] ]),
+                 dict([ (name, len(rows)) for (name, rows) in before.items() ]) )
+            assert_true( before['ip_revision'] )
+
+            # changed after the snapshot
+            self.sess.open_changeset()
+            self.sess.add(Subnet(addr="10.1.0.0", mask_len=24))
+            self.sess.query(Subnet).first().description = "changed"
+            self.sess.submit_changeset()
+            self.sess.close()
+            assert_not_equal( self.dump(), before )
+
+            self.runCommand('admin', 'restore', self.tmpdir)
+            eq_( self.dump(), before )
+        finally:
+            snapshot.BLOCK_ROWS = 10000
+
+    def set_protected(self, protected):
+        table = self.db.resolve("SchemaInfo").table
+        conn = self.db.connection()
+        conn.execute(table.update(values={ 'protected' : protected }))
+        conn.close()
+        self.db._schema_info = None
+
+    def test_restore_keeps_protected(self):
+        # a copy of a protected database
+        self.set_protected(True)
+        self.runCommand('admin', 'snapshot', self.tmpdir)
+        self.set_protected(False)
+
+        self.runCommand('admin', 'restore', self.tmpdir)
+        self.db._schema_info = None
+        eq_( self.db.schema_info.protected, False )
+        self.db.assert_unprotected()
+
+    @raises(dino.cmd.CommandExecutionError)
+    def test_restore_schema_version(self):
+        from dino.db.snapshot import json
+        self.runCommand('admin', 'snapshot', self.tmpdir)
+
+        manifest_file = os.path.join(self.tmpdir, 'MANIFEST')
+        manifest = json.loads(open(manifest_file).read())
+        manifest['schema_version'] -= 1
+        f = open(manifest_file, 'w')
+        f.write(json.dumps(manifest))
+        f.close()
+
+        self.runCommand('admin', 'restore', self.tmpdir)
+
+    @raises(dino.cmd.CommandExecutionError)
+    def test_restore_not_snapshot(self):
+        self.runCommand('admin', 'restore', self.tmpdir)
+
+
+class UpgradeCommandTest(CommandTest, SingleSessionTest):
+
+    def set_version(self, version):
+        table = self.db.resolve("SchemaInfo").table
+        conn = self.db.connection()
+        conn.execute(table.update(values={ 'version' : version }))
+        conn.close()
+        self.db._schema_info = None
+
+    def test_revision_indexes(self):
+        from dino.db import upgrade
+        table = Device.Revision.table
+
+        # the 2.1.10 indexes of device_revision
+        conn = self.db.connection()
+        [ index for index in table.indexes if index.name == "ix_device_revision_validity" ][0].drop(bind=conn)
+        conn.execute("CREATE INDEX ix_device_revision_head_id ON device_revision (head_id)")
+        conn.close()
+        self.set_version(0x020110)
+        assert_raises( SchemaVersionMismatch, self.db.session )
+
+        eq_( self.runCommand('admin', 'upgrade'), [ 0x020110 ] )
+
+        conn = self.db.connection()
+        names = upgrade.index_names(conn, table)
+        conn.close()
+        assert_true( "ix_device_revision_validity" in names )
+        assert_false( "ix_device_revision_head_id" in names )
+
+        self.db._schema_info = None
+        eq_( self.db.schema_info.version, SCHEMA_VERSION )
+        self.db.session().close()
+        eq_( self.runCommand('admin', 'upgrade'), [] )
+
+    @raises(dino.cmd.CommandExecutionError)
+    def test_unknown_version(self):
+        self.set_version(0x020100)
+        self.runCommand('admin', 'upgrade')
+
+
+class DiffCommandTest(CommandTest, SingleSessionTest):
+    
+    def setUp(self):
+        super(DiffCommandTest, self).setUp()
+        
+        self.sess.open_changeset()
+        site = Site(name='sjc1', address1="", address2="", city="", state="", postal="", description="")
+        rack = Rack(name="1.1", site=site)
+        self.sess.add(rack)
+        self.cs1 = self.sess.submit_changeset()
+        
+        self.sess.open_changeset()
+        rack.size = 20
+        self.sess.add(Subnet(addr="10.0.0.0", mask_len=24))
+        self.cs2 = self.sess.submit_changeset()
+        
+    def test_diff(self):
+        lines = self.runCommand('diff', str(self.cs1), str(self.cs2))
+        eq_( sorted(lines), [ "+ Subnet/10.0.0.0_24", "~ Rack/sjc1.1.1" ] )
+        
+        lines = self.runCommand('diff', str(self.cs1), str(self.cs2), 'Rack')
+        eq_( lines, [ "~ Rack/sjc1.1.1" ] )
+        
+    @raises(dino.cmd.CommandArgumentError)
+    def test_bad_changeset(self):
+        self.runCommand('diff', 'x', str(self.cs2))
         
 
 class ImportCommandTest(CommandTest, DataTest):
@@ -294,8 +497,80 @@ class ImportCommandTest(CommandTest, DataTest):
         self.assertEqual( device.hid, "001EC943AF41" )
         self.assertEqual( device.serialno,  "..CN7082184700NF")
         self.assertEqual( device.rackpos,  16)
-        self.assertEqual( device.pdu_port,  '3')      
+        self.assertEqual( device.pdu_port,  '3')
+
+    def test_bulk_import(self):
+        sess = self.db.session()
+
+        # update1 is applied in a second changeset, to the Device created by the first
+        (count, elapsed) = self.runCommand('jsonimport', '-b', '-s', '1', '-j', '2',
+                                           self.get_datafile("host1.json"), self.get_datafile("update1.json"))
+        self.assertEqual( count, 2 )
+
+        devices = sess.query(Device).filter_by(hw_class="server").all()
+        self.assertEqual(len(devices), 1)
+        self.assertEqual( devices[0].rackpos,  16)
+        self.assertNotEqual( devices[0].host, None )
+
+    def test_check(self):
+        sess = self.db.session()
+        
+        report = self.runCommand('jsonimport', '-c', self.get_datafile("host1.json"), self.get_datafile("host2.json"))
+        self.assertEqual( (report['files'], report['failed']), (2, 1) )
+        self.assertEqual( report['errors'][0]['file'], self.get_datafile("host2.json") )
+        self.assertEqual( report['errors'][0]['errors'], [ 'Chassis: Chassis/blob does not exist.' ] )
+        
+        # nothing was written
+        self.assertEqual( sess.query(Device).filter_by(hw_class="server").count(), 0 )
+        sess.close()
+
+    def test_parse_file(self):
+        from dino.cmd.jsonutil import parse_file
         
+        # without a session, the lookups of the v1 transform are deferred
+        (path, data, errors) = parse_file(self.get_datafile("host1.json"))
+        self.assertEqual( errors, [] )
+        kinds = [ kind for (spec, key, kind, arg) in data['Header']['deferred'] ]
+        self.assertEqual( sorted(kinds), [ 'device', 'dynamic', 'dynamic', 'subnet', 'subnet' ] )
+
+
+
+class JsonExportCommandTest(CommandTest, ObjectTest, SingleSessionTest):
+
+    def setUp(self):
+        super(JsonExportCommandTest, self).setUp()
+
+        self.create_devices(self.sess, count=12)
+        self.create_hosts(self.sess)
+
+        self.sess.open_changeset()
+        s = Subnet(addr="10.0.0.0", mask_len=24)
+        for (i, d) in enumerate(self.objects['devices']):
+            d.ports[0].is_blessed = True
+            d.host.interfaces[0].address = IpAddress(value="10.0.0.%d" % (i + 10), subnet=s)
+        self.sess.submit_changeset()
+
+    def test_export_all(self):
+        from dino.cmd.jsonutil import json, JsonExporter, JsonProcessor
+
+        # chunks of two hosts
+        JsonExporter.CHUNK_SIZE = 2
+        try:
+            lines = self.runCommand('jsonexport', '-a')
+        finally:
+            JsonExporter.CHUNK_SIZE = 500
+
+        # the same as the export of each host through the ORM
+        proc = JsonProcessor(self.sess)
+        expected = [ proc.host_to_dict(d.host) for d in self.objects['devices'] ]
+        eq_( [ json.loads(l) for l in lines ], json.loads(json.dumps(expected)) )
+
+        host = self.objects['devices'][1].host
+        lines = self.runCommand('jsonexport', '-a', 'Host[id=%d]' % host.id)
+        eq_( [ json.loads(l).keys() for l in lines ], [ json.loads(json.dumps(proc.host_to_dict(host))).keys() ] )
+
+        eq_( len(self.runCommand('jsonexport', '-a', '-s', 'sjc1')), 3 )
+        eq_( self.runCommand('jsonexport', '-a', '-s', 'other'), [] )
 
 
 if __name__ == "__main__":
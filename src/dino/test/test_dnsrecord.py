@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+
+import os
+import struct
+import sys
+import tempfile
+import unittest
+
+if __name__ == "__main__":
+    sys.path[0] = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+
+from dino.generators.dnsrecord import *
+from dino.generators.cdb import CdbWriter, CdbReader
+
+
+DATA = """
+# comment
+=host1.example.com:10.0.0.1   # trailing comment
++slot1.rack1.example.com:10.0.0.1
+
+Cwww.example.com:host1.example.com:300
+"""
+
+class DnsRecordTest(unittest.TestCase):
+
+    def setUp(self):
+        (fd, self.path) = tempfile.mkstemp()
+        f = os.fdopen(fd, 'w')
+        f.write(DATA)
+        f.close()
+
+    def tearDown(self):
+        os.unlink(self.path)
+
+    def test_parse(self):
+        recs = DnsRecord.parse_data_file(self.path)
+
+        self.assertEquals( [ r.__class__ for r in recs ], [ FullARecord, ForwardARecord, CnameRecord ] )
+        self.assertEquals( str(recs[0]), "=host1.example.com:10.0.0.1" )
+        self.assertEquals( recs[2].p, "host1.example.com" )
+        self.assertEquals( recs[2].ttl, "300" )
+        self.assertEquals( recs[2].lo, None )
+
+    def test_key(self):
+        rec = FullARecord(fqdn="host1.example.com", ip="10.0.0.1")
+        parsed = DnsRecord.parse_record("=host1.example.com:10.0.0.1")
+
+        self.assertEquals( rec, parsed )
+        self.assertEquals( len(set([rec, parsed])), 1 )
+        self.assertNotEquals( rec, ForwardARecord(fqdn="host1.example.com", ip="10.0.0.1") )
+
+        # Setting a field rebuilds the key
+        rec.ip = "10.0.0.2"
+        self.assertEquals( str(rec), "=host1.example.com:10.0.0.2" )
+        self.assertTrue( parsed < rec )
+        self.assertRaises( AttributeError, setattr, rec, 'other', 1 )
+
+
+class CdbTest(unittest.TestCase):
+
+    def setUp(self):
+        (fd, self.path) = tempfile.mkstemp()
+        os.close(fd)
+
+    def tearDown(self):
+        os.unlink(self.path)
+
+    def test_round_trip(self):
+        w = CdbWriter(self.path)
+        for i in xrange(1000):
+            w.add("key%d" % i, "value%d" % i)
+        w.add("key1", "again")
+        w.close()
+
+        r = CdbReader(self.path)
+        self.assertEquals( r.get("key999"), "value999" )
+        self.assertEquals( r.get_all("key1"), [ "value1", "again" ] )
+        self.assertEquals( r.get("missing"), None )
+        self.assertEquals( len(list(r)), 1001 )
+        r.close()
+
+    def test_tinydns(self):
+        recs = [ DnsRecord.parse_record("+Host.example.com:10.0.0.1"),
+                 DnsRecord.parse_record("=db.example.com:10.0.0.2:300"),
+                 DnsRecord.parse_record("Cwww.example.com:db.example.com"),
+                 DnsRecord.parse_record("+*.wild.example.com:10.0.0.3") ]
+        self.assertEquals( write_cdb(recs, self.path, 1), 5 )
+
+        ttd = "\0" * 8
+        r = CdbReader(self.path)
+        self.assertEquals( r.get("\x04host\x07example\x03com\x00"), 
+                           "\x00\x01=" + struct.pack(">L", 86400) + ttd + "\x0a\x00\x00\x01" )
+        self.assertEquals( r.get("\x012\x010\x010\x0210\x07in-addr\x04arpa\x00"), 
+                           "\x00\x0c=" + struct.pack(">L", 300) + ttd + "\x02db\x07example\x03com\x00" )
+        self.assertEquals( r.get("\x03www\x07example\x03com\x00")[:3], "\x00\x05=" )
+        # wildcards are stored under the parent name
+        self.assertEquals( r.get("\x04wild\x07example\x03com\x00")[:3], "\x00\x01*" )
+        r.close()
+
+    def test_tinydns_comments(self):
+        f = open(self.path, 'w')
+        f.write("# comment\n"
+                "'txt.example.com:v=1 #a\\043b:300  \n"
+                ":gen.example.com:16:x#y\n")
+        f.close()
+        recs = list(DnsRecord.iter_tinydns_data(self.path))
+        self.assertEquals( [ str(rec) for rec in recs ],
+                           [ "'txt.example.com:v=1 #a\\043b:300", ":gen.example.com:16:x#y" ] )
+
+        # '#' is only a comment in the first column
+        write_cdb(recs, self.path, 1)
+        r = CdbReader(self.path)
+        self.assertEquals( r.get("\x03txt\x07example\x03com\x00")[-9:], "\x08v=1 #a#b" )
+        self.assertEquals( r.get("\x03gen\x07example\x03com\x00")[-3:], "x#y" )
+        r.close()
+
+
+#
+# Micro-benchmark (not run by the test suite)
+#
+def do_parse_bench(path=None, count=1000000):
+    """ Time parse_data_file, set() and sort() of the records in path, 
+    a tinydns data file, or of count generated records if no path is given """
+    import time
+
+    generated = path is None
+    if generated:
+        (fd, path) = tempfile.mkstemp()
+        f = os.fdopen(fd, 'w')
+        for i in xrange(count):
+            f.write("=host%d.pod%d.sjc1.example.com:10.%d.%d.%d\n" % (i, i % 50, i >> 16 & 0xff, i >> 8 & 0xff, i & 0xff))
+        f.close()
+
+    try:
+        start = time.time()
+        recs = DnsRecord.parse_data_file(path)
+        print "parse: %d records: %.3fs" % (len(recs), time.time() - start)
+
+        start = time.time()
+        rec_set = set(recs)
+        print "set:   %d records: %.3fs" % (len(rec_set), time.time() - start)
+
+        start = time.time()
+        recs.sort()
+        print "sort:  %d records: %.3fs" % (len(recs), time.time() - start)
+    finally:
+        if generated:
+            os.unlink(path)
+
+
+if __name__ == "__main__":
+    import sys
+    do_parse_bench(*sys.argv[1:2])
@@ -21,6 +21,8 @@ from nose.tools import *
 
 from dino.db import Element, ResourceElement, ElementFormProcessor
 from dino.db.objectspec import *
+from dino.db.exception import ElementExistsError
+from dino.db.session import ElementCache
 from dino.db import collection
 from dino.test.base import *
 
@@ -186,6 +188,52 @@ class ObjectSpecTest(DinoTest):
         for x in ['person/foo', 'person/{1}', 'person/<2>']:
             assert_true(AttributeSpec.is_spec(x), "Does not match: %s" % x )
 
+class ElementCacheTest(DinoTest):
+    
+    class FakeElement(object):
+        def __init__(self, name, id):
+            self.element_name = "Fake/%s" % name
+            self.element_id = "Fake/{%d}" % id
+            
+    def test_keys(self):
+        cache = ElementCache(2)
+        e = self.FakeElement("a", 1)
+        cache.add(e)
+        
+        assert cache.get("Fake/a") is e
+        assert cache.get("Fake/{1}") is e
+        assert cache.get("Fake/b") is None
+        eq_( (cache.hits, cache.misses), (2, 1) )
+        
+    def test_evict(self):
+        cache = ElementCache(2)
+        (a, b, c) = [ self.FakeElement(n, i) for (i, n) in enumerate("abc") ]
+        cache.add(a)
+        cache.add(b)
+        cache.get("Fake/a")
+        cache.add(c)
+        
+        eq_( len(cache), 2 )
+        assert "Fake/a" in cache
+        assert "Fake/b" not in cache
+        assert "Fake/{1}" not in cache
+        
+    def test_rename(self):
+        cache = ElementCache(2)
+        e = self.FakeElement("a", 1)
+        cache.add(e)
+        e.element_name = "Fake/z"
+        cache.add(e)
+        
+        eq_( len(cache), 1 )
+        assert "Fake/a" not in cache
+        assert cache.get("Fake/z") is e
+        
+        cache.discard(e)
+        eq_( len(cache), 0 )
+        assert "Fake/{1}" not in cache
+        
+        
 class PersonTest(DatabaseTest):
     ENTITY_SET = entity_set    
     NAME = "eddie"
@@ -206,6 +254,41 @@ class PersonTest(DatabaseTest):
         
         assert p2.instance_name == self.NAME
         assert p2._instance_name == self.NAME
+
+    def test_cache(self):
+        self.db.element_cache_size = 10
+        sess = self.db.session()
+        
+        p = Person(name=self.NAME, age=12)
+        sess.add(p)
+        sess.flush()
+        
+        assert sess.find_element("Person/%s" % self.NAME) is p
+        assert sess.find_element(p.element_id) is p
+        eq_( sess.element_cache.hits, 2 )
+        
+        sess.delete(p)
+        sess.flush()
+        assert sess.find_element("Person/%s" % self.NAME) is None
+
+    @raises(ElementExistsError)
+    def test_exists(self):
+        sess = self.db.session()
+        
+        sess.add(Person(name=self.NAME, age=12))
+        sess.flush()
+        
+        sess.add(Person(name="other", age=12))
+        sess.add(Person(name=self.NAME, age=13))
+        sess.flush()
+        
+    @raises(ElementExistsError)
+    def test_exists_pending(self):
+        sess = self.db.session()
+        
+        sess.add(Person(name=self.NAME, age=12))
+        sess.add(Person(name=self.NAME, age=13))
+        sess.flush()
         
         
         
@@ -0,0 +1,396 @@
+import os
+import shutil
+import tempfile
+
+from nose.tools import *
+
+from dino.db import *
+from dino.test.base import *
+from dino.config import setattrable_dict
+from dino.generators.base import Generator, GeneratorExecutionError
+from dino.cmd import MainCommand, CommandExecutionError
+
+
+class IncrementalTest(ObjectTest, SingleSessionTest):
+
+    def setUp(self):
+        super(IncrementalTest, self).setUp()
+
+        self.create_devices(self.sess, count=8)
+        self.create_hosts(self.sess)
+        self.hosts = [ d.host for d in self.objects['devices'] ]
+
+        self.sess.open_changeset()
+        s = Subnet(addr="10.0.0.0", mask_len=24)
+        self.sess.add(s)
+        self.cs1 = self.sess.submit_changeset()
+
+        self.gen = Generator.get_generator_class('pxe')(self.db)
+        self.gen.workdir = tempfile.mkdtemp()
+        self.gen.state_file = self.gen.workdir + ".state"
+
+    def tearDown(self):
+        super(IncrementalTest, self).tearDown()
+        shutil.rmtree(self.gen.workdir)
+        if os.path.exists(self.gen.state_file):
+            os.unlink(self.gen.state_file)
+
+    def test_changed_hosts(self):
+        (h1, h2) = self.hosts
+
+        self.sess.open_changeset()
+        h1.device.ports[0].mac = "03:03:03:03:ff:01"
+        iface = h2.interfaces[0]
+        iface.address = IpAddress(value="10.0.0.5", subnet=self.sess.query(Subnet).first())
+        cs2 = self.sess.submit_changeset()
+
+        (changeset, pending, ids) = self.gen.scan_changesets(self.sess, { 'changeset' : int(self.cs1) })
+        eq_( (changeset, pending, ids), (int(cs2), [], set([int(cs2)])) )
+        eq_( self.gen.changed_hosts(self.sess, ids), set([h1.id, h2.id]) )
+        eq_( self.gen.changed_hosts(self.sess, []), set() )
+
+        # A change to the Subnet reaches every Host with an address in it
+        self.sess.open_changeset()
+        self.sess.query(Subnet).first().description = "changed"
+        cs3 = self.sess.submit_changeset()
+        eq_( self.gen.changed_hosts(self.sess, [ int(cs3) ]), set([h2.id]) )
+
+    def test_late_submit(self):
+        (h1, h2) = self.hosts
+        
+        self.sess.open_changeset()
+        h1.name = "late"
+        late = int(self.sess.submit_changeset())
+        
+        self.sess.open_changeset()
+        h2.name = "early"
+        early = int(self.sess.submit_changeset())
+        
+        # Seen as the lower id still in progress while the higher one is submitted
+        table = self.sess.resolve_entity("ChangeSet").table
+        committed = self.sess.execute(table.select(table.c.id == late)).fetchone()['committed']
+        self.sess.execute(table.update(table.c.id == late, values={ 'committed' : None }))
+        
+        (changeset, pending, ids) = self.gen.scan_changesets(self.sess, { 'changeset' : int(self.cs1) })
+        eq_( (changeset, pending, ids), (early, [ late ], set([ early ])) )
+        
+        self.sess.execute(table.update(table.c.id == late, values={ 'committed' : committed }))
+        
+        state = { 'changeset' : changeset, 'pending' : pending }
+        (changeset, pending, ids) = self.gen.scan_changesets(self.sess, state)
+        eq_( (changeset, pending, ids), (early, [], set([ late ])) )
+        eq_( self.gen.changed_hosts(self.sess, ids), set([ h1.id ]) )
+
+    def test_state(self):
+        eq_( self.gen.load_state(), None )
+
+        self.gen.save_state(int(self.cs1), files={ 1 : '01-aa' })
+        state = self.gen.load_state()
+        eq_( state['changeset'], int(self.cs1) )
+        eq_( state['files'], { 1 : '01-aa' } )
+
+        self.gen.full = True
+        eq_( self.gen.load_state(), None )
+
+        self.gen.full = False
+        self.gen.settings = setattrable_dict(self.gen.settings, site='other')
+        eq_( self.gen.load_state(), None )
+
+
+class DhcpQueryTest(ObjectTest, SingleSessionTest):
+
+    def setUp(self):
+        super(DhcpQueryTest, self).setUp()
+
+        self.create_devices(self.sess, count=8)
+        self.create_hosts(self.sess)
+
+        self.sess.open_changeset()
+        s = Subnet(addr="10.0.0.0", mask_len=24)
+        for (i, d) in enumerate(self.objects['devices']):
+            (eth0, eth1) = d.ports
+            eth0.is_blessed = True
+            eth1.is_ipmi = True
+            d.host.interfaces[0].address = IpAddress(value="10.0.0.%d" % (i + 10), subnet=s)
+        self.sess.submit_changeset()
+
+        self.gen = Generator.get_generator_class('dhcp')(self.db)
+        self.gen.settings = setattrable_dict(self.gen.settings, site='sjc1', domain='example.com')
+
+    def test_query_hosts(self):
+        hosts = [ dict(d) for d in self.gen.query_hosts(self.sess) ]
+
+        expected = []
+        for d in self.objects['devices']:
+            port = d.ports[0]
+            expected.append( (d.host.hostname() + '.example.com', port.mac, port.interface.address.value) )
+
+        eq_( sorted([ (d['hostname'], d['mac'], d['ip']) for d in hosts ]), sorted(expected) )
+
+        # The ipmi Interfaces have no address
+        eq_( list(self.gen.query_ipmi_hosts(self.sess)), [] )
+
+    def test_port_rows_chunks(self):
+        # a second Interface on each blessed port, its rows are skipped
+        self.sess.open_changeset()
+        for d in self.objects['devices']:
+            d.host.interfaces.append(Interface(port_name=d.ports[0].name, ifindex="1"))
+        self.sess.submit_changeset()
+
+        rows = list(self.gen.query_port_rows(self.sess, Port.is_blessed == True))
+        eq_( [ row[0] for row in rows ], sorted([ d.ports[0].id for d in self.objects['devices'] ]) )
+        assert_false( [ row for row in rows if row[7] is None ] )
+
+        # each chunk is a query, the chunks end inside the rows of a Port
+        for size in (1, 3):
+            self.gen.QUERY_CHUNK_SIZE = size
+            eq_( list(self.gen.query_port_rows(self.sess, Port.is_blessed == True)), rows )
+
+
+class PidGenerator(Generator):
+    NAME = "test_pid"
+    # Not in Generator.MAP, generate -l and running all generators must not see these
+    REGISTER = False
+    # Set by the test, pool processes are forked and see it too
+    OUTPUT_DIR = None
+
+    def generate(self):
+        f = open(os.path.join(self.OUTPUT_DIR, self.NAME), 'w')
+        f.write(str(os.getpid()))
+        f.close()
+
+    ACTIVATED = 0
+
+    def activate(self):
+        PidGenerator.ACTIVATED += 1
+
+class OtherPidGenerator(PidGenerator):
+    NAME = "test_other_pid"
+
+class FailGenerator(PidGenerator):
+    NAME = "test_fail"
+
+    def generate(self):
+        raise GeneratorExecutionError("failed")
+
+
+class SqlGenerator(PidGenerator):
+    NAME = "test_sql"
+    
+    def generate(self):
+        self.phase('query')
+        session = self.db_config.session()
+        session.query(Host).all()
+        session.query(Device).all()
+        session.close()
+        
+        self.phase('write')
+        super(SqlGenerator, self).generate()
+        
+
+class CountGenerator(PidGenerator):
+    NAME = "test_count"
+    
+    def generate(self):
+        session = self.db_config.session()
+        count = session.query(Chassis).count()
+        session.close()
+        
+        f = open(os.path.join(self.OUTPUT_DIR, self.NAME), 'w')
+        f.write(str(count))
+        f.close()
+        
+
+class GenerateJobsTest(DatabaseTest):
+
+    def setUp(self):
+        super(GenerateJobsTest, self).setUp()
+        PidGenerator.OUTPUT_DIR = tempfile.mkdtemp()
+
+        self.cmd = MainCommand.find_command('generate')(self.db, None)
+        self.cmd.parse(['-j', '2'])
+
+    def tearDown(self):
+        super(GenerateJobsTest, self).tearDown()
+        shutil.rmtree(PidGenerator.OUTPUT_DIR)
+
+    def test_parallel(self):
+        gen_list = [ PidGenerator(self.db), OtherPidGenerator(self.db) ]
+        gen_list[0].profile = self.cmd.create_profile(gen_list[0])
+        results = self.cmd.generate_all(gen_list, self.db)
+        eq_( sorted([ r[0] for r in results ]), [ "test_other_pid", "test_pid" ] )
+        
+        # The profile of the pool process is returned
+        eq_( [ p['phase'] for p in gen_list[0].profile.report() ], [ 'generate' ] )
+
+        f = open(os.path.join(PidGenerator.OUTPUT_DIR, 'test_pid'))
+        pid = int(f.read())
+        f.close()
+        assert_not_equal( pid, os.getpid() )
+
+    def test_parallel_session(self):
+        sess = self.db.session()
+        sess.begin()
+        for i in xrange(3):
+            sess.add(Chassis(name="c%d" % i, vendor="", product=""))
+        sess.commit()
+        sess.close()
+        
+        # The pool processes open sessions of their own
+        self.cmd.generate_all([ CountGenerator(self.db), SqlGenerator(self.db) ], self.db)
+        
+        f = open(os.path.join(PidGenerator.OUTPUT_DIR, 'test_count'))
+        eq_( f.read(), "3" )
+        f.close()
+
+    def test_not_registered(self):
+        for cls in (PidGenerator, OtherPidGenerator, FailGenerator, SqlGenerator, CountGenerator):
+            eq_( Generator.find_generator_class(cls.NAME), None )
+        assert Generator.find_generator_class('pxe') is not None
+
+    @raises(CommandExecutionError)
+    def test_failure(self):
+        self.cmd.generate_all([ PidGenerator(self.db), FailGenerator(self.db) ], self.db)
+
+    def test_profile(self):
+        self.cmd.parse(['-p', '--cprofile', 'query'])
+        
+        gen = SqlGenerator(self.db)
+        gen.profile = self.cmd.create_profile(gen)
+        gen.profile.cprofile_dir = PidGenerator.OUTPUT_DIR
+        self.cmd.generate_all([ gen ], self.db)
+        
+        report = gen.profile.report()
+        eq_( [ p['phase'] for p in report ], [ 'generate', 'query', 'write' ] )
+        eq_( report[1]['sql'], 2 )
+        eq_( report[2]['sql'], 0 )
+        assert_true( os.path.exists(os.path.join(PidGenerator.OUTPUT_DIR, 'test_sql.query.prof')) )
+        
+        # the engine is no longer counted
+        gen.profile.phase('other')
+        self.db.session().query(Host).all()
+        gen.profile.stop()
+        eq_( gen.profile.report()[-1]['sql'], 0 )
+
+
+class OutputTest(DinoTest):
+
+    def setUp(self):
+        super(OutputTest, self).setUp()
+        self.gen = PidGenerator(None)
+        self.gen.workdir = tempfile.mkdtemp()
+        self.gen.manifest_file = self.gen.workdir + ".manifest"
+        PidGenerator.ACTIVATED = 0
+
+    def tearDown(self):
+        super(OutputTest, self).tearDown()
+        shutil.rmtree(self.gen.workdir)
+        os.unlink(self.gen.manifest_file)
+
+    def generate(self, files, prune=True):
+        output = self.gen.open_output(prune=prune)
+        for (name, content) in files.items():
+            output.write(name, content)
+        return self.gen.close_output(output)
+
+    def test_write_if_changed(self):
+        eq_( self.generate({ 'a' : 'A', 'b' : 'B' }), set(['a', 'b']) )
+        eq_( self.generate({ 'a' : 'A', 'b' : 'B' }), set() )
+        eq_( self.generate({ 'a' : 'A', 'c' : 'C' }), set(['b', 'c']) )
+        eq_( sorted(os.listdir(self.gen.workdir)), ['a', 'c'] )
+
+        # Changes accumulate until activate
+        eq_( self.gen.load_manifest(), set(['a', 'b', 'c']) )
+
+    def test_activate_skip(self):
+        self.gen.settings = setattrable_dict(self.gen.settings, disable_activate='0')
+
+        self.generate({ 'a' : 'A' })
+        self.gen.activate()
+        eq_( self.gen.load_manifest(), set() )
+
+        # Nothing changed, activate() is not called
+        self.generate({ 'a' : 'A' })
+        self.gen.activate()
+
+        self.generate({ 'a' : 'B' })
+        self.gen.activate()
+        eq_( PidGenerator.ACTIVATED, 2 )
+
+    def test_activate_full(self):
+        self.gen.settings = setattrable_dict(self.gen.settings, disable_activate='0')
+
+        self.generate({ 'a' : 'A' })
+        self.gen.activate()
+        eq_( self.gen.load_manifest(), set() )
+
+        # Nothing changed, but a full activate pushes everything again
+        self.gen.full = True
+        self.gen.activate()
+        eq_( PidGenerator.ACTIVATED, 2 )
+        eq_( self.gen.manifest, None )
+
+
+class DnsWriterTest(ObjectTest, SingleSessionTest):
+
+    def setUp(self):
+        super(DnsWriterTest, self).setUp()
+
+        self.create_devices(self.sess, count=12)
+        self.create_hosts(self.sess)
+
+        self.sess.open_changeset()
+        s = Subnet(addr="10.0.0.0", mask_len=24)
+        for (i, d) in enumerate(self.objects['devices']):
+            d.ports[0].is_blessed = True
+            d.host.interfaces[0].address = IpAddress(value="10.0.0.%d" % (i + 10), subnet=s)
+        self.sess.submit_changeset()
+
+        self.tmpdir = tempfile.mkdtemp()
+        self.gen = Generator.get_generator_class('dns')(self.db)
+        self.gen.settings = setattrable_dict(self.gen.settings, site='sjc1', domain='example.com')
+        self.gen.workdir = os.path.join(self.tmpdir, 'dns')
+        self.gen.manifest_file = os.path.join(self.tmpdir, 'dns.manifest')
+
+        # one of the dynamic records is also static
+        self.static = os.path.join(self.tmpdir, 'static')
+        f = open(self.static, 'w')
+        f.write("# static\n")
+        f.write("+www.example.com:10.1.1.1\n")
+        f.write("=host-%s.pod01.sjc1.example.com:10.0.0.10  # dup\n" % self.objects['devices'][0].id)
+        f.close()
+
+    def tearDown(self):
+        super(DnsWriterTest, self).tearDown()
+        shutil.rmtree(self.tmpdir)
+
+    def test_write_data(self):
+        self.gen.SORT_CHUNK_SIZE = 2
+        self.gen.write_data(self.tmpdir, [ self.static ])
+
+        f = open(os.path.join(self.gen.workdir, self.gen.settings.dns_combinded_file))
+        lines = f.read().split("\n")
+        f.close()
+
+        dynamic = [ l for l in lines[lines.index("# Begin dynamically generated records") + 2:] if l ]
+        eq_( len(dynamic), 5 )
+        eq_( dynamic, sorted(dynamic) )
+        assert_true( "+www.example.com:10.1.1.1" in lines )
+        assert_false( [ l for l in dynamic if l.startswith("=host-%s." % self.objects['devices'][0].id) ] )
+
+    def test_compile_cdb(self):
+        from dino.generators.cdb import CdbReader
+        
+        self.gen.settings = setattrable_dict(self.gen.settings, dns_compile_cdb='1')
+        self.gen.write_data(self.tmpdir, [ self.static ])
+        eq_( self.gen.load_manifest(), set([ self.gen.settings.dns_combinded_file, 'data.cdb' ]) )
+        
+        r = CdbReader(os.path.join(self.gen.workdir, 'data.cdb'))
+        eq_( r.get('\x03www\x07example\x03com\x00')[-4:], '\x0a\x01\x01\x01' )
+        eq_( len(r.get_all('\x0210\x010\x010\x0210\x07in-addr\x04arpa\x00')), 1 )
+        r.close()
+        
+        # An unchanged data file gives the same data.cdb
+        self.gen.clear_manifest()
+        self.gen.write_data(self.tmpdir, [ self.static ])
+        eq_( self.gen.load_manifest(), set() )
@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 
-from dino.db import * 
+from dino.db import *
+from dino.db.model import AddressRuns, PrefixIndex
 import unittest
 
 
@@ -95,3 +96,77 @@ class AddressSetTest(unittest.TestCase):
             
 
 
+    def test_range_size(self):
+        subnet = Subnet(addr="10.0.0.1/24")
+        r = Range(subnet=subnet, start=1, end=10, range_type='policy')
+        
+        self.assertEquals( r.size(), 10 )
+        self.assertTrue( r.contains("10.0.0.1") )
+        self.assertTrue( r.contains("10.0.0.10") )
+        self.assertFalse( r.contains("10.0.0.11") )
+        
+    def test_avail_ips(self):
+        subnet = Subnet(addr="10.0.0.1/24")
+        Range(subnet=subnet, start=1, end=10, range_type='policy')
+        Range(subnet=subnet, start=12, end=16, range_type='dhcp')
+        subnet.addresses.add(IpAddress(value="10.0.0.11"))
+        subnet.addresses.add(IpAddress(value="10.0.0.18"))
+        
+        ip_list = [ IpType.ntoa(n) for n in subnet.avail_ips(3) ]
+        self.assertEquals( ip_list, [ "10.0.0.17", "10.0.0.19", "10.0.0.20" ] )
+        
+        self.assertEquals( len(subnet.avail_ip_set()), 254 - 17 )
+        
+        
+class AddressRunsTest(unittest.TestCase):
+    
+    def test_merge(self):
+        runs = AddressRuns([ (30, 40), (10, 20), (21, 25), (35, 36), (50, 49) ])
+        self.assertEquals( runs.runs, [ (10, 25), (30, 40) ] )
+        self.assertEquals( runs.size(), 27 )
+        
+    def test_contains(self):
+        runs = AddressRuns([ (10, 20), (30, 40) ])
+        for n in (10, 15, 20, 30, 40):
+            self.assertTrue( runs.contains(n) )
+        for n in (0, 9, 21, 29, 41):
+            self.assertFalse( runs.contains(n) )
+        
+    def test_subtract(self):
+        runs = AddressRuns([ (10, 20), (30, 40) ])
+        free = runs.subtract(AddressRuns([ (5, 10), (12, 12), (15, 32), (40, 45) ]))
+        
+        self.assertEquals( free.runs, [ (11, 11), (13, 14), (33, 39) ] )
+        self.assertEquals( list(free), [ 11, 13, 14, 33, 34, 35, 36, 37, 38, 39 ] )
+        self.assertEquals( free.first(4), [ 11, 13, 14, 33 ] )
+        self.assertEquals( free.first(100), list(free) )
+        
+        
+class PrefixIndexTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.index = PrefixIndex()
+        for (value, net) in enumerate([ "10.0.0.0/8", "10.2.0.0/16", "10.2.10.0/24", "0.0.0.0/0" ]):
+            (addr, mask_len) = net.split("/")
+            self.index.insert(IpType.aton(addr), int(mask_len), value)
+            
+    def test_lookup(self):
+        eq = self.assertEquals
+        eq( self.index.lookup(IpType.aton("10.2.10.27")), 2 )
+        eq( self.index.lookup(IpType.aton("10.2.11.27")), 1 )
+        eq( self.index.lookup(IpType.aton("10.3.10.27")), 0 )
+        eq( self.index.lookup(IpType.aton("172.29.1.1")), 3 )
+        
+    def test_update(self):
+        self.index.insert(IpType.aton("10.2.11.0"), 24, 2)
+        
+        self.assertEquals( len(self.index), 4 )
+        self.assertEquals( self.index.lookup(IpType.aton("10.2.10.27")), 1 )
+        self.assertEquals( self.index.lookup(IpType.aton("10.2.11.27")), 2 )
+        
+    def test_discard(self):
+        self.index.discard(3)
+        self.index.discard(1)
+        
+        self.assertEquals( self.index.lookup(IpType.aton("10.2.11.27")), 0 )
+        self.assertEquals( self.index.lookup(IpType.aton("172.29.1.1")), None )
@@ -37,4 +37,45 @@ class SubnetTest(DatabaseTest):
         
         
 
-    
\ No newline at end of file
+    
+
+class PortInterfaceTest(ObjectTest, SingleSessionTest):
+
+    def setUp(self):
+        super(PortInterfaceTest, self).setUp()
+        self.device = self.create_devices(self.sess)[0]
+        self.create_hosts(self.sess)
+
+    def test_lookup(self):
+        (eth0, eth1) = self.device.ports
+        eq_( self.device.ports['eth1'], eth1 )
+        eq_( eth0.interface.port, eth0 )
+        eq_( eth1.interface.port_name, 'eth1' )
+
+        self.sess.expunge_all()
+        device = self.sess.query(Device).first()
+        eq_( device.ports.get('eth0').interface, device.host.interfaces['eth0'] )
+
+    def test_rename(self):
+        (eth0, eth1) = self.device.ports
+        iface = eth1.interface
+
+        self.sess.open_changeset()
+        eth1.name = 'eth2'
+        iface.port_name = 'eth2'
+        self.sess.submit_changeset()
+
+        eq_( self.device.ports.get('eth1'), None )
+        eq_( eth1.interface, iface )
+        eq_( iface.port, eth1 )
+
+    def test_remove(self):
+        (eth0, eth1) = self.device.ports
+
+        self.sess.open_changeset()
+        self.device.ports.remove(eth0)
+        self.device.ports.append(Port(name='eth0', mac='03:03:03:03:03:03'))
+        self.sess.submit_changeset()
+
+        eq_( self.device.ports['eth0'].mac, '03:03:03:03:03:03' )
+        eq_( self.device.host.interfaces['eth0'].port, self.device.ports['eth0'] )